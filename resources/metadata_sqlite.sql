@@ -82,6 +82,10 @@ CREATE TABLE data ( id     INTEGER PRIMARY KEY,
                             format TEXT NOT NULL COLLATE NOCASE,
                             uncompressed_size INTEGER NOT NULL,
                             name TEXT NOT NULL,
+                            digest TEXT,
+                            digest_size INTEGER,
+                            digest_mtime REAL,
+                            changed REAL NOT NULL DEFAULT 0,
                             UNIQUE(book, format)
 );
 CREATE TABLE feeds ( id   INTEGER PRIMARY KEY,
@@ -575,4 +579,4 @@ CREATE TRIGGER series_update_trg
         BEGIN
           UPDATE series SET sort=title_sort(NEW.name) WHERE id=NEW.id;
         END;
-pragma user_version=23;
+pragma user_version=24;
@@ -8,6 +8,9 @@ __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 
 import os, time, re
 from collections import defaultdict
+from io import BytesIO
+from operator import itemgetter
+from Queue import Empty
 from future_builtins import map
 
 from calibre import prints
@@ -180,22 +183,205 @@ def import_book_directory(db, dirpath, callback=None, added_ids=None, compiled_r
         callback(mi.title)
 
 
-def recursive_import(db, root, single_book_per_directory=True,
-        callback=None, added_ids=None, compiled_rules=(), add_duplicates=False):
-    root = os.path.abspath(root)
-    duplicates  = []
-    for dirpath in os.walk(root):
-        func = import_book_directory if single_book_per_directory else import_book_directory_multiple
-        res = func(db, dirpath[0], callback=callback,
-            added_ids=added_ids, compiled_rules=compiled_rules, add_duplicates=add_duplicates)
-        if res is not None:
-            duplicates.extend(res)
-        if callable(callback):
-            if callback(''):
-                break
+def find_books_in_tree(root, single_book_per_directory=True, compiled_rules=()):
+    ''' Yield the list of paths to the formats of every book found in the directory tree rooted at root '''
+    for dirpath in os.walk(os.path.abspath(root)):
+        for formats in find_books_in_directory(dirpath[0], single_book_per_directory, compiled_rules=compiled_rules):
+            yield formats
+
+
+def read_metadata_for_import(paths, group_id, tdir):
+    ''' Read the metadata for a book from its formats, runs in a worker
+    process, see :func:`import_books`. Returns None if no metadata could be
+    read, otherwise the metadata as OPF, whether a cover was saved to tdir and
+    the time taken. '''
+    from calibre.ebooks.metadata.worker import serialize_metadata_for
+    st = time.time()
+    mi, opf, has_cover = serialize_metadata_for(paths, tdir, group_id)
+    if mi.title is None:
+        return
+    return opf, has_cover, time.time() - st
+
+
+class ImportStats(object):
+
+    ''' The number of books processed by, and the time spent in, each stage of :func:`import_books` '''
+
+    STAGES = ('scan', 'read', 'add')
+
+    def __init__(self):
+        self.counts = dict.fromkeys(self.STAGES, 0)
+        self.times = dict.fromkeys(self.STAGES, 0.0)
+        self.duplicates = self.failed = 0
+        self.start_time = time.time()
+
+    def record(self, stage, count, elapsed):
+        self.counts[stage] += count
+        self.times[stage] += elapsed
+
+    def rate(self, stage):
+        t = self.times[stage]
+        return self.counts[stage] / t if t > 0 else 0.0
+
+    def summary(self):
+        elapsed = time.time() - self.start_time
+        ans = [_('Added {0} books in {1:.1f} seconds ({2} duplicates, {3} failed)').format(
+            self.counts['add'], elapsed, self.duplicates, self.failed)]
+        for stage, name in zip(self.STAGES, (_('Scanning'), _('Reading metadata'), _('Adding to library'))):
+            ans.append('  ' + _('{0}: {1} books, {2:.1f} books/second').format(name, self.counts[stage], self.rate(stage)))
+        return '\n'.join(ans)
+
+
+def import_books(db, groups, callback=None, added_ids=None, add_duplicates=False, batch_size=50, max_workers=None, stats=None):
+    '''
+    Add books to the library. groups is an iterable that yields a list of
+    paths to the formats of each book, for example, from
+    :func:`find_books_in_tree`. The metadata is read from the files by a pool
+    of worker processes while groups is still being consumed and the books are
+    added to the library in batches of batch_size books. Use max_workers=0 to
+    read the metadata in this process instead.
+
+    Duplicates are detected by title, using an index of the titles in the
+    library built once at the start. Returns a list of (mi, formats) for the
+    books that were not added because they are duplicates. If stats is an
+    :class:`ImportStats` instance, it is updated as books are processed.
+
+    callback is called with the title of every book once its metadata has
+    been read, or with an empty string if it could not be read. If it returns
+    True, the import is aborted before any more books are read and the books
+    not yet added to the library are discarded.
+    '''
+    from calibre.ebooks.metadata.opf2 import OPF
+    from calibre.ptempfile import TemporaryDirectory
+    from calibre.utils.ipc.pool import Pool, Failure
+
+    new_api = db.new_api
+    stats = ImportStats() if stats is None else stats
+    titles = None if add_duplicates else new_api.data_for_has_book()
+    duplicates, pending, file_groups = [], [], {}
+    groups = iter(groups)
+
+    def title_key(mi):
+        return icu_lower(mi.title.strip())
+
+    def add_batch():
+        pending.sort(key=itemgetter(0))
+        batch = [(mi, create_format_map(paths)) for group_id, mi, paths in pending]
+        del pending[:]
+        st = time.time()
+        ids = new_api.add_books(batch, add_duplicates=True)[0]
+        stats.record('add', len(ids), time.time() - st)
+        if added_ids is not None:
+            added_ids.update(ids)
+
+    def group_done(title=''):
+        # Returns True if the import should be aborted
+        return callable(callback) and callback(title)
+
+    def process_result(group_id, result, tdir):
+        paths = file_groups.pop(group_id)
+        if result is None:
+            return group_done()
+        opf, has_cover, elapsed = result
+        stats.record('read', 1, elapsed)
+        mi = OPF(BytesIO(opf), basedir=tdir, populate_spine=False, try_to_guess_cover=False).to_book_metadata()
+        if mi.application_id == '__calibre_dummy__':
+            mi.application_id = None
+        if has_cover:
+            with lopen(os.path.join(tdir, '%s.cdata' % group_id), 'rb') as f:
+                mi.cover_data = None, f.read()
+        if titles is not None:
+            key = title_key(mi)
+            if key in titles:
+                stats.duplicates += 1
+                duplicates.append((mi, paths))
+                return group_done(mi.title)
+            titles.add(key)
+        pending.append((group_id, mi, paths))
+        if group_done(mi.title):
+            return True
+        if len(pending) >= batch_size:
+            add_batch()
+
+    def process_worker_result(worker_result, tdir):
+        if worker_result.is_terminal_failure:
+            prints('The read metadata worker process crashed while processing:', *file_groups.get(worker_result.id, ()))
+            raise Failure(pool.terminal_failure)
+        result = worker_result.result
+        if result.err:
+            stats.failed += 1
+            prints('Failed to read metadata from:', *file_groups.pop(worker_result.id))
+            prints(result.traceback)
+            return group_done()
+        return process_result(worker_result.id, result.value, tdir)
+
+    def next_result(timeout):
+        try:
+            ans = pool.results.get(True, timeout)
+        except Empty:
+            if pool.failed:
+                raise Failure(pool.terminal_failure)
+            return
+        pool.results.task_done()
+        return ans
+
+    with TemporaryDirectory('_import_books') as tdir:
+        pool = None if max_workers == 0 else Pool(max_workers=max_workers, name='ImportBooks')
+        try:
+            group_id = 0
+            while True:
+                if pool is not None:
+                    # Add the books whose metadata has been read so far,
+                    # without waiting for the workers
+                    worker_result = next_result(0)
+                    while worker_result is not None:
+                        if process_worker_result(worker_result, tdir):
+                            return duplicates
+                        worker_result = next_result(0)
+                st = time.time()
+                try:
+                    paths = next(groups)
+                except StopIteration:
+                    break
+                stats.record('scan', 1, time.time() - st)
+                group_id += 1
+                file_groups[group_id] = paths
+                if pool is None:
+                    try:
+                        result = read_metadata_for_import(paths, group_id, tdir)
+                    except Exception:
+                        import traceback
+                        stats.failed += 1
+                        file_groups.pop(group_id)
+                        prints('Failed to read metadata from:', *paths)
+                        traceback.print_exc()
+                        if group_done():
+                            return duplicates
+                        continue
+                    if process_result(group_id, result, tdir):
+                        return duplicates
+                else:
+                    pool(group_id, 'calibre.db.adding', 'read_metadata_for_import', paths, group_id, tdir)
+            while file_groups:
+                worker_result = next_result(0.1)
+                if worker_result is not None and process_worker_result(worker_result, tdir):
+                    return duplicates
+            if pending:
+                add_batch()
+        finally:
+            if pool is not None:
+                pool.shutdown()
     return duplicates
 
 
+def recursive_import(db, root, single_book_per_directory=True,
+        callback=None, added_ids=None, compiled_rules=(), add_duplicates=False, max_workers=None, stats=None):
+    ''' Import all the books in the directory tree rooted at root, see :func:`import_books` '''
+    return import_books(
+        db, find_books_in_tree(root, single_book_per_directory, compiled_rules=compiled_rules),
+        callback=callback, added_ids=added_ids, add_duplicates=add_duplicates, max_workers=max_workers, stats=stats)
+
+
 def add_catalog(cache, path, title, dbapi=None):
     from calibre.ebooks.metadata.book.base import Metadata
     from calibre.ebooks.metadata.meta import get_metadata
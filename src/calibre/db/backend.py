@@ -37,7 +37,7 @@ from calibre.utils.formatter_functions import (load_user_template_functions,
             formatter_functions)
 from calibre.db.tables import (OneToOneTable, ManyToOneTable, ManyToManyTable,
         SizeTable, FormatsTable, AuthorsTable, IdentifiersTable, PathTable,
-        CompositeTable, UUIDTable, RatingTable)
+        CompositeTable, UUIDTable, RatingTable, LazyLoader)
 # }}}
 
 '''
@@ -324,6 +324,20 @@ def set_global_state(backend):
         backend.library_id, (), precompiled_user_functions=backend.get_user_template_functions())
 
 
+def copy_and_hash(src, dest=None):
+    ''' Return the SHA-256 of the contents of src, also copying them to dest,
+    if specified '''
+    sha = hashlib.sha256()
+    while True:
+        raw = src.read(SPOOL_SIZE)
+        if not raw:
+            break
+        sha.update(raw)
+        if dest is not None:
+            dest.write(raw)
+    return sha.hexdigest()
+
+
 class DB(object):
 
     PATH_LIMIT = 40 if iswindows else 100
@@ -1250,13 +1264,21 @@ class DB(object):
         ''' Return last modified time as a UTC datetime object '''
         return utcfromtimestamp(os.stat(self.dbpath).st_mtime)
 
-    def read_tables(self):
+    def read_tables(self, lazy=False):
         '''
-        Read all data from the db into the python in-memory tables
+        Read all data from the db into the python in-memory tables. If lazy is
+        True, tables are instead read on demand, the first time their data is
+        accessed.
         '''
+        loader = self.table_loader = LazyLoader(self)
+        if lazy:
+            for table in self.tables.itervalues():
+                loader.attach(table)
+            return
 
         with self.conn:  # Use a single transaction, to ensure nothing modifies the db while we are reading
             for table in self.tables.itervalues():
+                st = time.time()
                 try:
                     table.read(self)
                 except:
@@ -1264,6 +1286,7 @@ class DB(object):
                     import pprint
                     pprint.pprint(table.metadata)
                     raise
+                loader.load_times[table.name] = time.time() - st
 
     def format_abspath(self, book_id, fmt, fname, path):
         path = os.path.join(self.library_path, path)
@@ -1296,14 +1319,21 @@ class DB(object):
         path = self.format_abspath(book_id, fmt, fname, path)
         if path is None:
             raise NoSuchFormat('Record %d has no fmt: %s'%(book_id, fmt))
-        sha = hashlib.sha256()
         with lopen(path, 'rb') as f:
-            while True:
-                raw = f.read(SPOOL_SIZE)
-                sha.update(raw)
-                if len(raw) < SPOOL_SIZE:
-                    break
-        return sha.hexdigest()
+            return copy_and_hash(f)
+
+    def format_digest(self, book_id, fmt, fname, path, current=None):
+        ''' Return the digest of the format as (sha256, size, mtime). If the
+        size and mtime of the file match those of current, current is returned
+        without reading the file. '''
+        path = self.format_abspath(book_id, fmt, fname, path)
+        if path is None:
+            raise NoSuchFormat('Record %d has no fmt: %s'%(book_id, fmt))
+        st = os.stat(path)
+        if current is not None and current[1:] == (st.st_size, st.st_mtime):
+            return current
+        with lopen(path, 'rb') as f:
+            return copy_and_hash(f), st.st_size, st.st_mtime
 
     def format_metadata(self, book_id, fmt, fname, path):
         path = self.format_abspath(book_id, fmt, fname, path)
@@ -1496,7 +1526,7 @@ class DB(object):
         dest = os.path.join(path, fname + fmt)
         if not os.path.exists(path):
             os.makedirs(path)
-        size = 0
+        size, sha, digest = 0, None, None
         if current_name is not None:
             old_path = os.path.join(path, current_name + fmt)
             if old_path != dest:
@@ -1516,7 +1546,7 @@ class DB(object):
 
         if (not getattr(stream, 'name', False) or not samefile(dest, stream.name)):
             with lopen(dest, 'wb') as f:
-                shutil.copyfileobj(stream, f)
+                sha = copy_and_hash(stream, f)
                 size = f.tell()
             if mtime is not None:
                 os.utime(dest, (mtime, mtime))
@@ -1524,8 +1554,13 @@ class DB(object):
             size = os.path.getsize(dest)
             if mtime is not None:
                 os.utime(dest, (mtime, mtime))
+            with lopen(dest, 'rb') as f:
+                sha = copy_and_hash(f)
 
-        return size, fname
+        if sha is not None:
+            st = os.stat(dest)
+            digest = (sha, st.st_size, st.st_mtime)
+        return size, fname, digest
 
     def update_path(self, book_id, title, author, path_field, formats_field):
         path = self.construct_path_name(book_id, title, author)
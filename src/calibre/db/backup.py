@@ -7,31 +7,108 @@ __license__   = 'GPL v3'
 __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
-import weakref, traceback
-from threading import Thread, Event
+import weakref, traceback, time
+from threading import Thread, Event, Lock
 
 from calibre import prints
 from calibre.ebooks.metadata.opf2 import metadata_to_opf
+from calibre.utils.config_base import tweaks
 
 
 class Abort(Exception):
     pass
 
 
+def create_write_pool():
+    ''' The pool of threads used to write OPF files, several at a time '''
+    from multiprocessing.pool import ThreadPool
+    return ThreadPool(processes=max(1, tweaks.get('newdb_backup_write_threads', 4)))
+
+
+class BackupStats(object):
+
+    ''' Throughput statistics for the metadata backups of a library '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.written = self.failed = self.batches = 0
+        self.busy_time = self.last_rate = 0.0
+        self.last_batch = None
+
+    def record(self, written, failed, elapsed):
+        with self.lock:
+            self.written += written
+            self.failed += failed
+            self.batches += 1
+            self.busy_time += elapsed
+            if elapsed > 0:
+                self.last_rate = written / elapsed
+            self.last_batch = time.time()
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'written': self.written, 'failed': self.failed, 'batches': self.batches,
+                'books_per_second': self.written / self.busy_time if self.busy_time > 0 else 0.0,
+                'last_books_per_second': self.last_rate, 'last_batch': self.last_batch,
+            }
+
+
+def backup_books(db, book_ids, pool=None):
+    '''
+    Write the OPF metadata backups for the specified books and clear their
+    dirtied flags. The metadata for all the books is read under a single read
+    lock and converted to OPF with no lock held. The files are then written
+    under a single read lock, several at a time if pool is not None, and
+    finally the dirtied flags are cleared in a single transaction. Returns the
+    set of books whose backups could not be written, they remain dirtied.
+    '''
+    db = getattr(db, 'new_api', db)
+    st = time.time()
+    sequences, raw_map = {}, {}
+    for book_id, mi, sequence in db.get_metadata_for_dump_batch(book_ids):
+        sequences[book_id] = sequence
+        if mi is None:
+            continue
+        try:
+            raw_map[book_id] = metadata_to_opf(mi)
+        except:
+            prints('Failed to convert to opf for id:', book_id)
+            traceback.print_exc()
+    failures = db.write_backups(raw_map, pool=pool)
+    for book_id, tb in failures.iteritems():
+        prints('Failed to write backup metadata for id:', book_id)
+        prints(tb)
+        del sequences[book_id]
+    db.clear_dirtied_batch(sequences)
+    db.backup_stats.record(len(raw_map) - len(failures), len(failures), time.time() - st)
+    return set(failures)
+
+
 class MetadataBackup(Thread):
     '''
     Continuously backup changed metadata into OPF files
-    in the book directory. This class runs in its own
+    in the book directory. Changed books are processed in batches, oldest
+    first, see :func:`backup_books`. This class runs in its own
     thread.
+
+    Once the backups are done, the hashes of formats are maintained as well:
+    hashes computed by Cache.format_hash() are stored and every
+    digest_interval seconds, the formats of all books are hashed again, one
+    batch of books per interval, see Cache.update_format_digests().
     '''
 
-    def __init__(self, db, interval=2, scheduling_interval=0.1):
+    def __init__(self, db, interval=2, scheduling_interval=0.1, batch_size=100, digest_interval=24 * 3600):
         Thread.__init__(self)
         self.daemon = True
         self._db = weakref.ref(getattr(db, 'new_api', db))
         self.stop_running = Event()
         self.interval = interval
         self.scheduling_interval = scheduling_interval
+        self.batch_size = batch_size
+        self.failed = set()
+        self.digest_interval = digest_interval
+        self.digest_queue, self.next_digest_pass = [], 0
 
     @property
     def db(self):
@@ -48,74 +125,65 @@ class MetadataBackup(Thread):
             raise Abort()
 
     def run(self):
-        while not self.stop_running.is_set():
-            try:
-                self.wait(self.interval)
-                self.do_one()
-            except Abort:
-                break
-
-    def do_one(self):
+        pool = create_write_pool()
         try:
-            book_id = self.db.get_a_dirtied_book()
-            if book_id is None:
-                return
+            while not self.stop_running.is_set():
+                try:
+                    self.wait(self.interval)
+                    # Books whose backups could not be written are retried
+                    # once per interval
+                    self.failed = set()
+                    # Give other threads a chance to use the db between
+                    # batches. Python threads don't have priorities, so this
+                    # thread would naturally keep the processor until some
+                    # scheduling event happens. The wait makes such an event
+                    while self.do_batch(pool):
+                        self.wait(self.scheduling_interval)
+                    self.update_digests()
+                except Abort:
+                    break
+        finally:
+            pool.terminate()
+
+    def do_batch(self, pool=None):
+        try:
+            book_ids = self.db.get_dirtied_books(self.batch_size, exclude=self.failed)
+            if not book_ids:
+                return 0
         except Abort:
             raise
         except:
             # Happens during interpreter shutdown
-            return
-
-        self.wait(0)
-
-        try:
-            mi, sequence = self.db.get_metadata_for_dump(book_id)
-        except:
-            prints('Failed to get backup metadata for id:', book_id, 'once')
-            traceback.print_exc()
-            self.wait(self.interval)
-            try:
-                mi, sequence = self.db.get_metadata_for_dump(book_id)
-            except:
-                prints('Failed to get backup metadata for id:', book_id, 'again, giving up')
-                traceback.print_exc()
-                return
-
-        if mi is None:
-            self.db.clear_dirtied(book_id, sequence)
-            return
-
-        # Give the GUI thread a chance to do something. Python threads don't
-        # have priorities, so this thread would naturally keep the processor
-        # until some scheduling event happens. The wait makes such an event
-        self.wait(self.scheduling_interval)
+            return 0
 
         try:
-            raw = metadata_to_opf(mi)
+            self.failed |= backup_books(self.db, book_ids, pool=pool)
+        except Abort:
+            raise
         except:
-            prints('Failed to convert to opf for id:', book_id)
+            prints('Failed to backup metadata for ids:', book_ids)
             traceback.print_exc()
-            self.db.clear_dirtied(book_id, sequence)
-            return
-
-        self.wait(self.scheduling_interval)
+            self.failed |= set(book_ids)
+        return len(book_ids)
 
+    def update_digests(self):
         try:
-            self.db.write_backup(book_id, raw)
+            db = self.db
+            db.store_pending_format_digests()
+            if not self.digest_queue:
+                if time.time() < self.next_digest_pass:
+                    return
+                self.digest_queue = sorted(db.all_book_ids(), reverse=True)
+                self.next_digest_pass = time.time() + self.digest_interval
+            book_ids = self.digest_queue[-self.batch_size:]
+            del self.digest_queue[-self.batch_size:]
+            db.update_format_digests(book_ids, abort=self.stop_running)
+        except Abort:
+            raise
         except:
-            prints('Failed to write backup metadata for id:', book_id, 'once')
+            prints('Failed to update the hashes of formats')
             traceback.print_exc()
-            self.wait(self.interval)
-            try:
-                self.db.write_backup(book_id, raw)
-            except:
-                prints('Failed to write backup metadata for id:', book_id, 'again, giving up')
-                traceback.print_exc()
-                return
-
-        self.db.clear_dirtied(book_id, sequence)
 
     def break_cycles(self):
         # Legacy compatibility
         pass
-
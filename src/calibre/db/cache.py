@@ -7,23 +7,29 @@ __license__   = 'GPL v3'
 __copyright__ = '2011, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
-import os, traceback, random, shutil, operator
+import os, traceback, random, shutil, operator, heapq
 from io import BytesIO
 from collections import defaultdict, Set, MutableSet
+from contextlib import contextmanager
 from functools import wraps, partial
 from future_builtins import zip
+from threading import Lock
 from time import time
+from weakref import WeakSet
 
 from calibre import isbytestring, as_unicode
 from calibre.constants import iswindows, preferred_encoding
 from calibre.customize.ui import run_plugins_on_import, run_plugins_on_postimport, run_plugins_on_postadd
 from calibre.db import SPOOL_SIZE, _get_next_series_num_for_list
-from calibre.db.categories import get_categories
-from calibre.db.locking import create_locks, DowngradeLockError, SafeReadLock
+from calibre.db.backup import BackupStats, create_write_pool
+from calibre.db.categories import get_categories, CategoryCache
+from calibre.db.locking import create_locks, DowngradeLockError, LockStats, SafeReadLock
 from calibre.db.errors import NoSuchFormat
 from calibre.db.fields import create_field, IDENTITY, InvalidLinkTable
 from calibre.db.search import Search
+from calibre.db.snapshot import Snapshot, SnapshotFields, SnapshotWriteLock
 from calibre.db.tables import VirtualTable
+from calibre.db.utils import DuplicatesIndex, SortIndex
 from calibre.db.write import get_series_values, uniq
 from calibre.db.lazy import FormatMetadata, FormatsList, ProxyMetadata
 from calibre.ebooks import check_ebook_format
@@ -35,7 +41,6 @@ from calibre.ptempfile import (base_dir, PersistentTemporaryFile,
 from calibre.utils.config import prefs, tweaks
 from calibre.utils.date import now as nowf, utcnow, UNDEFINED_DATE
 from calibre.utils.icu import sort_key
-from calibre.utils.localization import canonicalize_lang
 
 
 def api(f):
@@ -55,9 +60,11 @@ def write_api(f):
     return f
 
 
-def wrap_simple(lock, func):
+def wrap_simple(lock, func, lock_stats=None):
     @wraps(func)
     def call_func_with_lock(*args, **kwargs):
+        if lock_stats is not None and lock_stats.enabled:
+            return lock_stats.call(lock, func, args, kwargs)
         try:
             with lock:
                 return func(*args, **kwargs)
@@ -94,6 +101,12 @@ def _add_newbook_tag(mi):
 
 
 dynamic_category_preferences = frozenset({'grouped_search_make_user_categories', 'grouped_search_terms', 'user_categories'})
+# The fields that duplicate detection depends on, see DuplicatesIndex
+DUPLICATES_INDEX_FIELDS = frozenset({'title', 'authors', 'languages'})
+# Fields that are changed along with other fields, see reload_fields_from_db()
+DEPENDENT_FIELDS = {
+    'title': ('sort', 'path'), 'title_sort': ('sort',), 'authors': ('author_sort', 'path'), 'isbn': ('identifiers',),
+}
 
 
 class Cache(object):
@@ -110,15 +123,28 @@ class Cache(object):
 
     def __init__(self, backend):
         self.backend = backend
-        self.fields = {}
+        self.snapshots = WeakSet()
+        self.fields = SnapshotFields(self.snapshots)
         self.composites = {}
         self.read_lock, self.write_lock = create_locks()
+        self.write_lock = SnapshotWriteLock(self.write_lock, self.fields)
+        self.lock_stats = LockStats()
         self.format_metadata_cache = defaultdict(dict)
+        # Format hashes computed under the read lock, waiting to be stored,
+        # see store_pending_format_digests()
+        self.pending_format_digests, self.pending_format_digests_lock = {}, Lock()
         self.formatter_template_cache = {}
         self.dirtied_cache = {}
         self.dirtied_sequence = 0
         self.cover_caches = set()
+        self.metadata_caches = set()
         self.clear_search_cache_count = 0
+        self.sort_indices = {}
+        self.duplicates_index = DuplicatesIndex()
+        self.composite_dependencies = {}
+        self.bulk_edits = None
+        self.category_cache = CategoryCache()
+        self.backup_stats = BackupStats()
 
         # Implement locking for all simple read/write API methods
         # An unlocked version of the method is stored with the name starting
@@ -132,7 +158,7 @@ class Cache(object):
                 setattr(self, '_'+name, func)
                 # Wrap it in a lock
                 lock = self.read_lock if ira else self.write_lock
-                setattr(self, name, wrap_simple(lock, func))
+                setattr(self, name, wrap_simple(lock, func, self.lock_stats))
 
         self._search_api = Search(self, 'saved_searches', self.field_metadata.get_search_terms())
         self.initialize_dynamic()
@@ -161,6 +187,36 @@ class Cache(object):
         will happen.'''
         return SafeReadLock(self.read_lock)
 
+    def lock_statistics(self, enable=None, clear=False):
+        ''' Return the time API calls have spent waiting for and holding the
+        database lock, see :class:`calibre.db.locking.LockStats`. Recording
+        must first be turned on with enable=True, or the newdb_lock_stats
+        tweak. Use clear=True to start over after reading the statistics. '''
+        ans = self.lock_stats.report()
+        if clear:
+            self.lock_stats.clear()
+        if enable is not None:
+            self.lock_stats.enabled = enable
+        return ans
+
+    @read_api
+    def snapshot(self, fields=None):
+        '''
+        Return a :class:`calibre.db.snapshot.Snapshot`, a read-only view of
+        the data in the library as it is now, that can be read without
+        holding the database lock while other threads change the library.
+        Use it for long running reads, such as generating a catalog::
+
+            with cache.snapshot() as snapshot:
+                for book_id in snapshot.all_book_ids():
+                    title = snapshot.field_for('title', book_id)
+
+        :param fields: The names of the fields that will be read, defaults to
+            all fields. Limiting the fields makes writes made while the
+            snapshot is alive cheaper.
+        '''
+        return Snapshot(self, fields)
+
     @write_api
     def ensure_has_search_category(self, fail_on_existing=True):
         if len(self._search_api.saved_searches.names()) > 0:
@@ -212,14 +268,82 @@ class Cache(object):
         self.backend.set_user_template_functions(user_template_functions)
 
     @write_api
-    def clear_composite_caches(self, book_ids=None):
-        for field in self.composites.itervalues():
+    def clear_composite_caches(self, book_ids=None, fields=None):
+        '''
+        Clear the cached values of composite columns for the specified books.
+        If fields is not None, only the composite columns whose templates read
+        one of the specified fields are cleared. '''
+        if book_ids is None:
+            self.composite_dependencies.clear()
+        if fields is not None:
+            # last_modified is updated whenever a book is changed
+            changed = {'last_modified'}
+            for field in fields:
+                changed.add(field)
+                changed.update(Search.DEPENDENT_FIELDS.get(field, ()))
+        for name, field in self.composites.iteritems():
+            if fields is not None:
+                deps = self._composite_fields(name)
+                if deps is not None and deps.isdisjoint(changed):
+                    continue
             field.clear_caches(book_ids=book_ids)
 
+    @read_api
+    def composite_fields(self, name):
+        '''
+        Return the set of fields that the value of the composite column
+        ``name`` depends on, including the fields read by other composite
+        columns its template uses, or None if the set is not known. '''
+        try:
+            return self.composite_dependencies[name]
+        except KeyError:
+            pass
+        ans, seen, pending = set(), {name}, [name]
+        while pending:
+            fields = self.composites[pending.pop()].template_fields()
+            if fields is None:
+                ans = None
+                break
+            for field in fields:
+                if field in self.composites:
+                    if field in seen:
+                        continue
+                    seen.add(field)
+                    pending.append(field)
+                ans.add(field)
+        self.composite_dependencies[name] = ans = None if ans is None else frozenset(ans)
+        return ans
+
+    @read_api
+    def prerender_composites(self, limit=100):
+        '''
+        Render the values of composite columns that were cleared by changes to
+        books, so that sorting or searching on those columns does not have to
+        render them all at once. Renders at most ``limit`` values and returns
+        the number of values rendered, zero when there is nothing left to do.
+        See :class:`calibre.db.prerender.CompositeRenderer`. '''
+        count = 0
+        for field in self.composites.itervalues():
+            for book_id in field.pop_stale(limit - count):
+                if self._has_id(book_id):
+                    field.get_value_with_cache(book_id, self._get_proxy_metadata)
+                    count += 1
+            if count >= limit:
+                break
+        return count
+
     @write_api
-    def clear_search_caches(self, book_ids=None):
+    def clear_search_caches(self, book_ids=None, fields=None):
         self.clear_search_cache_count += 1
-        self._search_api.update_or_clear(self, book_ids)
+        for mc in self.metadata_caches:
+            mc.invalidate(book_ids)
+        self._search_api.update_or_clear(self, book_ids, fields)
+        self.category_cache.clear(fields)
+        if fields is None or not DUPLICATES_INDEX_FIELDS.isdisjoint(fields):
+            if book_ids is None:
+                self.duplicates_index.clear()
+            else:
+                self.duplicates_index.books_changed(book_ids)
 
     @read_api
     def last_modified(self):
@@ -229,14 +353,22 @@ class Cache(object):
     def clear_caches(self, book_ids=None, template_cache=True, search_cache=True):
         if template_cache:
             self._initialize_template_cache()  # Clear the formatter template cache
-        for field in self.fields.itervalues():
+        self.category_cache.clear()
+        for mc in self.metadata_caches:
+            mc.invalidate(book_ids or None)
+        for field in dict.itervalues(self.fields):  # Does not change the data of the fields, see SnapshotFields
             if hasattr(field, 'clear_caches'):
                 field.clear_caches(book_ids=book_ids)  # Clear the composite cache and ondevice caches
         if book_ids:
             for book_id in book_ids:
                 self.format_metadata_cache.pop(book_id, None)
+            for si in self.sort_indices.itervalues():
+                si.books_changed(book_ids)
+            self.duplicates_index.books_changed(book_ids)
         else:
             self.format_metadata_cache.clear()
+            self.sort_indices.clear()
+            self.duplicates_index.clear()
         if search_cache:
             self._clear_search_caches(book_ids)
 
@@ -248,8 +380,30 @@ class Cache(object):
             self.backend.prefs.load_from_db()
             self._search_api.saved_searches.load_from_db()
             for field in self.fields.itervalues():
-                if hasattr(field, 'table'):
+                if hasattr(field, 'table') and field.table.is_loaded:
+                    field.table.read(self.backend)  # Reread data from metadata.db
+
+    @write_api
+    def reload_fields_from_db(self, fields, book_ids=None):
+        '''
+        Re-read the data of only the specified fields from the database, for
+        example, after another process has changed them, and clear the cached
+        data of the specified books (all books if None). Much cheaper than
+        :meth:`reload_from_db` when the changed fields are known. Fields that
+        are changed along with the specified fields, such as the sort of the
+        title, and the last modified time are re-read as well.
+        '''
+        names = {'last_modified'}
+        for name in fields:
+            names.add(name)
+            names.update(DEPENDENT_FIELDS.get(name, ()))
+        names |= {name + '_index' for name in names if name + '_index' in self.fields}
+        with self.backend.conn:  # Prevent other processes, such as calibredb from interrupting the reload by locking the db
+            for name in names:
+                field = self.fields.get(name)
+                if field is not None and hasattr(field, 'table') and field.table.is_loaded:
                     field.table.read(self.backend)  # Reread data from metadata.db
+        self._clear_caches(book_ids=book_ids or None, template_cache=False)
 
     @property
     def field_metadata(self):
@@ -350,12 +504,20 @@ class Cache(object):
     # }}}
 
     @api
-    def init(self):
+    def init(self, lazy_load_tables=None):
         '''
         Initialize this cache with data from the backend.
+
+        :param lazy_load_tables: If True, the data for each field is only read
+            from the database the first time it is used (by searching, sorting,
+            field_for, etc.), which makes startup much faster for very large
+            libraries. Defaults to the value of the ``newdb_lazy_load_tables``
+            tweak. See also :meth:`table_load_report`.
         '''
+        if lazy_load_tables is None:
+            lazy_load_tables = tweaks.get('newdb_lazy_load_tables', False)
         with self.write_lock:
-            self.backend.read_tables()
+            self.backend.read_tables(lazy=lazy_load_tables)
             bools_are_tristate = self.backend.prefs['bools_are_tristate']
 
             for field, table in self.backend.tables.iteritems():
@@ -385,6 +547,26 @@ class Cache(object):
 
     # Cache Layer API {{{
 
+    @read_api
+    def table_load_report(self):
+        '''
+        Return a mapping of field name to a dictionary with the keys:
+        ``loaded`` (True if the data for the field has been read from the
+        database), ``load_time`` (seconds spent reading it) and ``memory``
+        (approximate bytes used by the in-memory data). Useful to find out which
+        fields dominate startup time and memory usage. Calling this does not
+        cause lazily loaded fields to be read.
+        '''
+        load_times = self.backend.table_loader.load_times
+        ans = {}
+        for name, field in self.fields.iteritems():
+            table = getattr(field, 'table', None)
+            if table is None or name not in self.backend.tables:
+                continue
+            ans[name] = {'loaded': table.is_loaded, 'load_time': load_times.get(name, 0),
+                         'memory': table.memory_usage() if table.is_loaded else 0}
+        return ans
+
     @read_api
     def field_for(self, name, book_id, default_value=None):
         '''
@@ -553,13 +735,113 @@ class Cache(object):
     @read_api
     def format_hash(self, book_id, fmt):
         ''' Return the hash of the specified format for the specified book. The
-        kind of hash is backend dependent, but is usually SHA-256. '''
+        kind of hash is backend dependent, but is usually SHA-256. The hash is
+        stored in the database and the file is only read again if its size or
+        modification time have changed since the hash was computed. A newly
+        computed hash is stored later, by :meth:`store_pending_format_digests`. '''
+        fmt = (fmt or '').upper()
         try:
             name = self.fields['formats'].format_fname(book_id, fmt)
             path = self._field_for('path', book_id).replace('/', os.sep)
         except:
             raise NoSuchFormat('Record %d has no fmt: %s'%(book_id, fmt))
-        return self.backend.format_hash(book_id, fmt, name, path)
+        current = self.fields['formats'].table.digest_map.get(book_id, {}).get(fmt)
+        digest = self.backend.format_digest(book_id, fmt, name, path, current)
+        if digest is not current:
+            with self.pending_format_digests_lock:
+                old = self.pending_format_digests.get((book_id, fmt), (current,))[0]
+                self.pending_format_digests[(book_id, fmt)] = (old, digest)
+        return digest[0]
+
+    @write_api
+    def store_format_digests(self, updates):
+        ''' Store format hashes. updates is a map of (book_id, fmt) to
+        (old_digest, new_digest). Digests that were changed by somebody else
+        since old_digest was read are not stored. '''
+        table = self.fields['formats'].table
+        table.update_digests({k:digest for k, (old, digest) in updates.iteritems()
+                              if table.digest_map.get(k[0], {}).get(k[1]) == old}, self.backend)
+
+    @write_api
+    def store_pending_format_digests(self):
+        ''' Store the hashes computed by :meth:`format_hash`. Run periodically
+        by the metadata backup thread. Returns the number of hashes stored. '''
+        with self.pending_format_digests_lock:
+            updates, self.pending_format_digests = self.pending_format_digests, {}
+        if updates:
+            self._store_format_digests(updates)
+        return len(updates)
+
+    @api
+    def update_format_digests(self, book_ids=None, abort=None, notify=None, batch_size=100, hash_new=True):
+        '''
+        Compute and store the hash of every format of the specified books
+        (all books if None) whose hash is not stored or whose file has changed
+        since its hash was computed, see :meth:`format_hash`. Files are read
+        without holding the database lock, so this is meant to be run in a
+        background thread, the metadata backup thread runs it over the whole
+        library periodically. Returns the number of hashes that were computed.
+
+        :param abort: A threading.Event(), if set, the pass is stopped.
+        :param notify: A callable called with (number of formats checked, total number of formats)
+        :param batch_size: The number of hashes stored in the database at a time.
+        :param hash_new: If False, formats whose hash is not stored are skipped,
+            so that only files that changed since they were hashed are read.
+        '''
+        with self.safe_read_lock:
+            table = self.fields['formats'].table
+            if book_ids is None:
+                book_ids = self._all_book_ids()
+            todo = []
+            for book_id in book_ids:
+                try:
+                    path = self._field_for('path', book_id).replace('/', os.sep)
+                except:
+                    continue
+                digests = table.digest_map.get(book_id, {})
+                for fmt, name in table.fname_map.get(book_id, {}).iteritems():
+                    if name and path and (hash_new or fmt in digests):
+                        todo.append((book_id, fmt, name, path, digests.get(fmt)))
+
+        updates, count = {}, 0
+        for i, (book_id, fmt, name, path, current) in enumerate(todo):
+            if abort is not None and abort.is_set():
+                break
+            try:
+                digest = self.backend.format_digest(book_id, fmt, name, path, current)
+            except (NoSuchFormat, EnvironmentError):
+                digest = current
+            if digest is not current:
+                updates[(book_id, fmt)] = (current, digest)
+                if len(updates) >= batch_size:
+                    self.store_format_digests(updates)
+                    count, updates = count + len(updates), {}
+            if notify is not None:
+                notify(i + 1, len(todo))
+        if updates:
+            self.store_format_digests(updates)
+            count += len(updates)
+        return count
+
+    @read_api
+    def formats_changed_since(self, stamp, book_ids=None):
+        '''
+        Return a map of book id to the set of formats of that book whose
+        contents changed after stamp, a timestamp as returned by time.time().
+        A change is recorded when a format is added or replaced with different
+        contents, when metadata is embedded in it and when its hash is found to
+        be different from the stored hash, by :meth:`update_format_digests` or
+        by :meth:`format_hash`, once the hash is stored. So changes made to files
+        outside of calibre are seen only once the hash has been computed again.
+        Removed formats are not included.
+        '''
+        changed_map = self.fields['formats'].table.changed_map
+        ans = {}
+        for book_id in (changed_map if book_ids is None else book_ids):
+            fmts = {fmt for fmt, changed in changed_map.get(book_id, {}).iteritems() if changed > stamp}
+            if fmts:
+                ans[book_id] = fmts
+        return ans
 
     @api
     def format_metadata(self, book_id, fmt, allow_cache=True, update_db=False):
@@ -944,13 +1226,42 @@ class Cache(object):
                 return skf
             return func
 
+        def rank_map(field):
+            ''' Return the precomputed ranks of all books for field, or None if
+            the field cannot be indexed, for example, because its values depend on
+            other fields. '''
+            if field in virtual_fields:
+                return None
+            f = self.fields.get(fm.get(field, field))
+            if f is None or f.is_composite or not hasattr(f, 'table'):
+                return None
+            try:
+                si = self.sort_indices[field]
+            except KeyError:
+                si = self.sort_indices[field] = SortIndex()
+            return si.ranks_for(all_book_ids, partial(sort_key_func, field))
+
         # Sort only once on any given field
         fields = uniq(fields, operator.itemgetter(0))
+        all_book_ids = self._all_book_ids()
+        if all_book_ids.issuperset(ids_to_sort):
+            rank_maps = tuple(rank_map(field) for field, order in fields)
+        else:
+            # Some of the books are not in the library, use sort keys
+            rank_maps = (None,) * len(fields)
+        if all(rm is not None for rm in rank_maps):
+            if len(fields) == 1:
+                return sorted(ids_to_sort, key=rank_maps[0].__getitem__, reverse=not fields[0][1])
+            orders = tuple(zip(rank_maps, (1 if order else -1 for _, order in fields)))
+            if len(orders) == 2:
+                (r1, o1), (r2, o2) = orders
+                return sorted(ids_to_sort, key=lambda book_id: (o1 * r1[book_id], o2 * r2[book_id]))
+            return sorted(ids_to_sort, key=lambda book_id: tuple(o * r[book_id] for r, o in orders))
 
         if len(fields) == 1:
             return sorted(ids_to_sort, key=sort_key_func(fields[0][0]),
                           reverse=not fields[0][1])
-        sort_key_funcs = tuple(sort_key_func(field) for field, order in fields)
+        sort_key_funcs = tuple(sort_key_func(field) if rm is None else rm.__getitem__ for rm, (field, order) in zip(rank_maps, fields))
         orders = tuple(1 if order else -1 for _, order in fields)
         Lazy = object()  # Lazy load the sort keys for sub-sort fields
 
@@ -991,6 +1302,37 @@ class Cache(object):
         '''
         return self._search_api(self, query, restriction, virtual_fields=virtual_fields, book_ids=book_ids)
 
+    @read_api
+    def explain_search(self, query, restriction='', virtual_fields=None, book_ids=None):
+        '''
+        Run the specified search, without using cached results, and return a
+        textual description of how it was evaluated: the query tree in the
+        order in which its terms were evaluated, with the estimated cost,
+        number of candidates, number of matches and time taken for every term.
+        Useful to find out why a search is slow. The parameters are the same as
+        for :meth:`search`.
+        '''
+        return self._search_api.explain(self, query, restriction, virtual_fields=virtual_fields, book_ids=book_ids)
+
+    @read_api
+    def warm_search_cache(self):
+        '''
+        Run the searches for all virtual libraries and saved searches, so that
+        their results are in the search cache when they are first used. Returns
+        the number of searches run.
+        '''
+        queries = list(self._pref('virtual_libraries', {}).itervalues())
+        queries.extend('search:"%s"' % name.replace('"', '\\"') for name in self._search_api.saved_searches.names())
+        count = 0
+        for query in queries:
+            try:
+                self._search(query)
+            except Exception:
+                # Broken saved searches/virtual libraries are reported when they are used
+                continue
+            count += 1
+        return count
+
     @read_api
     def books_in_virtual_library(self, vl, search_restriction=None):
         ' Return the set of books in the specified virtual library '
@@ -1021,19 +1363,29 @@ class Cache(object):
             return self.get_categories(sort=sort, book_ids=book_ids, already_fixed=bad_field)
 
     @write_api
-    def update_last_modified(self, book_ids, now=None):
+    def update_last_modified(self, book_ids, now=None, fields=None):
         if book_ids:
             if now is None:
                 now = nowf()
             f = self.fields['last_modified']
             f.writer.set_books({book_id:now for book_id in book_ids}, self.backend)
             if self.composites:
-                self._clear_composite_caches(book_ids)
-            self._clear_search_caches(book_ids)
+                self._clear_composite_caches(book_ids, fields)
+            self._clear_search_caches(book_ids, fields)
+            for si in self.sort_indices.itervalues():
+                si.books_changed(book_ids)
 
     @write_api
-    def mark_as_dirty(self, book_ids):
-        self._update_last_modified(book_ids)
+    def mark_as_dirty(self, book_ids, fields=None):
+        if self.bulk_edits is not None:
+            # Inside bulk_edit(), defer until the edit is finished
+            self.bulk_edits['book_ids'].update(book_ids)
+            if fields is None:
+                self.bulk_edits['fields'] = None
+            elif self.bulk_edits['fields'] is not None:
+                self.bulk_edits['fields'].update(fields)
+            return
+        self._update_last_modified(book_ids, fields=fields)
         already_dirtied = set(self.dirtied_cache).intersection(book_ids)
         new_dirtied = book_ids - already_dirtied
         already_dirtied = {book_id:self.dirtied_sequence+i for i, book_id in enumerate(already_dirtied)}
@@ -1091,19 +1443,70 @@ class Cache(object):
         dirtied = f.writer.set_books(
             book_id_to_val_map, self.backend, allow_case_change=allow_case_change)
 
+        changed_fields = {f.name}
         if is_series and simap:
             sf = self.fields[f.name+'_index']
             dirtied |= sf.writer.set_books(simap, self.backend, allow_case_change=False)
+            changed_fields.add(sf.name)
 
         if dirtied and update_path and do_path_update:
             self._update_path(dirtied, mark_as_dirtied=False)
 
-        self._mark_as_dirty(dirtied)
+        self._mark_as_dirty(dirtied, fields=changed_fields)
 
         return dirtied
 
+    @contextmanager
+    def bulk_edit(self):
+        '''
+        Context manager to efficiently make many changes to the database, for
+        example with many calls to :meth:`set_field`. All changes are made in a
+        single transaction, and the affected books are marked as dirtied,
+        have their last modified time updated and have their cached search,
+        sort and composite column values invalidated only once, when the
+        block exits. If an exception is raised inside the block, all changes
+        are rolled back. Moving the files of books whose title or authors are
+        changed cannot be rolled back, so it is done only after all changes
+        have been committed. The write lock is held for the duration of the block,
+        so keep it short. Searches and sorts inside the block may not reflect
+        changes made in it. Usage::
+
+            with cache.bulk_edit():
+                cache.set_field('tags', {book_id: tags for book_id in book_ids})
+                cache.set_field('rating', {book_id: 4 for book_id in book_ids})
+        '''
+        with self.write_lock:
+            if self.bulk_edits is not None:
+                # Nested bulk edit, the outermost one does the work
+                yield
+                return
+            self.bulk_edits = edits = {'book_ids': set(), 'fields': set(), 'update_path': set()}
+            try:
+                with self.backend.conn:
+                    try:
+                        yield
+                    finally:
+                        self.bulk_edits = None
+                    if edits['book_ids']:
+                        self._mark_as_dirty(edits['book_ids'], fields=edits['fields'])
+            except:
+                # The transaction has been rolled back, so discard the
+                # changes made to the in-memory tables as well
+                self._reload_from_db()
+                raise
+            if edits['update_path']:
+                self._update_path(edits['update_path'], mark_as_dirtied=False)
+
     @write_api
     def update_path(self, book_ids, mark_as_dirtied=True):
+        if self.bulk_edits is not None:
+            # Inside bulk_edit(), defer moving the files of books that have
+            # them, as that cannot be rolled back
+            deferred = {book_id for book_id in book_ids if self._field_for('path', book_id)}
+            self.bulk_edits['update_path'] |= deferred
+            if mark_as_dirtied and deferred:
+                self._mark_as_dirty(deferred)
+            book_ids = [book_id for book_id in book_ids if book_id not in deferred]
         for book_id in book_ids:
             title = self._field_for('title', book_id, default_value=_('Unknown'))
             try:
@@ -1143,6 +1546,75 @@ class Cache(object):
                 pass
         return mi, sequence
 
+    @read_api
+    def get_dirtied_books(self, limit=None, exclude=()):
+        ''' Return the ids of books whose metadata backups are out of date,
+        least recently changed first, at most limit of them. '''
+        dc = self.dirtied_cache
+        book_ids = (book_id for book_id in dc if book_id not in exclude) if exclude else dc
+        if limit is None:
+            return sorted(book_ids, key=dc.__getitem__)
+        return heapq.nsmallest(limit, book_ids, key=dc.__getitem__)
+
+    @read_api
+    def get_metadata_for_dump_batch(self, book_ids):
+        ''' Return (book_id, mi, sequence) for every book in book_ids, see
+        :meth:`get_metadata_for_dump`. '''
+        return [(book_id,) + self._get_metadata_for_dump(book_id) for book_id in book_ids]
+
+    @read_api
+    def write_backups(self, book_id_raw_map, pool=None):
+        '''
+        Write the OPF metadata backups for many books. If pool (a
+        multiprocessing ThreadPool) is not None, several files are written at
+        a time. The read lock prevents the books being moved while the files
+        are being written. Returns a mapping of book ids to tracebacks, for the
+        books whose backups could not be written.
+        '''
+        jobs = []
+        for book_id, raw in book_id_raw_map.iteritems():
+            path = self._field_for('path', book_id)
+            if path:
+                jobs.append((book_id, path.replace('/', os.sep), raw))
+
+        def write(job):
+            book_id, path, raw = job
+            try:
+                self.backend.write_backup(path, raw)
+            except Exception:
+                return book_id, traceback.format_exc()
+            return book_id, None
+
+        results = map(write, jobs) if pool is None or len(jobs) < 2 else pool.imap_unordered(write, jobs)
+        return {book_id: tb for book_id, tb in results if tb is not None}
+
+    @write_api
+    def clear_dirtied_batch(self, book_id_sequence_map):
+        ''' Clear the dirtied indicator for many books at once, see :meth:`clear_dirtied`. '''
+        dc = self.dirtied_cache
+        book_ids = []
+        for book_id, sequence in book_id_sequence_map.iteritems():
+            dc_sequence = dc.get(book_id, None)
+            if dc_sequence is None or sequence is None or dc_sequence == sequence:
+                book_ids.append(book_id)
+        if book_ids:
+            self.backend.executemany('DELETE FROM metadata_dirtied WHERE book=?', ((x,) for x in book_ids))
+            for book_id in book_ids:
+                dc.pop(book_id, None)
+
+    @read_api
+    def backup_status(self):
+        '''
+        Return the state of the metadata backups as a dictionary: the number of
+        books waiting to be backed up (queue_length), and the number of
+        backups written and failed, batches processed and books backed up per
+        second overall and for the most recent batch, since the library was
+        opened.
+        '''
+        ans = self.backup_stats.as_dict()
+        ans['queue_length'] = len(self.dirtied_cache)
+        return ans
+
     @write_api
     def clear_dirtied(self, book_id, sequence):
         # Clear the dirtied indicator for the books. This is used when fetching
@@ -1194,25 +1666,41 @@ class Cache(object):
         if callback is not None:
             callback(len(book_ids), True, False)
 
-        for book_id in book_ids:
-            if self._field_for('path', book_id) is None:
-                if callback is not None:
-                    callback(book_id, None, False)
-                continue
-            mi, sequence = self._get_metadata_for_dump(book_id)
-            if mi is None:
-                if callback is not None:
-                    callback(book_id, mi, False)
-                continue
-            try:
-                raw = metadata_to_opf(mi)
-                self._write_backup(book_id, raw)
+        # Process the books in batches, writing several files at a time and
+        # clearing the dirtied flags of a batch in a single transaction
+        book_ids = tuple(book_ids)
+        batch_size = 100
+        pool = create_write_pool() if len(book_ids) > batch_size else None
+        try:
+            for i in xrange(0, len(book_ids), batch_size):
+                st = time()
+                batch, raw_map, sequences = [], {}, {}
+                for book_id in book_ids[i:i+batch_size]:
+                    if self._field_for('path', book_id) is None:
+                        if callback is not None:
+                            callback(book_id, None, False)
+                        continue
+                    mi, sequence = self._get_metadata_for_dump(book_id)
+                    if mi is None:
+                        if callback is not None:
+                            callback(book_id, mi, False)
+                        continue
+                    batch.append((book_id, mi))
+                    try:
+                        raw_map[book_id] = metadata_to_opf(mi)
+                        sequences[book_id] = sequence
+                    except:
+                        pass
+                failures = self._write_backups(raw_map, pool=pool)
                 if remove_from_dirtied:
-                    self._clear_dirtied(book_id, sequence)
-            except:
-                pass
-            if callback is not None:
-                callback(book_id, mi, True)
+                    self._clear_dirtied_batch({k:v for k, v in sequences.iteritems() if k not in failures})
+                self.backup_stats.record(len(raw_map) - len(failures), len(failures), time() - st)
+                if callback is not None:
+                    for book_id, mi in batch:
+                        callback(book_id, mi, True)
+        finally:
+            if pool is not None:
+                pool.terminate()
 
     @write_api
     def set_cover(self, book_id_data_map):
@@ -1243,6 +1731,20 @@ class Cache(object):
     def remove_cover_cache(self, cover_cache):
         self.cover_caches.discard(cover_cache)
 
+    @write_api
+    def add_metadata_cache(self, metadata_cache):
+        ''' Add a cache of data derived from the metadata of books, such as
+        rendered metadata. Its invalidate(book_ids) method is called whenever
+        books are changed, with book_ids=None when all books may have
+        changed. '''
+        if not callable(metadata_cache.invalidate):
+            raise ValueError('Metadata caches must have an invalidate method')
+        self.metadata_caches.add(metadata_cache)
+
+    @write_api
+    def remove_metadata_cache(self, metadata_cache):
+        self.metadata_caches.discard(metadata_cache)
+
     @write_api
     def set_metadata(self, book_id, mi, ignore_errors=False, force_changes=False,
                      set_title=True, set_authors=True, allow_case_change=False):
@@ -1375,8 +1877,7 @@ class Cache(object):
         except IndexError:
             author = _('Unknown')
 
-        size, fname = self.backend.add_format(book_id, fmt, stream, title, author, path, name, mtime=mtime)
-        return size, fname
+        return self.backend.add_format(book_id, fmt, stream, title, author, path, name, mtime=mtime)
 
     @api
     def add_format(self, book_id, fmt, stream_or_path, replace=True, run_hooks=True, dbapi=None):
@@ -1408,10 +1909,10 @@ class Cache(object):
                 return False
 
             stream = stream_or_path if hasattr(stream_or_path, 'read') else lopen(stream_or_path, 'rb')
-            size, fname = self._do_add_format(book_id, fmt, stream, name)
+            size, fname, digest = self._do_add_format(book_id, fmt, stream, name)
             del stream
 
-            max_size = self.fields['formats'].table.update_fmt(book_id, fmt, fname, size, self.backend)
+            max_size = self.fields['formats'].table.update_fmt(book_id, fmt, fname, size, self.backend, digest=digest)
             self.fields['size'].table.update_sizes({book_id: max_size})
             self._update_last_modified((book_id,))
 
@@ -1516,10 +2017,8 @@ class Cache(object):
         if title:
             if isbytestring(title):
                 title = title.decode(preferred_encoding, 'replace')
-            q = icu_lower(title).strip()
-            for title in self.fields['title'].table.book_col_map.itervalues():
-                if q == icu_lower(title):
-                    return True
+            with self.duplicates_index.lock:
+                return self._updated_duplicates_index().has_title(title)
         return False
 
     @read_api
@@ -1576,6 +2075,8 @@ class Cache(object):
                 self.fields[field].table.uuid_to_id_map[val] = book_id
             self.fields[field].table.book_col_map[book_id] = val
 
+        # Make the new book visible to has_book() even inside bulk_edit()
+        self.duplicates_index.books_changed((book_id,))
         return book_id
 
     @api
@@ -1868,6 +2369,7 @@ class Cache(object):
     @write_api
     def set_sort_for_authors(self, author_id_to_sort_map, update_books=True):
         sort_map = self.fields['authors'].table.set_sort_names(author_id_to_sort_map, self.backend)
+        self.category_cache.clear(('authors',))
         changed_books = set()
         if update_books:
             val_map = {}
@@ -1926,70 +2428,52 @@ class Cache(object):
             return f.get_books_for_val(item_id_or_composite_value, self._get_proxy_metadata, self._all_book_ids())
         return self._books_for_field(f.name, int(item_id_or_composite_value))
 
+    def _duplicates_index_entry(self, book_id):
+        return (as_unicode(self._field_for('title', book_id) or ''), self._field_for('authors', book_id),
+                self._field_for('languages', book_id))
+
+    @read_api
+    def updated_duplicates_index(self):
+        ' Used internally, return the duplicates index, brought up to date with the library '
+        return self.duplicates_index.update(self._all_book_ids(), self._duplicates_index_entry)
+
     @read_api
     def data_for_find_identical_books(self):
         ''' Return data that can be used to implement
         :meth:`find_identical_books` in a worker process without access to the
         db. See db.utils for an implementation. '''
-        at = self.fields['authors'].table
-        author_map = defaultdict(set)
-        for aid, author in at.id_map.iteritems():
-            author_map[icu_lower(author)].add(aid)
-        return (author_map, at.col_book_map.copy(), self.fields['title'].table.book_col_map.copy(), self.fields['languages'].book_value_map.copy())
+        with self.duplicates_index.lock:
+            return self._updated_duplicates_index().copy()
 
     @read_api
     def update_data_for_find_identical_books(self, book_id, data):
-        author_map, author_book_map, title_map, lang_map = data
-        title_map[book_id] = self._field_for('title', book_id)
-        lang_map[book_id] = self._field_for('languages', book_id)
-        at = self.fields['authors'].table
-        for aid in at.book_col_map.get(book_id, ()):
-            author_map[icu_lower(at.id_map[aid])].add(aid)
-            try:
-                author_book_map[aid].add(book_id)
-            except KeyError:
-                author_book_map[aid] = {book_id}
+        data.add(book_id, *self._duplicates_index_entry(book_id))
 
     @read_api
     def find_identical_books(self, mi, search_restriction='', book_ids=None):
         ''' Finds books that have a superset of the authors in mi and the same
         title (title is fuzzy matched). See also :meth:`data_for_find_identical_books`. '''
-        from calibre.db.utils import fuzzy_title
-        identical_book_ids = set()
-        langq = tuple(filter(lambda x: x and x != 'und', map(canonicalize_lang, mi.languages or ())))
-        if mi.authors:
-            try:
-                quathors = mi.authors[:20]  # Too many authors causes parsing of the search expression to fail
-                query = ' and '.join('authors:"=%s"'%(a.replace('"', '')) for a in quathors)
-                qauthors = mi.authors[20:]
-            except ValueError:
-                return identical_book_ids
+        with self.duplicates_index.lock:
+            identical_book_ids = self._updated_duplicates_index().find(mi)
+        if identical_book_ids and book_ids is not None:
+            identical_book_ids &= set(book_ids)
+        if identical_book_ids and search_restriction:
             try:
-                book_ids = self._search(query, restriction=search_restriction, book_ids=book_ids)
+                identical_book_ids &= self._search('', restriction=search_restriction, book_ids=identical_book_ids)
             except:
                 traceback.print_exc()
-                return identical_book_ids
-            if qauthors and book_ids:
-                matches = set()
-                qauthors = {icu_lower(x) for x in qauthors}
-                for book_id in book_ids:
-                    aut = self._field_for('authors', book_id)
-                    if aut:
-                        aut = {icu_lower(x) for x in aut}
-                        if aut.issuperset(qauthors):
-                            matches.add(book_id)
-                book_ids = matches
-
-            for book_id in book_ids:
-                fbook_title = self._field_for('title', book_id)
-                fbook_title = fuzzy_title(fbook_title)
-                mbook_title = fuzzy_title(mi.title)
-                if fbook_title == mbook_title:
-                    bl = self._field_for('languages', book_id)
-                    if not langq or not bl or bl == langq:
-                        identical_book_ids.add(book_id)
+                return set()
         return identical_book_ids
 
+    @read_api
+    def find_duplicate_books(self):
+        ''' Return a list of sets of book ids, each set containing books that
+        are duplicates of each other: books with the same title (fuzzy matched),
+        the same authors and compatible languages. See also
+        :meth:`find_identical_books`. '''
+        with self.duplicates_index.lock:
+            return self._updated_duplicates_index().duplicate_groups()
+
     @read_api
     def get_top_level_move_items(self):
         all_paths = {self._field_for('path', book_id).partition('/')[0] for book_id in self._all_book_ids()}
@@ -2157,7 +2641,12 @@ class Cache(object):
                     if new_size is not None:
                         self.format_metadata_cache[book_id].get(fmt, {})['size'] = new_size
                         max_size = self.fields['formats'].table.update_fmt(book_id, fmt, name, new_size, self.backend)
+                        self.fields['formats'].table.update_digests({(book_id, fmt):None}, self.backend)
                         self.fields['size'].table.update_sizes({book_id: max_size})
+                        for si in self.sort_indices.itervalues():
+                            si.books_changed((book_id,))
+                        for mc in self.metadata_caches:
+                            mc.invalidate((book_id,))
             if report_progress is not None:
                 report_progress(i+1, len(book_ids), mi)
 
@@ -2254,8 +2743,8 @@ def import_library(library_key, importer, library_path, progress=None, abort=Non
                 cache.backend.set_cover(book_id, path, stream, no_processing=True)
             else:
                 stream = importer.start_file(fmtkey, _('{0} format for {1}').format(fmt.upper(), title))
-                size, fname = cache._do_add_format(book_id, fmt, stream, mtime=stream.mtime)
-                cache.fields['formats'].table.update_fmt(book_id, fmt, fname, size, cache.backend)
+                size, fname, digest = cache._do_add_format(book_id, fmt, stream, mtime=stream.mtime)
+                cache.fields['formats'].table.update_fmt(book_id, fmt, fname, size, cache.backend, digest=digest)
             stream.close()
         cache.dump_metadata({book_id})
     if progress is not None:
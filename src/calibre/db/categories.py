@@ -126,6 +126,124 @@ category_sort_keys[False]['name'] = \
     lambda x:sort_key(x.sort or x.name)
 
 
+class CachedCategory(object):
+
+    '''
+    The items in a single category for all books in the library, stored as
+    (name, id, sort, avg, id_set) tuples. The items for any subset of the
+    books, such as a virtual library, are derived from these by intersecting
+    the id sets, without re-computing names, sort values or sort keys.
+    '''
+
+    __slots__ = ('items', 'dependencies', 'has_avg', 'sort_depends_on_books', 'base_keys', 'letter_keys')
+
+    def __init__(self, items, dependencies, has_avg, sort_depends_on_books):
+        self.items, self.dependencies = items, dependencies
+        self.has_avg, self.sort_depends_on_books = has_avg, sort_depends_on_books
+        self.base_keys = self.letter_keys = None
+
+    def project(self, tag_class, book_ids, book_rating_map, lang_map, field):
+        ans = []
+        has_avg = self.has_avg
+        sort_depends_on_books = self.sort_depends_on_books and book_ids is not None
+        for i, (name, item_id, sval, avg, id_set) in enumerate(self.items):
+            if book_ids is not None:
+                id_set = id_set.intersection(book_ids)
+                if not id_set:
+                    continue
+                if has_avg:
+                    ratings = tuple(r for r in (book_rating_map.get(book_id, 0) for
+                                                book_id in id_set) if r > 0)
+                    avg = sum(ratings)/len(ratings) if ratings else 0
+                if sort_depends_on_books:
+                    sval = field.category_sort_value(item_id, id_set, lang_map)
+            ans.append((i, tag_class(name, id=item_id, sort=sval, avg=avg, id_set=id_set, count=len(id_set))))
+        return ans
+
+    def sort(self, items, sort_on, first_letter_sort, reverse):
+        # Sort the (index, tag) pairs returned by project(), using the cached
+        # sort keys, equivalent to sorting with category_sort_keys
+        if self.base_keys is None:
+            self.base_keys = [sort_key(sval or name) for name, item_id, sval, avg, id_set in self.items]
+        base = self.base_keys
+        if sort_on == 'name':
+            if first_letter_sort:
+                if self.letter_keys is None:
+                    self.letter_keys = [collation_order(icu_upper(sval or name or ' ')) for name, item_id, sval, avg, id_set in self.items]
+                letters = self.letter_keys
+
+                def key(x):
+                    return letters[x[0]], base[x[0]]
+            else:
+                def key(x):
+                    return base[x[0]]
+        elif sort_on == 'popularity':
+            def key(x):
+                return -x[1].count, base[x[0]]
+        else:
+            def key(x):
+                return -x[1].avg_rating, base[x[0]]
+        items.sort(key=key, reverse=reverse)
+        return [t for i, t in items]
+
+
+class CategoryCache(object):
+
+    '''
+    Cache of the tag browser categories for all books in the library. A
+    category is re-computed only after one of the fields it depends on has
+    changed.
+    '''
+
+    def __init__(self):
+        self.categories = {}
+
+    def get(self, category):
+        return self.categories.get(category)
+
+    def set(self, category, val):
+        self.categories[category] = val
+
+    def clear(self, fields=None):
+        if fields is None:
+            self.categories.clear()
+            return
+        for category, cc in tuple(self.categories.iteritems()):
+            if cc.dependencies is None or not cc.dependencies.isdisjoint(fields):
+                del self.categories[category]
+
+
+def compute_category(dbcache, category, cat, is_multiple, is_composite, tag_class, book_rating_map, lang_map):
+    ''' Compute the items in the specified category for all books in the library '''
+    has_avg, sort_depends_on_books = True, False
+    # Average ratings are computed from the rating field, except for rating
+    # columns, which use their own values
+    dependencies = {category} if cat['datatype'] == 'rating' else {category, 'rating'}
+    if is_composite:
+        cats = dbcache.fields[category].get_composite_categories(
+            tag_class, book_rating_map, dbcache._all_book_ids(), is_multiple, dbcache._get_proxy_metadata)
+        deps = dbcache._composite_fields(category)
+        dependencies = None if deps is None else dependencies | deps
+    elif category == 'news':
+        cats = dbcache.fields['tags'].get_news_category(tag_class)
+        has_avg, dependencies = False, {'tags'}
+    else:
+        dt = cat['datatype']
+        field = dbcache.fields[category]
+        cats = field.get_categories(tag_class, book_rating_map, lang_map)
+        if category in {'formats', 'identifiers'}:
+            has_avg = False
+        elif dt == 'series':
+            sort_depends_on_books = tweaks['title_series_sorting'] != 'strictly_alphabetic'
+            dependencies.add('languages')
+        if (category != 'authors' and dt == 'text' and
+            cat['is_multiple'] and cat['display'].get('is_names', False)):
+            for item in cats:
+                item.sort = author_to_author_sort(item.sort)
+    items = tuple((t.name, t.id, t.sort, t.avg_rating * 2, t.id_set) for t in cats)
+    return CachedCategory(items, None if dependencies is None else frozenset(dependencies), has_avg, sort_depends_on_books)
+
+
 def get_categories(dbcache, sort='name', book_ids=None, first_letter_sort=False):
     if sort not in CATEGORY_SORTS:
         raise ValueError('sort ' + sort + ' not a valid value')
@@ -136,43 +254,29 @@ def get_categories(dbcache, sort='name', book_ids=None, first_letter_sort=False)
 
     categories = {}
     book_ids = frozenset(book_ids) if book_ids else book_ids
-    pm_cache = {}
-
-    def get_metadata(book_id):
-        ans = pm_cache.get(book_id)
-        if ans is None:
-            ans = pm_cache[book_id] = dbcache._get_proxy_metadata(book_id)
-        return ans
-
-    bids = None
     first_letter_sort = bool(first_letter_sort)
+    category_cache = dbcache.category_cache
 
     for category, is_multiple, is_composite in find_categories(fm):
         tag_class = create_tag_class(category, fm)
+        cat = fm[category]
         sort_on, reverse = sort, False
-        if is_composite:
-            if bids is None:
-                bids = dbcache._all_book_ids() if book_ids is None else book_ids
-            cats = dbcache.fields[category].get_composite_categories(
-                tag_class, book_rating_map, bids, is_multiple, get_metadata)
-        elif category == 'news':
-            cats = dbcache.fields['tags'].get_news_category(tag_class, book_ids)
+        brm = book_rating_map
+        if not is_composite and cat['datatype'] == 'rating':
+            if category != 'rating':
+                brm = dbcache.fields[category].book_value_map
+            if sort_on == 'name':
+                sort_on, reverse = 'rating', True
+        cc = category_cache.get(category)
+        if cc is None:
+            cc = compute_category(dbcache, category, cat, is_multiple, is_composite, tag_class, brm, lang_map)
+            category_cache.set(category, cc)
+        cats = cc.project(tag_class, book_ids, brm, lang_map, dbcache.fields.get(category))
+        if cc.sort_depends_on_books and book_ids is not None:
+            cats = [t for i, t in cats]
+            cats.sort(key=category_sort_keys[first_letter_sort][sort_on], reverse=reverse)
         else:
-            cat = fm[category]
-            brm = book_rating_map
-            dt = cat['datatype']
-            if dt == 'rating':
-                if category != 'rating':
-                    brm = dbcache.fields[category].book_value_map
-                if sort_on == 'name':
-                    sort_on, reverse = 'rating', True
-            cats = dbcache.fields[category].get_categories(
-                tag_class, brm, lang_map, book_ids)
-            if (category != 'authors' and dt == 'text' and
-                cat['is_multiple'] and cat['display'].get('is_names', False)):
-                for item in cats:
-                    item.sort = author_to_author_sort(item.sort)
-        cats.sort(key=category_sort_keys[first_letter_sort][sort_on], reverse=reverse)
+            cats = cc.sort(cats, sort_on, first_letter_sort, reverse)
         categories[category] = cats
 
     # Needed for legacy databases that have multiple ratings that
@@ -180,7 +284,7 @@ def get_categories(dbcache, sort='name', book_ids=None, first_letter_sort=False)
     for r in categories['rating']:
         for x in tuple(categories['rating']):
             if r.name == x.name and r.id != x.id:
-                r.id_set |= x.id_set
+                r.id_set = r.id_set | x.id_set
                 r.count = len(r.id_set)
                 categories['rating'].remove(x)
                 break
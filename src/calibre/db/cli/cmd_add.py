@@ -10,7 +10,9 @@ from io import BytesIO
 from optparse import OptionGroup, OptionValueError
 
 from calibre import prints
-from calibre.db.adding import compile_rule, recursive_import, import_book_directory, import_book_directory_multiple
+from calibre.db.adding import (
+    ImportStats, compile_rule, import_book_directory, import_book_directory_multiple, recursive_import
+)
 from calibre.ebooks.metadata import MetaInformation, string_to_authors
 from calibre.ebooks.metadata.book.serialize import read_cover
 from calibre.ebooks.metadata.meta import get_metadata
@@ -18,7 +20,7 @@ from calibre.srv.changes import books_added
 from calibre.utils.localization import canonicalize_lang
 
 readonly = False
-version = 0  # change this if you change signature of implementation()
+version = 1  # change this if you change signature of implementation()
 
 
 def to_stream(data):
@@ -59,6 +61,10 @@ def add_books(db, notify_changes, is_remote, args):
     return ids, [(mi.title, [getattr(x, 'name', '<stream>') for x in format_map.itervalues()]) for mi, format_map in duplicates]
 
 
+def data_for_has_book(db, notify_changes, is_remote, args):
+    return db.data_for_has_book()
+
+
 def implementation(db, notify_changes, action, *args):
     is_remote = notify_changes is not None
     func = globals()[action]
@@ -67,8 +73,8 @@ def implementation(db, notify_changes, action, *args):
 
 class DBProxy(object):
     # Allows dbctx to be used with the directory adding API that expects a
-    # normal db object. Fortunately that API only calls one method,
-    # add_books()
+    # normal db object. Fortunately that API only calls two methods,
+    # add_books() and data_for_has_book()
 
     def __init__(self, dbctx):
         self.new_api = self
@@ -78,6 +84,9 @@ class DBProxy(object):
         books = [(read_cover(mi), {k:self.dbctx.path(v) for k, v in fmt_map.iteritems()}) for mi, fmt_map in books]
         return self.dbctx.run('add', 'add_books', books, kwargs)
 
+    def data_for_has_book(self):
+        return self.dbctx.run('add', 'data_for_has_book')
+
 
 def do_add_empty(
     dbctx, title, authors, isbn, tags, series, series_index, cover, identifiers,
@@ -157,6 +166,7 @@ def do_add(
 
         dir_dups = []
         dbproxy = DBProxy(dbctx)
+        stats = ImportStats()
 
         for dpath in dirs:
             if recurse:
@@ -166,7 +176,8 @@ def do_add(
                     single_book_per_directory=one_book_per_directory,
                     added_ids=added_ids,
                     compiled_rules=compiled_rules,
-                    add_duplicates=add_duplicates
+                    add_duplicates=add_duplicates,
+                    stats=stats
                 ) or []
             else:
                 func = import_book_directory if one_book_per_directory else import_book_directory_multiple
@@ -180,6 +191,8 @@ def do_add(
             dir_dups.extend(dups)
 
         sys.stdout = sys.__stdout__
+        if recurse and dirs:
+            prints(stats.summary())
 
         if dir_dups or file_duplicates:
             prints(
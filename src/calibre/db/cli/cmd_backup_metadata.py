@@ -66,4 +66,8 @@ def main(opts, args, dbctx):
     if opts.all:
         book_ids = db.all_ids()
     db.dump_metadata(book_ids=book_ids, callback=BackupProgress())
+    status = db.new_api.backup_status()
+    prints(
+        _('Wrote {0} OPF files at {1:.1f} books/second, {2} failed, {3} books still waiting to be backed up').format(
+            status['written'], status['books_per_second'], status['failed'], status['queue_length']))
     return 0
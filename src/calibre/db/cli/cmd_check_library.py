@@ -9,7 +9,7 @@ import sys
 
 from calibre import prints
 from calibre.db.legacy import LibraryDatabase
-from calibre.library.check_library import CHECKS, CheckLibrary
+from calibre.library.check_library import CHECKS, CheckLibrary, default_state_path
 
 readonly = False
 version = 0  # change this if you change signature of implementation()
@@ -61,6 +61,16 @@ Perform some checks on the filesystem representing a library. Reports are {0}
         help=_("Comma-separated list of names to ignore.\n"
                "Default: all")
     )
+
+    parser.add_option(
+        '-i',
+        '--incremental',
+        default=False,
+        action='store_true',
+        help=_('Remember the contents of the folders of the library and only'
+               ' look again at the folders that were modified since the last'
+               ' incremental check. Much faster on slow or network filesystems.')
+    )
     return parser
 
 
@@ -115,7 +125,7 @@ def main(opts, args, dbctx):
     prints(_('Vacuuming database...'))
     db.new_api.vacuum()
     checker = CheckLibrary(dbctx.library_path, db)
-    checker.scan_library(names, exts)
+    checker.scan_library(names, exts, state_path=default_state_path(dbctx.library_path) if opts.incremental else None)
     for check in checks:
         _print_check_library_results(checker, check, as_csv=opts.csv)
 
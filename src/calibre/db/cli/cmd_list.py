@@ -57,13 +57,26 @@ def implementation(
             book_ids = db.multisort([(sort_by, ascending)])
         if limit > -1:
             book_ids = book_ids[:limit]
-        data = {}
-        metadata = {}
+        # Locally, formats and cover are read from the library, not the snapshot
+        snapshot = db.snapshot({'identifiers' if f == 'isbn' else f.replace('*', '#') for f in fields
+                                if is_remote or f not in ('formats', 'cover')})
+
+    def all_field_for(field, book_ids, default_value=None):
+        # Composite columns are not available in snapshots
+        if field in snapshot.field_names:
+            return snapshot.all_field_for(field, book_ids, default_value=default_value)
+        return db.all_field_for(field, book_ids, default_value=default_value)
+
+    # Read the data from a snapshot, so that listing a large library does not
+    # block changes to it, while still giving a consistent view of it
+    data = {}
+    metadata = {}
+    with snapshot:
         for field in fields:
             if field in 'id':
                 continue
             if field == 'isbn':
-                x = db.all_field_for('identifiers', book_ids, default_value={})
+                x = all_field_for('identifiers', book_ids, default_value={})
                 data[field] = {k: v.get('isbn') or '' for k, v in x.iteritems()}
                 continue
             field = field.replace('*', '#')
@@ -75,7 +88,7 @@ def implementation(
                 if field == 'cover':
                     data[field] = {k: cover(db, k) for k in book_ids}
                     continue
-            data[field] = db.all_field_for(field, book_ids)
+            data[field] = all_field_for(field, book_ids)
     return {'book_ids': book_ids, "data": data, 'metadata': metadata, 'fields':fields}
 
 
@@ -4,8 +4,11 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import time
+from datetime import timedelta
+
 from calibre import prints
-from calibre.db.restore import Restore
+from calibre.db.restore import Restore, default_checkpoint_dir
 
 readonly = False
 version = 0  # change this if you change signature of implementation()
@@ -30,6 +33,8 @@ WARNING: This command completely regenerates your database. You will lose
 all saved searches, user categories, plugboards, stored per-book conversion
 settings, and custom recipes. Restored metadata will only be as accurate as
 what is found in the OPF files.
+
+If the restore is interrupted, running this command again resumes it.
     '''
         )
     )
@@ -51,12 +56,19 @@ class Progress(object):
 
     def __init__(self):
         self.total = 1
+        self.start_time = time.time()
 
     def __call__(self, msg, step):
         if msg is None:
             self.total = float(step)
+            self.start_time = time.time()
         else:
-            prints(msg, '...', '%d%%' % int(100 * (step / self.total)))
+            rate = step / max(0.001, time.time() - self.start_time)
+            if step > 0 and self.total > 1:
+                eta = timedelta(seconds=int((self.total - step) / rate))
+                prints(msg, '...', '%d%%' % int(100 * (step / self.total)), _('({0:.1f} per second, {1} remaining)').format(rate, eta))
+            else:
+                prints(msg, '...', '%d%%' % int(100 * (step / self.total)))
 
 
 def main(opts, args, dbctx):
@@ -66,15 +78,18 @@ def main(opts, args, dbctx):
               ' recovery') % '--really-do-it'
         )
 
-    r = Restore(dbctx.library_path, progress_callback=Progress())
+    st = time.time()
+    r = Restore(dbctx.library_path, progress_callback=Progress(), checkpoint_dir=default_checkpoint_dir(dbctx.library_path))
     r.start()
     r.join()
 
     if r.tb is not None:
         prints('Restoring database failed with error:')
         prints(r.tb)
+        prints('Run this command again to resume the restore')
     else:
         prints('Restoring database succeeded')
+        prints('Restored %d books in %s' % (r.successes, timedelta(seconds=int(time.time() - st))))
         prints('old database saved as', r.olddb)
         if r.errors_occurred:
             name = 'calibre_db_restore_report.txt'
@@ -7,10 +7,12 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 from calibre import prints
 
 readonly = True
-version = 0  # change this if you change signature of implementation()
+version = 1  # change this if you change signature of implementation()
 
 
-def implementation(db, notify_changes, query):
+def implementation(db, notify_changes, query, explain=False):
+    if explain:
+        return db.explain_search(query)
     return db.search(query)
 
 
@@ -36,6 +38,14 @@ language, for example: {0}
         type=int,
         help=_('The maximum number of results to return. Default is all results.')
     )
+    parser.add_option(
+        '--explain',
+        default=False,
+        action='store_true',
+        help=_('Instead of the matching book ids, print how the search was evaluated:'
+               ' the order in which its terms were evaluated, with the number of'
+               ' books and time taken for each term. Useful to find out why a search is slow.')
+    )
     return parser
 
 
@@ -43,6 +53,9 @@ def main(opts, args, dbctx):
     if len(args) < 1:
         raise SystemExit(_('Error: You must specify the search expression'))
     q = ' '.join(args)
+    if opts.explain:
+        prints(dbctx.run('search', q, True))
+        return 0
     ids = dbctx.run('search', q)
     if not ids:
         raise SystemExit(_('No books matching the search expression:') + ' ' + q)
@@ -37,7 +37,7 @@ def implementation(db, notify_changes, col, book_id, val, append):
                 val = fm['is_multiple']['list_to_ui'].join(val)
             msg = _('Data set to: {}').format(val)
     if is_remote:
-        notify_changes(metadata((book_id,)))
+        notify_changes(metadata((book_id,), fields=(field,)))
     return True, msg
 
 
@@ -52,7 +52,7 @@ def implementation(db, notify_changes, action, *args):
                     mi.set(field, val)
             changed_ids = db.set_metadata(book_id, mi, force_changes=True, allow_case_change=True)
             if is_remote:
-                notify_changes(metadata(changed_ids))
+                notify_changes(metadata(changed_ids, fields=[field for field, val in fvals]))
             return db.get_metadata(book_id)
 
 
@@ -28,6 +28,22 @@ def bool_sort_key(bools_are_tristate):
 
 IDENTITY = lambda x: x
 
+# Names that templates use to refer to fields, that are not the names of the
+# fields themselves
+TEMPLATE_FIELD_ALIASES = {
+    'title_sort': ('sort',), 'book_size': ('size',), 'ondevice_col': ('ondevice',), 'language': ('languages',),
+    'has_cover': ('cover',), 'format_metadata': ('formats',), 'db_approx_formats': ('formats',), 'isbn': ('identifiers',),
+    'author_sort_map': ('authors',), 'author_link_map': ('authors',), 'date': ('timestamp',), 'series_index': ('series', 'series_index'),
+}
+# Builtin template functions that read fields of the book directly, rather than
+# via their arguments. None means the fields read cannot be known.
+TEMPLATE_FUNCTION_FIELDS = {
+    'booksize': ('size',), 'ondevice': ('ondevice',), 'series_sort': ('series',), 'has_cover': ('cover',),
+    'author_links': ('authors',), 'author_sorts': ('authors',), 'approximate_formats': ('formats',),
+    'formats_modtimes': ('formats',), 'formats_sizes': ('formats',), 'formats_paths': ('formats', 'title', 'authors'),
+    'virtual_libraries': None, 'user_categories': None, 'eval': None, 'template': None, 'lookup': None,
+}
+
 
 class InvalidLinkTable(Exception):
 
@@ -209,6 +225,9 @@ class CompositeField(OneToOneField):
         OneToOneField.__init__(self, name, table, bools_are_tristate, get_template_functions)
 
         self._render_cache = {}
+        # Books whose rendered values were cleared, used to re-render them in
+        # the background, see pop_stale()
+        self._stale = set()
         self._lock = Lock()
         m = self.metadata
         self._composite_name = '#' + m['label']
@@ -262,6 +281,43 @@ class CompositeField(OneToOneField):
     def bool_sort_key(self, val):
         return self._bool_sort_key(force_to_bool(val))
 
+    def template_fields(self):
+        '''
+        Return the set of fields that the template for this column reads, found
+        by parsing the template. Returns None if the set cannot be known, for
+        example, because the template uses functions that read arbitrary
+        fields. Other composite columns are included by name, their fields are
+        not. '''
+        from calibre.ebooks.metadata.book.base import field_metadata
+        from calibre.utils.formatter import TemplateFormatter
+        from calibre.utils.formatter_functions import formatter_functions
+        try:
+            names, functions = TemplateFormatter().template_fields(self.metadata['display']['composite_template'])
+        except Exception:
+            return None  # The template has a syntax error
+        if names is None:
+            return None
+        builtins = formatter_functions().get_builtins_and_aliases()
+        for func in functions:
+            if func not in builtins:
+                return None
+            if func in TEMPLATE_FUNCTION_FIELDS:
+                extra = TEMPLATE_FUNCTION_FIELDS[func]
+                if extra is None:
+                    return None
+                names.update(extra)
+        ans = set()
+        for name in names:
+            # Field names are looked up the way SafeFormat.get_value() does
+            name = name.lower()
+            if name in TEMPLATE_FIELD_ALIASES:
+                ans.update(TEMPLATE_FIELD_ALIASES[name])
+            elif name.startswith('#') and name.endswith('_index'):
+                ans |= {name, name[:-6]}
+            else:
+                ans.add(field_metadata.search_term_to_field_key(name))
+        return ans
+
     def __render_composite(self, book_id, mi, formatter, template_cache):
         ' INTERNAL USE ONLY. DO NOT USE THIS OUTSIDE THIS CLASS! '
         ans = formatter.safe_format(
@@ -286,10 +342,25 @@ class CompositeField(OneToOneField):
     def clear_caches(self, book_ids=None):
         with self._lock:
             if book_ids is None:
+                # Everything changed, re-rendering every book in the
+                # background would be no cheaper than rendering on demand
                 self._render_cache.clear()
+                self._stale.clear()
             else:
                 for book_id in book_ids:
-                    self._render_cache.pop(book_id, None)
+                    if self._render_cache.pop(book_id, None) is not None:
+                        self._stale.add(book_id)
+
+    def pop_stale(self, limit):
+        ''' Return up to limit books whose values were rendered, then cleared
+        and have not been rendered since. '''
+        ans = []
+        with self._lock:
+            while self._stale and len(ans) < limit:
+                book_id = self._stale.pop()
+                if book_id not in self._render_cache:
+                    ans.append(book_id)
+        return ans
 
     def get_value_with_cache(self, book_id, get_metadata):
         with self._lock:
@@ -8,8 +8,11 @@ __copyright__ = '2011, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
 import traceback, sys
+from bisect import bisect_left
+from copy import deepcopy
 from threading import Lock, Condition, current_thread
 from calibre.utils.config_base import tweaks
+from calibre.utils.monotonic import monotonic
 
 
 class LockingError(RuntimeError):
@@ -25,7 +28,7 @@ class DowngradeLockError(LockingError):
     pass
 
 
-def create_locks():
+def create_locks(prefer_writers=None, max_reader_batch=None):
     '''
     Return a pair of locks: (read_lock, write_lock)
 
@@ -46,8 +49,16 @@ def create_locks():
     B. Bad things will happen if you violate this rule, the most benign of
     which is the raising of a LockingError (I haven't been able to eliminate
     the possibility of deadlocking in this scenario).
+
+    See :class:`SHLock` for prefer_writers and max_reader_batch. They default
+    to the values of the newdb_lock_prefer_writers and
+    newdb_lock_max_reader_batch tweaks.
     '''
-    l = SHLock()
+    if prefer_writers is None:
+        prefer_writers = tweaks.get('newdb_lock_prefer_writers', False)
+    if max_reader_batch is None:
+        max_reader_batch = tweaks.get('newdb_lock_max_reader_batch', 0)
+    l = SHLock(prefer_writers=prefer_writers, max_reader_batch=max_reader_batch)
     wrapper = DebugRWLockWrapper if tweaks.get('newdb_debug_locking', False) else RWLockWrapper
     return wrapper(l), wrapper(l, is_shared=False)
 
@@ -56,12 +67,22 @@ class SHLock(object):  # {{{
     '''
     Shareable lock class. Used to implement the Multiple readers-single writer
     paradigm. As best as I can tell, neither writer nor reader starvation
-    should be possible.
+    should be possible with the default policy.
+
+    New readers always wait behind a waiting writer. By default, when a
+    writer releases the lock, all waiting readers get it before the next
+    waiting writer. If prefer_writers is True, the next waiting writer gets
+    it first instead, readers can then be starved by a steady stream of
+    writers. If max_reader_batch is greater than zero, at most that many
+    waiting readers are let in at a time, so that a writer arriving later
+    has to wait for fewer readers to finish.
 
     Based on code from: https://github.com/rfk/threading2
     '''
 
-    def __init__(self):
+    def __init__(self, prefer_writers=False, max_reader_batch=0):
+        self.prefer_writers = prefer_writers
+        self.max_reader_batch = max_reader_batch
         self._lock = Lock()
         #  When a shared lock is held, is_shared will give the cumulative
         #  number of locks and _shared_owners maps each owning thread to
@@ -113,20 +134,13 @@ class SHLock(object):  # {{{
                 if not self.is_exclusive:
                     self._exclusive_owner = None
                     #  If there are waiting shared locks, issue them
-                    #  all and them wake everyone up.
-                    if self._shared_queue:
-                        for (thread, waiter) in self._shared_queue:
-                            self.is_shared += 1
-                            self._shared_owners[thread] = 1
-                            waiter.notify()
-                        del self._shared_queue[:]
+                    #  and wake them up, unless writers are preferred.
+                    if self._shared_queue and not (self.prefer_writers and self._exclusive_queue):
+                        self._issue_shared()
                     #  Otherwise, if there are waiting exclusive locks,
                     #  they get first dibbs on the lock.
                     elif self._exclusive_queue:
-                        (thread, waiter) = self._exclusive_queue.pop(0)
-                        self._exclusive_owner = thread
-                        self.is_exclusive += 1
-                        waiter.notify()
+                        self._issue_exclusive()
             elif self.is_shared:
                 try:
                     self._shared_owners[me] -= 1
@@ -139,15 +153,29 @@ class SHLock(object):  # {{{
                     #  If there are waiting exclusive locks,
                     #  they get first dibbs on the lock.
                     if self._exclusive_queue:
-                        (thread, waiter) = self._exclusive_queue.pop(0)
-                        self._exclusive_owner = thread
-                        self.is_exclusive += 1
-                        waiter.notify()
-                    else:
-                        assert not self._shared_queue
+                        self._issue_exclusive()
+                    #  Otherwise issue the next batch of shared locks
+                    elif self._shared_queue:
+                        self._issue_shared()
             else:
                 raise LockingError("release() called on unheld lock")
 
+    def _issue_shared(self):
+        num = len(self._shared_queue)
+        if self.max_reader_batch > 0:
+            num = min(num, self.max_reader_batch)
+        for (thread, waiter) in self._shared_queue[:num]:
+            self.is_shared += 1
+            self._shared_owners[thread] = 1
+            waiter.notify()
+        del self._shared_queue[:num]
+
+    def _issue_exclusive(self):
+        (thread, waiter) = self._exclusive_queue.pop(0)
+        self._exclusive_owner = thread
+        self.is_exclusive += 1
+        waiter.notify()
+
     def _acquire_shared(self, blocking=True):
         me = current_thread()
         #  Each case: acquiring a lock we already hold.
@@ -155,9 +183,10 @@ class SHLock(object):  # {{{
             self.is_shared += 1
             self._shared_owners[me] += 1
             return True
-        #  If the lock is already spoken for by an exclusive, add us
-        #  to the shared queue and it will give us the lock eventually.
-        if self.is_exclusive or self._exclusive_queue:
+        #  If the lock is already spoken for by an exclusive, or other
+        #  readers are waiting for their turn, add us to the shared queue
+        #  and it will give us the lock eventually.
+        if self.is_exclusive or self._exclusive_queue or self._shared_queue:
             if self._exclusive_owner is me:
                 raise DowngradeLockError("can't downgrade SHLock object")
             if not blocking:
@@ -278,3 +307,74 @@ class SafeReadLock(object):
 
     __enter__ = acquire
     __exit__  = release
+
+
+class LockStats(object):
+
+    '''
+    Histograms of the time spent waiting for and holding the database lock,
+    per API method. Recording is off unless enabled is True, or the
+    newdb_lock_stats tweak is set. Nested API calls are recorded as well, so
+    their hold times are also included in the hold time of the outer call.
+    '''
+
+    # Upper bounds, in seconds, of the histogram buckets, the last bucket
+    # counts everything slower
+    BUCKETS = (0.001, 0.01, 0.1, 1, 10)
+
+    def __init__(self, enabled=None):
+        self.enabled = tweaks.get('newdb_lock_stats', False) if enabled is None else enabled
+        self.lock = Lock()
+        self.stats = {}
+
+    def clear(self):
+        with self.lock:
+            self.stats = {}
+
+    def record(self, name, wait_time, hold_time):
+        with self.lock:
+            try:
+                entry = self.stats[name]
+            except KeyError:
+                entry = self.stats[name] = {k:{'total':0.0, 'max':0.0, 'histogram':[0] * (len(self.BUCKETS) + 1)} for k in ('wait', 'hold')}
+                entry['calls'] = 0
+            entry['calls'] += 1
+            for k, t in (('wait', wait_time), ('hold', hold_time)):
+                s = entry[k]
+                s['total'] += t
+                s['max'] = max(s['max'], t)
+                s['histogram'][bisect_left(self.BUCKETS, t)] += 1
+
+    def report(self):
+        ''' Return a mapping of API method name to its number of calls and the
+        total, maximum and histogram of its wait and hold times. '''
+        with self.lock:
+            return deepcopy(self.stats)
+
+    def __str__(self):
+        report = self.report()
+        labels = ['<%gs' % b for b in self.BUCKETS] + ['>%gs' % self.BUCKETS[-1]]
+        ans = []
+        for name in sorted(report, key=lambda n: report[n]['wait']['total'] + report[n]['hold']['total'], reverse=True):
+            entry = report[name]
+            ans.append('%s: %d calls' % (name, entry['calls']))
+            for k in ('wait', 'hold'):
+                s = entry[k]
+                ans.append('  %s: total %.3fs max %.3fs %s' % (k, s['total'], s['max'], ' '.join(
+                    '%s:%d' % (l, c) for l, c in zip(labels, s['histogram']) if c)))
+        return '\n'.join(ans)
+
+    def call(self, lock, func, args, kwargs):
+        ''' Call func with lock held, recording the time spent '''
+        st = monotonic()
+        try:
+            lock.acquire()
+        except DowngradeLockError:
+            # The calling thread already holds the exclusive lock
+            return func(*args, **kwargs)
+        acquired = monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            lock.release()
+            self.record(func.__name__, acquired - st, monotonic() - acquired)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2026, agent <agent at local>'
+__docformat__ = 'restructuredtext en'
+
+import weakref, traceback
+from threading import Thread, Event
+
+
+class Abort(Exception):
+    pass
+
+
+class CompositeRenderer(Thread):
+    '''
+    Re-render the values of composite columns that were cleared by changes to
+    books, in small batches, so that sorting or searching on a composite
+    column after a bulk edit does not have to render every value at once. This
+    class runs in its own thread.
+    '''
+
+    def __init__(self, db, interval=2, batch_size=50, scheduling_interval=0.01):
+        Thread.__init__(self, name='CompositeRenderer')
+        self.daemon = True
+        self._db = weakref.ref(getattr(db, 'new_api', db))
+        self.stop_running = Event()
+        self.interval = interval
+        self.batch_size = batch_size
+        self.scheduling_interval = scheduling_interval
+
+    @property
+    def db(self):
+        ans = self._db()
+        if ans is None:
+            raise Abort()
+        return ans
+
+    def stop(self):
+        self.stop_running.set()
+
+    def wait(self, interval):
+        if self.stop_running.wait(interval):
+            raise Abort()
+
+    def run(self):
+        while not self.stop_running.is_set():
+            try:
+                self.wait(self.interval)
+                # Release the lock between batches so that other threads
+                # can read and write the db
+                while self.do_one():
+                    self.wait(self.scheduling_interval)
+            except Abort:
+                break
+
+    def do_one(self):
+        try:
+            return self.db.prerender_composites(self.batch_size)
+        except Abort:
+            raise
+        except:
+            # Happens during interpreter shutdown
+            if self._db() is not None:
+                traceback.print_exc()
+            return 0
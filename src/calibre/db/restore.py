@@ -5,15 +5,17 @@ __license__   = 'GPL v3'
 __copyright__ = '2010, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
-import re, os, traceback, shutil, time
+import re, os, traceback, shutil, time, cPickle, hashlib
 from threading import Thread
 from operator import itemgetter
+from Queue import Empty
 
 from calibre.ptempfile import TemporaryDirectory
 from calibre.ebooks.metadata.opf2 import OPF
+from calibre.ebooks.metadata.book.serialize import metadata_as_dict, metadata_from_dict
 from calibre.db.backend import DB, DBPrefs
 from calibre.db.cache import Cache
-from calibre.constants import filesystem_encoding
+from calibre.constants import filesystem_encoding, cache_dir
 from calibre.utils.date import utcfromtimestamp
 from calibre import isbytestring, force_unicode
 
@@ -21,6 +23,67 @@ NON_EBOOK_EXTENSIONS = frozenset([
         'jpg', 'jpeg', 'gif', 'png', 'bmp',
         'opf', 'swp', 'swo'
         ])
+BAD_EXT_PAT = re.compile(r'[^a-z0-9_]+')
+CHECKPOINT_VERSION = 1
+
+
+def is_ebook_file(filename):
+    ext = os.path.splitext(filename)[1]
+    if not ext:
+        return False
+    ext = ext[1:].lower()
+    if ext in NON_EBOOK_EXTENSIONS or \
+            BAD_EXT_PAT.search(ext) is not None:
+        return False
+    return True
+
+
+def read_book_dir(library_path, dirpath, filenames, book_id):
+    ''' Read the metadata from the OPF file and the list of formats of the
+    book in dirpath '''
+    book_id = int(book_id)
+    formats = filter(is_ebook_file, filenames)
+    fmts    = [os.path.splitext(x)[1][1:].upper() for x in formats]
+    sizes   = [os.path.getsize(os.path.join(dirpath, x)) for x in formats]
+    names   = [os.path.splitext(x)[0] for x in formats]
+    opf = os.path.join(dirpath, 'metadata.opf')
+    mi = OPF(opf, basedir=dirpath).to_book_metadata()
+    timestamp = os.path.getmtime(opf)
+    path = os.path.relpath(dirpath, library_path).replace(os.sep, '/')
+    return {
+        'mi': mi,
+        'timestamp': timestamp,
+        'formats': list(zip(fmts, sizes, names)),
+        'id': book_id,
+        'dirpath': dirpath,
+        'path': path,
+    }
+
+
+def read_book_dirs(library_path, dirs):
+    ''' Read the books in dirs, runs in a worker process, see
+    :meth:`Restore.scan_library`. Metadata objects cannot be pickled, so the
+    metadata is returned as a dict. '''
+    ans = []
+    for dirpath, filenames, book_id in dirs:
+        try:
+            book = read_book_dir(library_path, dirpath, filenames, book_id)
+        except Exception:
+            ans.append((dirpath, None, traceback.format_exc()))
+            continue
+        mi = book['mi']
+        book['mi'], book['cover'] = metadata_as_dict(mi), mi.cover
+        ans.append((dirpath, book, None))
+    return ans
+
+
+def default_checkpoint_dir(library_path):
+    ''' The folder in which calibredb restore_database builds the new
+    database, so that an interrupted restore can be resumed '''
+    if isbytestring(library_path):
+        library_path = library_path.decode(filesystem_encoding)
+    key = hashlib.sha1(os.path.abspath(library_path).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir(), 'restore-database', key)
 
 
 class Restorer(Cache):
@@ -39,14 +102,29 @@ class Restorer(Cache):
 
 class Restore(Thread):
 
-    def __init__(self, library_path, progress_callback=None):
+    '''
+    Restore the database of a library from the OPF files in the book folders.
+    The OPF files are read by max_workers worker processes (use 0 to read
+    them in this process), chunk_size folders at a time, and the books are
+    added to the new database in batches of batch_size books.
+
+    If checkpoint_dir is specified, the new database is built in it rather
+    than in a temporary folder, and it is left there if the restore fails or
+    is interrupted. Restoring again with the same checkpoint_dir then only
+    restores the books not already restored. checkpoint_dir must be a folder
+    used only for this, see :func:`default_checkpoint_dir`.
+    '''
+
+    def __init__(self, library_path, progress_callback=None, max_workers=None, batch_size=100, checkpoint_dir=None, chunk_size=20):
         super(Restore, self).__init__()
         if isbytestring(library_path):
             library_path = library_path.decode(filesystem_encoding)
         self.src_library_path = os.path.abspath(library_path)
         self.progress_callback = progress_callback
+        self.max_workers, self.batch_size, self.chunk_size = max_workers, batch_size, chunk_size
+        self.checkpoint_dir = checkpoint_dir
         self.db_id_regexp = re.compile(r'^.* \((\d+)\)$')
-        self.bad_ext_pat = re.compile(r'[^a-z0-9_]+')
+        self.bad_ext_pat = BAD_EXT_PAT
         if not callable(self.progress_callback):
             self.progress_callback = lambda x, y: x
         self.dirs = []
@@ -59,6 +137,8 @@ class Restore(Thread):
         self.successes = 0
         self.tb = None
         self.authors_links = {}
+        self.restored_ids = frozenset()
+        self.resumed = False
 
     @property
     def errors_occurred(self):
@@ -101,6 +181,11 @@ class Restore(Thread):
 
     def run(self):
         try:
+            if self.checkpoint_dir is not None:
+                self.library_path = self.checkpoint_dir
+                self.do_restore()
+                shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+                return
             basedir = os.path.dirname(self.src_library_path)
             try:
                 tdir = TemporaryDirectory('_rlib', dir=basedir)
@@ -112,22 +197,62 @@ class Restore(Thread):
 
             with tdir as tdir:
                 self.library_path = tdir
-                self.scan_library()
-                if not self.load_preferences():
-                    # Something went wrong with preferences restore. Start over
-                    # with a new database and attempt to rebuild the structure
-                    # from the metadata in the opf
-                    dbpath = os.path.join(self.library_path, 'metadata.db')
-                    if os.path.exists(dbpath):
-                        os.remove(dbpath)
-                    self.create_cc_metadata()
-                self.restore_books()
-                if self.successes == 0 and len(self.dirs) > 0:
-                    raise Exception(('Something bad happened'))
-                self.replace_db()
+                self.do_restore()
         except:
             self.tb = traceback.format_exc()
 
+    def do_restore(self):
+        self.resumed = self.load_checkpoint()
+        if self.resumed:
+            self.progress_callback(_('Resuming an interrupted restore, {} books were already restored').format(len(self.restored_ids)), 0)
+        self.scan_library()
+        if not self.resumed:
+            if not self.load_preferences():
+                # Something went wrong with preferences restore. Start over
+                # with a new database and attempt to rebuild the structure
+                # from the metadata in the opf
+                dbpath = os.path.join(self.library_path, 'metadata.db')
+                if os.path.exists(dbpath):
+                    os.remove(dbpath)
+                self.create_cc_metadata()
+        self.save_checkpoint()
+        self.restore_books()
+        if self.successes == 0 and len(self.dirs) > 0:
+            raise Exception(('Something bad happened'))
+        self.replace_db()
+
+    @property
+    def checkpoint_path(self):
+        return os.path.join(self.checkpoint_dir, 'restore-checkpoint.pickle')
+
+    def load_checkpoint(self):
+        ''' Return True if an interrupted restore is being resumed. The ids of
+        the books already in the new database are not restored again. '''
+        if self.checkpoint_dir is None:
+            return False
+        try:
+            with open(self.checkpoint_path, 'rb') as f:
+                state = cPickle.load(f)
+            if state['version'] != CHECKPOINT_VERSION or state['library_path'] != self.src_library_path:
+                raise ValueError('Checkpoint is for a different library')
+            db = Restorer(self.library_path)
+            self.restored_ids = db.all_book_ids()
+            db.close()
+        except Exception:
+            if os.path.exists(self.checkpoint_dir):
+                shutil.rmtree(self.checkpoint_dir)
+            os.makedirs(self.checkpoint_dir)
+            return False
+        self.authors_links = state['authors_links']
+        self.successes = len(self.restored_ids)
+        return True
+
+    def save_checkpoint(self):
+        if self.checkpoint_dir is not None:
+            state = {'version':CHECKPOINT_VERSION, 'library_path':self.src_library_path, 'authors_links':self.authors_links}
+            with open(self.checkpoint_path, 'wb') as f:
+                cPickle.dump(state, f, -1)
+
     def load_preferences(self):
         self.progress_callback(None, 1)
         self.progress_callback(_('Starting restoring preferences and column metadata'), 0)
@@ -154,6 +279,7 @@ class Restore(Thread):
         return False
 
     def scan_library(self):
+        chunk_size = self.chunk_size
         for dirpath, dirnames, filenames in os.walk(self.src_library_path):
             leaf = os.path.basename(dirpath)
             m = self.db_id_regexp.search(leaf)
@@ -162,46 +288,79 @@ class Restore(Thread):
                 continue
             self.dirs.append((dirpath, filenames, m.group(1)))
 
-        self.progress_callback(None, len(self.dirs))
-        for i, x in enumerate(self.dirs):
-            dirpath, filenames, book_id = x
+        todo = [x for x in self.dirs if int(x[2]) not in self.restored_ids]
+        self.progress_callback(None, len(todo))
+        if self.max_workers == 0 or len(todo) <= chunk_size:
+            for i, x in enumerate(todo):
+                dirpath, filenames, book_id = x
+                try:
+                    self.process_dir(dirpath, filenames, book_id)
+                except:
+                    self.failed_dirs.append((dirpath, traceback.format_exc()))
+                self.progress_callback(_('Processed') + ' ' + dirpath, i+1)
+            return
+
+        from calibre.utils.ipc.pool import Pool, Failure
+        pending = {i:todo[i:i+chunk_size] for i in xrange(0, len(todo), chunk_size)}
+        done = 0
+        while pending:
+            pool = Pool(max_workers=self.max_workers, name='RestoreDatabase')
             try:
-                self.process_dir(dirpath, filenames, book_id)
-            except:
-                self.failed_dirs.append((dirpath, traceback.format_exc()))
-            self.progress_callback(_('Processed') + ' ' + dirpath, i+1)
+                try:
+                    for job_id, chunk in pending.iteritems():
+                        pool(job_id, 'calibre.db.restore', 'read_book_dirs', self.src_library_path, chunk)
+                except Failure:
+                    pass  # Handled below
+                while pending:
+                    try:
+                        worker_result = pool.results.get(True, 0.1)
+                    except Empty:
+                        if not pool.failed:
+                            continue
+                        worker_result = None
+                    else:
+                        pool.results.task_done()
+                    if worker_result is None or worker_result.is_terminal_failure:
+                        # A worker crashed, the folders it was reading are
+                        # recorded as failed, the others are read by a new pool
+                        tf = pool.terminal_failure
+                        if tf.job_id not in pending:
+                            raise Failure(tf)
+                        for dirpath, filenames, book_id in pending.pop(tf.job_id):
+                            self.failed_dirs.append((dirpath, tf.tb))
+                            done += 1
+                        break
+                    chunk = pending.pop(worker_result.id)
+                    result = worker_result.result
+                    if result.err:
+                        results = [(dirpath, None, result.traceback) for dirpath, filenames, book_id in chunk]
+                    else:
+                        results = result.value
+                    for dirpath, book, tb in results:
+                        if tb is None:
+                            try:
+                                mi = book['mi'] = metadata_from_dict(book['mi'])
+                                mi.cover = book.pop('cover')
+                                self.process_book(book)
+                            except:
+                                tb = traceback.format_exc()
+                        if tb is not None:
+                            self.failed_dirs.append((dirpath, tb))
+                        done += 1
+                        self.progress_callback(_('Processed') + ' ' + dirpath, done)
+            finally:
+                pool.shutdown()
 
     def is_ebook_file(self, filename):
-        ext = os.path.splitext(filename)[1]
-        if not ext:
-            return False
-        ext = ext[1:].lower()
-        if ext in NON_EBOOK_EXTENSIONS or \
-                self.bad_ext_pat.search(ext) is not None:
-            return False
-        return True
+        return is_ebook_file(filename)
 
     def process_dir(self, dirpath, filenames, book_id):
-        book_id = int(book_id)
-        formats = filter(self.is_ebook_file, filenames)
-        fmts    = [os.path.splitext(x)[1][1:].upper() for x in formats]
-        sizes   = [os.path.getsize(os.path.join(dirpath, x)) for x in formats]
-        names   = [os.path.splitext(x)[0] for x in formats]
-        opf = os.path.join(dirpath, 'metadata.opf')
-        mi = OPF(opf, basedir=dirpath).to_book_metadata()
-        timestamp = os.path.getmtime(opf)
-        path = os.path.relpath(dirpath, self.src_library_path).replace(os.sep,
-                '/')
-
-        if int(mi.application_id) == book_id:
-            self.books.append({
-                'mi': mi,
-                'timestamp': timestamp,
-                'formats': list(zip(fmts, sizes, names)),
-                'id': book_id,
-                'dirpath': dirpath,
-                'path': path,
-            })
+        self.process_book(read_book_dir(self.src_library_path, dirpath, filenames, book_id))
+
+    def process_book(self, book):
+        mi, dirpath = book['mi'], book['dirpath']
+        if int(mi.application_id) == book['id']:
+            self.books.append(book)
         else:
             self.mismatched_dirs.append(dirpath)
 
@@ -250,13 +409,18 @@ class Restore(Thread):
 
         db = Restorer(self.library_path)
 
-        for i, book in enumerate(self.books):
-            try:
-                db.restore_book(book['id'], book['mi'], utcfromtimestamp(book['timestamp']), book['path'], book['formats'])
-                self.successes += 1
-            except:
-                self.failed_restores.append((book, traceback.format_exc()))
-            self.progress_callback(book['mi'].title, i+1)
+        for start in xrange(0, len(self.books), self.batch_size):
+            # Each batch is restored in a single transaction, for performance.
+            # If the restore is interrupted, the books of the batch are not in
+            # the new database, so a resumed restore restores them.
+            with db.backend.conn:
+                for i, book in enumerate(self.books[start:start + self.batch_size], start):
+                    try:
+                        db.restore_book(book['id'], book['mi'], utcfromtimestamp(book['timestamp']), book['path'], book['formats'])
+                        self.successes += 1
+                    except:
+                        self.failed_restores.append((book, traceback.format_exc()))
+                    self.progress_callback(book['mi'].title, i+1)
 
         id_map = db.get_item_ids('authors', [author for author in self.authors_links])
         link_map = {aid:self.authors_links[name][0] for name, aid in id_map.iteritems() if aid is not None}
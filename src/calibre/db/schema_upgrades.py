@@ -696,3 +696,13 @@ CREATE TRIGGER fkc_lrp_update
         END;
 
         ''')
+
+    def upgrade_version_23(self):
+        ''' Add columns to the data table for the digest of each format and
+        the time its contents last changed '''
+        self.db.execute('''
+        ALTER TABLE data ADD COLUMN digest TEXT;
+        ALTER TABLE data ADD COLUMN digest_size INTEGER;
+        ALTER TABLE data ADD COLUMN digest_mtime REAL;
+        ALTER TABLE data ADD COLUMN changed REAL NOT NULL DEFAULT 0;
+        ''')
@@ -8,13 +8,15 @@ __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
 import re, weakref, operator
+from array import array
 from functools import partial
 from datetime import timedelta
 from collections import deque, OrderedDict
+from threading import Lock
 
 from calibre.constants import preferred_encoding
 from calibre.db.utils import force_to_bool
-from calibre.utils.config_base import prefs
+from calibre.utils.config_base import prefs, tweaks
 from calibre.utils.date import parse_date, UNDEFINED_DATE, now, dt_as_local
 from calibre.utils.icu import primary_contains, sort_key
 from calibre.utils.localization import lang_map, canonicalize_lang
@@ -141,11 +143,17 @@ class DateSearch(object):  # {{{
     def ge(self, *args):
         return not self.lt(*args)
 
-    def __call__(self, query, field_iter):
+    def __call__(self, query, field_iter, column=None, candidates=None):
         matches = set()
         if len(query) < 2:
             return matches
 
+        if column is not None and query in ('false', 'true'):
+            state = column.state
+            if query == 'false':
+                return {book_id for book_id in candidates if state[book_id] != VALUE}
+            return {book_id for book_id in candidates if state[book_id] == VALUE}
+
         if query == 'false':
             for v, book_ids in field_iter():
                 if isinstance(v, (str, unicode)):
@@ -197,6 +205,20 @@ class DateSearch(object):  # {{{
                 else:
                     field_count = query.count('/') + 1
 
+        if column is not None and field_count in (1, 2, 3):
+            # Compare the local dates as integers of the form YYYYMMDD, truncated
+            # to the precision of the query
+            div = (10000, 100, 1)[field_count - 1]
+            lo = (qd.year * 10000 + qd.month * 100 + qd.day) // div * div
+            hi = lo + div
+            top = 10**9
+            lo, hi, inside = {
+                self.eq: (lo, hi, True), self.ne: (lo, hi, False),
+                self.gt: (hi, top, True), self.le: (0, hi, True),
+                self.lt: (0, lo, True), self.ge: (lo, top, True)}[relop]
+            state, values = column.state, column.values
+            return {book_id for book_id in candidates if state[book_id] > NULL and (lo <= values[book_id] < hi) is inside}
+
         for v, book_ids in field_iter():
             if isinstance(v, (str, unicode)):
                 v = parse_date(v)
@@ -219,7 +241,7 @@ class NumericSearch(object):  # {{{
             ('<', operator.lt),
         ))
 
-    def __call__(self, query, field_iter, location, datatype, candidates, is_many=False):
+    def __call__(self, query, field_iter, location, datatype, candidates, is_many=False, column=None):
         matches = set()
         if not query:
             return matches
@@ -281,6 +303,19 @@ class NumericSearch(object):  # {{{
                 cast = int
 
         qfalse = query == 'false'
+        if column is not None:
+            state, values = column.state, column.values
+            if qfalse:
+                if location == 'cover':
+                    return {book_id for book_id in candidates if state[book_id] == NULL or (
+                        state[book_id] == VALUE and not values[book_id])}
+                return {book_id for book_id in candidates if state[book_id] == NULL}
+            if query == 'true':
+                if location == 'cover':
+                    return {book_id for book_id in candidates if state[book_id] == VALUE and values[book_id]}
+                return {book_id for book_id in candidates if state[book_id] == VALUE}
+            return {book_id for book_id in candidates if state[book_id] == VALUE and relop(values[book_id], q)}
+
         for val, book_ids in field_iter():
             if val is None:
                 if qfalse:
@@ -313,34 +348,150 @@ class BooleanSearch(object):  # {{{
             self.local_yes, self.local_checked, 'checked', '_checked', '_yes', 'true', 'yes',
             self.local_empty, self.local_blank, 'blank', '_blank', '_empty', 'empty'}
 
-    def __call__(self, query, field_iter, bools_are_tristate):
+    def matches(self, query, val, bools_are_tristate):
+        if not bools_are_tristate:
+            if val is None or not val:  # item is None or set to false
+                return query in {self.local_no, self.local_unchecked, 'unchecked', '_unchecked', 'no', '_no', 'false'}
+            # item is explicitly set to true
+            return query in {self.local_yes, self.local_checked, 'checked', '_checked', 'yes', '_yes', 'true'}
+        if val is None:
+            return query in {self.local_empty, self.local_blank, 'blank', '_blank', 'empty', '_empty', 'false'}
+        if not val:  # is not None and false
+            return query in {self.local_no, self.local_unchecked, 'unchecked', '_unchecked', 'no', '_no', 'true'}
+        # item is not None and true
+        return query in {self.local_yes, self.local_checked, 'checked', '_checked', 'yes', '_yes', 'true'}
+
+    def __call__(self, query, field_iter, bools_are_tristate, column=None, candidates=None):
         matches = set()
         if query not in self.local_bool_values:
             raise ParseException(_('Invalid boolean query "{0}"').format(query))
+        if column is not None:
+            # The column stores NULL, FALSE or TRUE for every book
+            states = {s for s, val in ((NULL, None), (FALSE, False), (TRUE, True)) if self.matches(query, val, bools_are_tristate)}
+            state = column.state
+            return {book_id for book_id in candidates if state[book_id] in states}
         for val, book_ids in field_iter():
-            val = force_to_bool(val)
-            if not bools_are_tristate:
-                if val is None or not val:  # item is None or set to false
-                    if query in {self.local_no, self.local_unchecked, 'unchecked', '_unchecked', 'no', '_no', 'false'}:
-                        matches |= book_ids
-                else:  # item is explicitly set to true
-                    if query in {self.local_yes, self.local_checked, 'checked', '_checked', 'yes', '_yes', 'true'}:
-                        matches |= book_ids
-            else:
-                if val is None:
-                    if query in {self.local_empty, self.local_blank, 'blank', '_blank', 'empty', '_empty', 'false'}:
-                        matches |= book_ids
-                elif not val:  # is not None and false
-                    if query in {self.local_no, self.local_unchecked, 'unchecked', '_unchecked', 'no', '_no', 'true'}:
-                        matches |= book_ids
-                else:  # item is not None and true
-                    if query in {self.local_yes, self.local_checked, 'checked', '_checked', 'yes', '_yes', 'true'}:
-                        matches |= book_ids
+            if self.matches(query, force_to_bool(val), bools_are_tristate):
+                matches |= book_ids
         return matches
 
 # }}}
 
 
+class Columns(object):  # {{{
+
+    '''
+    Columnar copies of the values of one-to-one date, number and yes/no
+    fields, stored in arrays indexed by book id, with the values already
+    converted to the form used by the searches above: local dates as integers
+    of the form YYYYMMDD, numbers as floats and yes/no values as states. This
+    allows searches on these fields to be evaluated by comparing a whole
+    column at once, instead of converting and comparing values one book at a
+    time. Books that have changed are updated before the next search.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.clear()
+
+    def clear(self):
+        self.columns = {}
+        self.dirty = set()
+
+    def books_changed(self, book_ids):
+        with self.lock:
+            if self.columns:
+                self.dirty |= set(book_ids)
+
+    def discard_books(self, book_ids):
+        with self.lock:
+            for column in self.columns.itervalues():
+                for book_id in book_ids:
+                    column.discard(book_id)
+            self.dirty -= set(book_ids)
+
+    def get(self, dbcache, location, datatype, candidates):
+        ''' Return the column for location, or None if the field does not have
+        one, in which case the field must be searched value by value. '''
+        field = dbcache.fields.get(location)
+        if (field is None or field.is_composite or field.is_many or not hasattr(field, 'table') or
+                datatype not in ('datetime', 'int', 'float', 'bool')):
+            return None
+        with self.lock:
+            if self.dirty:
+                for name, column in self.columns.iteritems():
+                    f = dbcache.fields[name]
+                    for book_id in self.dirty:
+                        column.set(book_id, f.for_book(book_id))
+                self.dirty.clear()
+            column = self.columns.get(location)
+            if column is None:
+                kind = {'datetime':'date', 'bool':'bool'}.get(datatype, 'number')
+                column = Column(kind, int if datatype == 'int' else float)
+                for book_id, val in field.table.book_col_map.iteritems():
+                    column.set(book_id, val)
+                self.columns[location] = column
+            if column.errors:
+                return None
+            column.ensure_size(max(candidates) + 1)
+            return column
+
+
+# The state of each book in a Column, books that have no value (or are not in
+# the library) are NULL
+NULL, FALSE, TRUE = 0, 1, 2
+UNDEFINED, VALUE = FALSE, TRUE  # Dates less than or equal to UNDEFINED_DATE are UNDEFINED
+
+
+class Column(object):
+
+    __slots__ = ('kind', 'cast', 'values', 'state', 'errors')
+
+    def __init__(self, kind, cast):
+        self.kind, self.cast = kind, cast
+        self.values = array(b'i' if kind == 'date' else b'd')
+        self.state = bytearray()
+        self.errors = 0
+
+    def ensure_size(self, size):
+        extra = size - len(self.state)
+        if extra > 0:
+            extra = max(extra, len(self.state) // 2 + 64)
+            self.state.extend(bytearray(extra))
+            self.values.extend(array(self.values.typecode, (0,)) * extra)
+
+    def set(self, book_id, val):
+        self.ensure_size(book_id + 1)
+        state = self.state
+        kind = self.kind
+        try:
+            if kind == 'bool':
+                val = force_to_bool(val)
+                state[book_id] = NULL if val is None else (TRUE if val else FALSE)
+            elif val is None:
+                state[book_id] = NULL
+            elif kind == 'date':
+                d = dt_as_local(val)
+                self.values[book_id] = d.year * 10000 + d.month * 100 + d.day
+                state[book_id] = VALUE if val > UNDEFINED_DATE else UNDEFINED
+            else:
+                v = self.cast(val)
+                self.values[book_id] = v
+                if self.values[book_id] != v:
+                    raise ValueError('%r cannot be represented exactly' % val)
+                state[book_id] = VALUE
+        except Exception:
+            # Fall back to searching the field value by value
+            self.errors += 1
+            state[book_id] = NULL
+
+    def discard(self, book_id):
+        if book_id < len(self.state):
+            self.state[book_id] = NULL
+
+# }}}
+
+
 class KeyPairSearch(object):  # {{{
 
     def __call__(self, query, field_iter, candidates, use_primary_find):
@@ -444,12 +595,171 @@ class SavedSearchQueries(object):  # {{{
 # }}}
 
 
+class TextIndex(object):  # {{{
+
+    '''
+    An inverted index from the trigrams in the values of text fields to the
+    books that have those values. It is used to narrow down the set of books
+    that have to be checked for contains and equality searches, without
+    having to look at every value in the library. The index only ever
+    narrows, the actual matching is still done by :func:`_match` so results
+    are unchanged.
+
+    To guarantee that no matches are missed, only values consisting of
+    printable ASCII characters are indexed (books with other values are
+    always checked) and all characters other than letters and digits are
+    ignored, since they can be ignorable in some collations.
+
+    Books that have changed are re-indexed before the next search. Entries
+    for their old values are left in place, they only cause extra books to
+    be checked, and are removed when the index is periodically rebuilt.
+    '''
+
+    INDEXED_FIELDS = frozenset(('title', 'authors', 'tags', 'series', 'publisher'))
+    INDEXED_DATATYPES = frozenset(('text', 'series', 'enumeration'))
+
+    def __init__(self):
+        self.lock = Lock()
+        self.clear()
+
+    def clear(self):
+        self.field_indices = {}
+        self.dirty = set()
+        self.stale = 0
+        self.usable = None
+
+    def books_changed(self, book_ids):
+        with self.lock:
+            if self.field_indices:
+                self.dirty |= set(book_ids)
+
+    def discard_books(self, book_ids):
+        with self.lock:
+            self.dirty -= set(book_ids)
+
+    def is_indexable(self, field):
+        if field.is_composite:
+            return False
+        if field.name in self.INDEXED_FIELDS:
+            return True
+        return field.name.startswith('#') and field.metadata['datatype'] in self.INDEXED_DATATYPES
+
+    def index_book(self, findex, field, book_id):
+        val = field.for_book(book_id, default_value=None)
+        if not val:
+            findex.unindexed.discard(book_id)
+            return
+        vals = (val,) if isinstance(val, basestring) else val
+        grams = set()
+        for v in vals:
+            if not isinstance(v, basestring) or _printable_ascii.match(v) is None:
+                findex.unindexed.add(book_id)
+                return
+            grams |= trigrams(v)
+        findex.unindexed.discard(book_id)
+        postings = findex.postings
+        for g in grams:
+            try:
+                postings[g].append(book_id)
+            except KeyError:
+                postings[g] = array(b'i', (book_id,))
+
+    def build(self, dbcache, field):
+        findex = FieldIndex(dbcache._all_book_ids(type=set))
+        for book_id in findex.known:
+            self.index_book(findex, field, book_id)
+        return findex
+
+    def flush(self, dbcache):
+        if self.dirty:
+            self.stale += len(self.dirty)
+            if self.stale > max(1000, len(dbcache.fields['title'].table.book_col_map) // 4):
+                self.field_indices.clear()
+                self.stale = 0
+            else:
+                for name, findex in self.field_indices.iteritems():
+                    field = dbcache.fields[name]
+                    for book_id in self.dirty:
+                        if book_id in dbcache.fields['title'].table.book_col_map:
+                            findex.known.add(book_id)
+                            self.index_book(findex, field, book_id)
+            self.dirty.clear()
+
+    def candidates(self, dbcache, location, query, candidates):
+        '''
+        Return the subset of candidates whose values for location could match
+        query (a contains or equals query, without its match kind prefix). Returns
+        None if the index cannot be used for this query.
+        '''
+        grams = query_trigrams(query)
+        if not grams:
+            return None
+        field = dbcache.fields.get(location)
+        if field is None or not self.is_indexable(field):
+            return None
+        with self.lock:
+            if self.usable is None:
+                # In some locales, such as Hungarian, different sequences of
+                # ASCII letters are equal at primary strength, which would
+                # cause the index to miss matches
+                self.usable = not primary_contains('cscs', 'ccs')
+            if not self.usable:
+                return None
+            self.flush(dbcache)
+            findex = self.field_indices.get(location)
+            if findex is None:
+                findex = self.field_indices[location] = self.build(dbcache, field)
+            lists = []
+            for g in grams:
+                p = findex.postings.get(g)
+                if p is None:
+                    lists = None
+                    break
+                lists.append(p)
+            found = set()
+            if lists:
+                lists.sort(key=len)
+                found = set(lists[0]).intersection(*lists[1:])
+            found |= findex.unindexed
+            ans = found.intersection(candidates)
+            ans |= candidates - findex.known
+        return ans
+
+
+class FieldIndex(object):
+
+    __slots__ = ('known', 'postings', 'unindexed')
+
+    def __init__(self, known):
+        self.known = known
+        self.postings = {}
+        self.unindexed = set()
+
+
+_printable_ascii = re.compile(r'^[\x20-\x7e]*$')
+_not_alnum = re.compile(r'[^a-z0-9]+')
+
+
+def trigrams(text):
+    text = _not_alnum.sub('', text.lower())
+    return {text[i:i+3] for i in xrange(len(text) - 2)}
+
+
+def query_trigrams(query):
+    if _printable_ascii.match(query) is None:
+        return None
+    return trigrams(query)
+
+# }}}
+
+
 class Parser(SearchQueryParser):  # {{{
 
     def __init__(self, dbcache, all_book_ids, gst, date_search, num_search,
                  bool_search, keypair_search, limit_search_columns, limit_search_columns_to,
-                 locations, virtual_fields, lookup_saved_search, parse_cache):
+                 locations, virtual_fields, lookup_saved_search, parse_cache, text_index=None, columns=None):
         self.dbcache, self.all_book_ids = dbcache, all_book_ids
+        self.text_index, self.columns = text_index, columns
         self.all_search_locations = frozenset(locations)
         self.grouped_search_terms = gst
         self.date_search, self.num_search = date_search, num_search
@@ -459,7 +769,9 @@ class Parser(SearchQueryParser):  # {{{
         self.virtual_fields = virtual_fields or {}
         if 'marked' not in self.virtual_fields:
             self.virtual_fields['marked'] = self
-        SearchQueryParser.__init__(self, locations, optimize=True, lookup_saved_search=lookup_saved_search, parse_cache=parse_cache)
+        self.fields_used = set()
+        SearchQueryParser.__init__(self, locations, optimize=True, lookup_saved_search=lookup_saved_search,
+                                   parse_cache=parse_cache, plan_queries=True)
 
     @property
     def field_metadata(self):
@@ -483,8 +795,25 @@ class Parser(SearchQueryParser):  # {{{
 
     def parse(self, *args, **kwargs):
         self.virtual_field_used = False
+        self.fields_used = set()
         return SearchQueryParser.parse(self, *args, **kwargs)
 
+    def field_used(self, name):
+        # Record the fields that the current search depends on. None means
+        # the search could depend on any field.
+        if self.fields_used is not None:
+            if name in ('all', 'vl'):
+                self.fields_used = None
+                return
+            self.fields_used.add(name)
+            field = self.dbcache.fields.get(name)
+            if field is not None and field.is_composite:
+                deps = self.dbcache._composite_fields(name)
+                if deps is None:
+                    self.fields_used = None
+                else:
+                    self.fields_used |= deps
+
     def get_matches(self, location, query, candidates=None,
                     allow_recursion=True):
         # If candidates is not None, it must not be modified. Changing its
@@ -499,6 +828,7 @@ class Parser(SearchQueryParser):  # {{{
             return matches
 
         if location == 'vl':
+            self.field_used('vl')
             vl = self.dbcache._pref('virtual_libraries', {}).get(query) if query else None
             if not vl:
                 raise ParseException(_('No such virtual library: {}').format(query))
@@ -516,6 +846,8 @@ class Parser(SearchQueryParser):  # {{{
         original_location = location
         location = self.field_metadata.search_term_to_field_key(
             icu_lower(location.strip()))
+        if not isinstance(location, list):
+            self.field_used(location)
         # grouped search terms
         if isinstance(location, list):
             if allow_recursion:
@@ -573,13 +905,15 @@ class Parser(SearchQueryParser):  # {{{
                 fm['display'].get('composite_sort', '') == 'date')):
                 if location == 'date':
                     location = 'timestamp'
+                column = None if self.columns is None else self.columns.get(self.dbcache, location, dt, candidates)
                 return self.date_search(
-                    icu_lower(query), partial(self.field_iter, location, candidates))
+                    icu_lower(query), partial(self.field_iter, location, candidates), column=column, candidates=candidates)
 
             # take care of numbers special case
             if (dt in ('rating', 'int', 'float') or
                     (dt == 'composite' and
                      fm['display'].get('composite_sort', '') == 'number')):
+                column = None
                 if location == 'id':
                     is_many = False
 
@@ -589,10 +923,12 @@ class Parser(SearchQueryParser):  # {{{
                 else:
                     field = self.dbcache.fields[location]
                     fi, is_many = partial(self.field_iter, location, candidates), field.is_many
+                    if self.columns is not None:
+                        column = self.columns.get(self.dbcache, location, dt, candidates)
                 if dt == 'rating' and fm['display'].get('allow_half_stars'):
                     dt = 'half-rating'
                 return self.num_search(
-                    icu_lower(query), fi, location, dt, candidates, is_many=is_many)
+                    icu_lower(query), fi, location, dt, candidates, is_many=is_many, column=column)
 
             # take care of the 'count' operator for is_multiples
             if (fm['is_multiple'] and
@@ -603,9 +939,10 @@ class Parser(SearchQueryParser):  # {{{
 
             # take care of boolean special case
             if dt == 'bool':
+                column = None if self.columns is None else self.columns.get(self.dbcache, location, dt, candidates)
                 return self.bool_search(icu_lower(query),
                                 partial(self.field_iter, location, candidates),
-                                self.dbcache._pref('bools_are_tristate'))
+                                self.dbcache._pref('bools_are_tristate'), column=column, candidates=candidates)
 
             # special case: colon-separated fields such as identifiers. isbn
             # is a special case within the case
@@ -699,7 +1036,12 @@ class Parser(SearchQueryParser):  # {{{
                 continue
 
             if location in text_fields:
-                for val, book_ids in self.field_iter(location, current_candidates):
+                cands = None
+                if matchkind != REGEXP_MATCH and self.text_index is not None:
+                    cands = self.text_index.candidates(self.dbcache, location, q, current_candidates)
+                if cands is None:
+                    cands = current_candidates
+                for val, book_ids in self.field_iter(location, cands):
                     if val is not None:
                         if isinstance(val, basestring):
                             val = (val,)
@@ -715,6 +1057,49 @@ class Parser(SearchQueryParser):  # {{{
 
         return matches
 
+    def estimate_cost(self, location, query):
+        # The costs are only meaningful relative to each other. Terms that are
+        # answered from an index or a column are cheap, terms that have to
+        # look at every value of a field are more expensive, and regular
+        # expressions, long text and templates (composite columns) are the
+        # most expensive.
+        location = location.strip()
+        if location == 'search':
+            return 20
+        if location == 'vl':
+            return 5
+        if len(location) > 2 and location.startswith('@') and location[1:] in self.grouped_search_terms:
+            location = location[1:]
+        key = self.field_metadata.search_term_to_field_key(icu_lower(location))
+        if isinstance(key, list):
+            return sum(self.estimate_cost(x, query) for x in key)
+        regex = query.startswith('~')
+        if key == 'all':
+            return 200 if regex else 100
+        if key.startswith('@'):
+            return 20
+        if key not in self.field_metadata:
+            return 1
+        fm = self.field_metadata[key]
+        dt = fm['datatype']
+        if dt == 'composite':
+            return 300
+        if dt in ('datetime', 'int', 'float', 'bool', 'rating'):
+            field = self.dbcache.fields.get(key)
+            return 2 if self.columns is not None and field is not None and not field.is_many else 10
+        if fm['is_multiple'] or fm.get('is_csp', False):
+            base = 10
+        else:
+            base = 40 if dt == 'comments' else 20
+        if regex:
+            return base * 5
+        if query.startswith('=') or self.text_index is None:
+            return base
+        field = self.dbcache.fields.get(key)
+        if field is not None and self.text_index.is_indexable(field):
+            return max(1, base // 4)
+        return base
+
     def get_user_category_matches(self, location, query, candidates):
         matches = set()
         if len(query) < 2:
@@ -798,9 +1183,84 @@ class LRUCache(object):  # {{{
 # }}}
 
 
+class ResultCache(LRUCache):  # {{{
+
+    '''
+    The cache of search results. Results are stored as sorted arrays of book
+    ids, which take a fraction of the memory of a set, together with the
+    fields the search looked at, so that a change to some fields only affects
+    the results that depend on them. The cache is bounded both by the number of
+    results and by the total number of book ids stored in it.
+    '''
+
+    def __init__(self, limit=None, max_ids=None):
+        LRUCache.__init__(self, limit=tweaks.get('newdb_search_cache_size', 200) if limit is None else limit)
+        self.max_ids = tweaks.get('newdb_search_cache_max_ids', 4000000) if max_ids is None else max_ids
+        self.fields_map = {}
+        self.num_ids = 0
+
+    def add(self, key, val, fields=None):
+        if key in self.item_map:
+            self._move_up(key)
+            return
+        ids = array(b'i', sorted(val))
+        if len(ids) > self.max_ids:
+            return
+        while self.age_map and (len(self.age_map) >= self.limit or self.num_ids + len(ids) > self.max_ids):
+            self.pop(self.age_map[0])
+        self.item_map[key] = ids
+        self.fields_map[key] = fields
+        self.num_ids += len(ids)
+        self.age_map.append(key)
+    __setitem__ = add
+
+    def set(self, key, val):
+        ''' Replace the result for a query that is already cached '''
+        ids = array(b'i', sorted(val))
+        self.num_ids += len(ids) - len(self.item_map[key])
+        self.item_map[key] = ids
+
+    def get(self, key, default=None):
+        ans = LRUCache.get(self, key)
+        return default if ans is None else set(ans)
+
+    def peek(self, key):
+        ''' Return the cached result for key without marking it as used '''
+        ans = self.item_map.get(key)
+        return None if ans is None else set(ans)
+
+    def keys(self):
+        return list(self.age_map)
+
+    def fields(self, key):
+        ''' The set of fields the cached query depends on, or None if it could
+        depend on any field. '''
+        return self.fields_map.get(key)
+
+    def clear(self):
+        LRUCache.clear(self)
+        self.fields_map.clear()
+        self.num_ids = 0
+
+    def pop(self, key, default=None):
+        self.num_ids -= len(self.item_map.get(key, ()))
+        self.fields_map.pop(key, None)
+        LRUCache.pop(self, key, default)
+
+    def __iter__(self):
+        for key, ids in self.item_map.items():
+            yield key, set(ids)
+# }}}
+
+
 class Search(object):
 
     MAX_CACHE_UPDATE = 50
+    # Fields whose values are changed, or whose search values depend on, the
+    # values of other fields
+    DEPENDENT_FIELDS = {
+        'title': ('sort',), 'authors': ('author_sort',), 'series': ('series_sort',), 'languages': ('series_sort',),
+    }
 
     def __init__(self, db, opt_name, all_search_locations=()):
         self.all_search_locations = all_search_locations
@@ -809,8 +1269,10 @@ class Search(object):
         self.bool_search = BooleanSearch()
         self.keypair_search = KeyPairSearch()
         self.saved_searches = SavedSearchQueries(db, opt_name)
-        self.cache = LRUCache()
+        self.cache = ResultCache()
         self.parse_cache = LRUCache(limit=100)
+        self.text_index = TextIndex() if tweaks.get('newdb_search_index', True) else None
+        self.columns = Columns() if tweaks.get('newdb_search_index', True) else None
 
     def get_saved_searches(self):
         return self.saved_searches
@@ -819,33 +1281,75 @@ class Search(object):
         if frozenset(newlocs) != frozenset(self.all_search_locations):
             self.clear_caches()
             self.parse_cache.clear()
+            for index in (self.text_index, self.columns):
+                if index is not None:
+                    index.clear()
         self.all_search_locations = newlocs
 
-    def update_or_clear(self, dbcache, book_ids=None):
-        if book_ids and (len(book_ids) * len(self.cache)) <= self.MAX_CACHE_UPDATE:
-            self.update_caches(dbcache, book_ids)
+    def update_or_clear(self, dbcache, book_ids=None, fields=None):
+        '''
+        Update the caches for a change to the specified books. If fields is
+        not None, only cached results for searches that depend on those fields
+        are affected. '''
+        for index in (self.text_index, self.columns):
+            if index is not None:
+                if book_ids:
+                    index.books_changed(book_ids)
+                else:
+                    index.clear()
+        if not book_ids:
+            return self.clear_caches()
+        stale = self.stale_queries(fields)
+        if not stale:
+            return
+        if len(book_ids) * len(stale) <= self.MAX_CACHE_UPDATE:
+            self.update_caches(dbcache, book_ids, stale)
         else:
-            self.clear_caches()
+            for query in stale:
+                self.cache.pop(query)
+
+    def stale_queries(self, fields):
+        queries = self.cache.keys()
+        if fields is None:
+            return queries
+        # last_modified is updated whenever a book is changed
+        changed = {'last_modified'}
+        for field in fields:
+            changed.add(field)
+            changed.update(self.DEPENDENT_FIELDS.get(field, ()))
+        ans = []
+        for query in queries:
+            used = self.cache.fields(query)
+            if used is None or not used.isdisjoint(changed):
+                ans.append(query)
+        return ans
 
     def clear_caches(self):
         self.cache.clear()
 
-    def update_caches(self, dbcache, book_ids):
+    def update_caches(self, dbcache, book_ids, queries=None):
         sqp = self.create_parser(dbcache)
         try:
-            return self._update_caches(sqp, book_ids)
+            return self._update_caches(sqp, book_ids, queries)
         finally:
             sqp.dbcache = sqp.lookup_saved_search = None
 
     def discard_books(self, book_ids):
         book_ids = set(book_ids)
         for query, result in self.cache:
-            result.difference_update(book_ids)
+            if not result.isdisjoint(book_ids):
+                self.cache.set(query, result - book_ids)
+        for index in (self.text_index, self.columns):
+            if index is not None:
+                index.discard_books(book_ids)
 
-    def _update_caches(self, sqp, book_ids):
+    def _update_caches(self, sqp, book_ids, queries=None):
         book_ids = sqp.all_book_ids = set(book_ids)
         remove = set()
-        for query, result in tuple(self.cache):
+        for query in (self.cache.keys() if queries is None else queries):
+            result = self.cache.peek(query)
+            if result is None:
+                continue
             try:
                 matches = sqp.parse(query)
             except ParseException:
@@ -855,6 +1359,7 @@ class Search(object):
                 result.difference_update(book_ids - matches)
                 # add books that now match but did not before
                 result.update(matches)
+                self.cache.set(query, result)
         for query in remove:
             self.cache.pop(query)
 
@@ -865,7 +1370,8 @@ class Search(object):
             self.keypair_search,
             prefs['limit_search_columns'],
             prefs['limit_search_columns_to'], self.all_search_locations,
-            virtual_fields, self.saved_searches.lookup, self.parse_cache)
+            virtual_fields, self.saved_searches.lookup, self.parse_cache,
+            text_index=self.text_index, columns=self.columns)
 
     def __call__(self, dbcache, query, search_restriction, virtual_fields=None, book_ids=None):
         '''
@@ -880,6 +1386,38 @@ class Search(object):
         finally:
             sqp.dbcache = sqp.lookup_saved_search = None
 
+    def explain(self, dbcache, query, search_restriction, virtual_fields=None, book_ids=None):
+        '''
+        Run the specified search, bypassing the result cache, and return a
+        description of how it was evaluated, see
+        :meth:`SearchQueryParser.explain`.
+        '''
+        if isinstance(search_restriction, bytes):
+            search_restriction = search_restriction.decode('utf-8')
+        if isinstance(query, bytes):
+            query = query.decode('utf-8')
+        sqp = self.create_parser(dbcache, virtual_fields)
+        try:
+            restricted_ids = dbcache._all_book_ids(type=set) if book_ids is None else book_ids
+            lines = []
+            if search_restriction and search_restriction.strip():
+                sqp.all_book_ids = restricted_ids
+                restricted_ids, rlines = sqp.explain(search_restriction.strip())
+                lines.append(_('Restriction:'))
+                lines.extend('  ' + x for x in rlines)
+            query = query.strip()
+            if query:
+                sqp.all_book_ids = restricted_ids
+                result, qlines = sqp.explain(query)
+                lines.append(_('Query:'))
+                lines.extend('  ' + x for x in qlines)
+            else:
+                result = restricted_ids
+            lines.append(_('Matches: %d') % len(result))
+            return '\n'.join(lines)
+        finally:
+            sqp.dbcache = sqp.lookup_saved_search = None
+
     def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None):
         ''' Do the search, caching the results. Results are cached only if the
         search is on the full library and no virtual field is searched on '''
@@ -901,7 +1439,7 @@ class Search(object):
                 sqp.all_book_ids = all_book_ids if book_ids is None else book_ids
                 restricted_ids = sqp.parse(search_restriction)
                 if not sqp.virtual_field_used and sqp.all_book_ids is all_book_ids:
-                    self.cache.add(search_restriction.strip(), restricted_ids)
+                    self.cache.add(search_restriction.strip(), restricted_ids, sqp.fields_used)
             else:
                 restricted_ids = cached
                 if book_ids is not None:
@@ -921,6 +1459,6 @@ class Search(object):
         result = sqp.parse(query)
 
         if not sqp.virtual_field_used and sqp.all_book_ids is all_book_ids:
-            self.cache.add(query, result)
+            self.cache.add(query, result, sqp.fields_used)
 
         return result
@@ -0,0 +1,256 @@
+#!/usr/bin/env python2
+# vim:fileencoding=UTF-8
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2026, agent <agent at local>'
+__docformat__ = 'restructuredtext en'
+
+from copy import copy
+from threading import Lock
+
+from calibre.db.tables import CompactMap
+
+# Writers of these fields also change the linked fields, through references
+# to them held by the field objects, without looking them up in Cache.fields
+WRITE_LINKED_FIELDS = {'title': ('sort',), 'authors': ('author_sort',)}
+
+
+def copy_container(val):
+    if isinstance(val, CompactMap):
+        return copy(val)
+    if isinstance(val, (set, list)):
+        return copy(val)
+    if isinstance(val, dict):
+        # Maps such as col_book_map have sets or dicts as values that
+        # writers change in place, so they have to be copied as well
+        sample = next(val.itervalues(), None)
+        if isinstance(sample, (set, dict, list)):
+            ans = copy(val)
+            for k, v in val.iteritems():
+                ans[k] = copy(v)
+            return ans
+        return copy(val)
+    return val
+
+
+def copy_field(field):
+    ''' Return a copy of field whose table data is independent of the
+    original. A lazily loaded table is read first. '''
+    table = field.table
+    loader = table.__dict__.get('lazy_loader')
+    if loader is not None:
+        loader.load(table)
+    ans = copy(field)
+    ans.table = copy(table)
+    for k, v in table.__dict__.iteritems():
+        if k != 'metadata':
+            ans.table.__dict__[k] = copy_container(v)
+    return ans
+
+
+class Snapshot(object):
+
+    '''
+    A read-only view of the data of the library as it was when the snapshot
+    was taken, see Cache.snapshot(). Reading from a snapshot does not hold
+    the database lock, so long running readers do not block writers.
+
+    The data of a field is copied the first time it is read, under a short
+    read lock, or the first time a writer looks the field up, before it is
+    changed, see :class:`SnapshotFields`. So creating a snapshot is cheap
+    and writes only copy the fields they touch.
+
+    Composite columns and the ondevice column are not available, as their
+    values are computed from other fields. Use the snapshot in a with
+    statement, or call release(), to free it early, otherwise it is freed
+    when it is garbage collected.
+    '''
+
+    def __init__(self, dbcache, fields=None):
+        self.dbcache = dbcache
+        available = {name for name, field in dict.iteritems(dbcache.fields) if hasattr(field, 'table') and not field.is_composite}
+        self.field_names = available if fields is None else available.intersection(fields) | {'uuid', 'title'}
+        self.fields = {}
+        self.lock = Lock()
+        dbcache.snapshots.add(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def release(self):
+        self.dbcache.snapshots.discard(self)
+        with self.lock:
+            self.field_names = frozenset()
+            self.fields = {}
+
+    def copy_field(self, name):
+        # Must be called with the database lock held
+        with self.lock:
+            ans = self.fields.get(name)
+            if ans is None:
+                if name not in self.field_names:
+                    raise KeyError(name)
+                ans = self.fields[name] = copy_field(dict.__getitem__(self.dbcache.fields, name))
+                if len(self.fields) == len(self.field_names):
+                    self.dbcache.snapshots.discard(self)
+            return ans
+
+    def copy_for_write(self, names):
+        ' Copy the data of the specified fields, if not yet copied, called by writers before changing anything. '
+        for name in names:
+            for name in (name,) + WRITE_LINKED_FIELDS.get(name, ()):
+                if name in self.field_names and name not in self.fields:
+                    self.copy_field(name)
+
+    def field(self, name):
+        try:
+            return self.fields[name]
+        except KeyError:
+            if name not in self.field_names:
+                raise
+        with self.dbcache.safe_read_lock:
+            return self.copy_field(name)
+
+    def all_book_ids(self, type=frozenset):
+        ' Same as Cache.all_book_ids() '
+        return type(self.field('uuid').table.book_col_map)
+
+    def has_id(self, book_id):
+        ' Same as Cache.has_id() '
+        return book_id in self.field('title').table.book_col_map
+
+    def field_for(self, name, book_id, default_value=None):
+        ' Same as Cache.field_for() '
+        try:
+            field = self.field(name)
+        except KeyError:
+            return default_value
+        if field.is_multiple:
+            default_value = field.default_value
+        try:
+            return field.for_book(book_id, default_value=default_value)
+        except (KeyError, IndexError):
+            return default_value
+
+    def all_field_for(self, name, book_ids, default_value=None):
+        ' Same as Cache.all_field_for() '
+        field = self.field(name)
+        if field.is_multiple:
+            default_value = field.default_value
+        ans = {}
+        for book_id in book_ids:
+            try:
+                ans[book_id] = field.for_book(book_id, default_value=default_value)
+            except (KeyError, IndexError):
+                ans[book_id] = default_value
+        return ans
+
+    def field_ids_for(self, name, book_id):
+        ' Same as Cache.field_ids_for() '
+        try:
+            return self.field(name).ids_for_book(book_id)
+        except (KeyError, IndexError):
+            return ()
+
+    def books_for_field(self, name, item_id):
+        ' Same as Cache.books_for_field() '
+        try:
+            return self.field(name).books_for(item_id)
+        except (KeyError, IndexError):
+            return set()
+
+    def get_id_map(self, name):
+        ' Same as Cache.get_id_map() '
+        field = self.field(name)
+        try:
+            return field.table.id_map.copy()
+        except AttributeError:
+            if name == 'title':
+                return field.table.book_col_map.copy()
+            raise ValueError('%s is not a many-one or many-many field' % name)
+
+    def get_item_name(self, name, item_id):
+        ' Same as Cache.get_item_name() '
+        return self.field(name).table.id_map[item_id]
+
+    def author_data(self, author_ids=None):
+        ' Same as Cache.author_data() '
+        af = self.field('authors')
+        if author_ids is None:
+            return {aid:af.author_data(aid) for aid in af.table.id_map}
+        return {aid:af.author_data(aid) for aid in author_ids if aid in af.table.id_map}
+
+
+class SnapshotFields(dict):
+
+    '''
+    The fields of a Cache. While the write lock is held, looking up a field
+    first copies its data into the live snapshots that have not yet copied
+    it, so that writers only copy the fields they touch. Iterating over the
+    fields while writing copies all of them.
+    '''
+
+    def __init__(self, snapshots):
+        dict.__init__(self)
+        self.snapshots = snapshots
+        self.writing = 0
+
+    def copy_for_write(self, names):
+        if self.writing and self.snapshots:
+            for snapshot in tuple(self.snapshots):
+                snapshot.copy_for_write(names)
+
+    def __getitem__(self, name):
+        self.copy_for_write((name,))
+        return dict.__getitem__(self, name)
+
+    def get(self, name, default=None):
+        if name in self:
+            self.copy_for_write((name,))
+        return dict.get(self, name, default)
+
+    def itervalues(self):
+        self.copy_for_write(tuple(self))
+        return dict.itervalues(self)
+
+    def iteritems(self):
+        self.copy_for_write(tuple(self))
+        return dict.iteritems(self)
+
+    def values(self):
+        self.copy_for_write(tuple(self))
+        return dict.values(self)
+
+    def items(self):
+        self.copy_for_write(tuple(self))
+        return dict.items(self)
+
+
+class SnapshotWriteLock(object):
+
+    '''
+    Wraps the write lock of a Cache so that the fields of the Cache know
+    when a writer holds it, see :class:`SnapshotFields`.
+    '''
+
+    def __init__(self, write_lock, fields):
+        self.write_lock, self.fields = write_lock, fields
+
+    def acquire(self):
+        self.write_lock.acquire()
+        self.fields.writing += 1
+
+    def release(self, *args):
+        self.fields.writing -= 1
+        self.write_lock.release()
+
+    __enter__ = acquire
+    __exit__ = release
+
+    def owns_lock(self):
+        return self.write_lock.owns_lock()
@@ -7,10 +7,15 @@ __license__   = 'GPL v3'
 __copyright__ = '2011, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
+import sys, time
+from array import array
 from datetime import datetime, timedelta
-from collections import defaultdict
+from collections import defaultdict, MutableMapping
+from threading import RLock
 
 from calibre.constants import plugins
+from calibre.utils.config_base import tweaks
+from calibre.utils.monotonic import monotonic
 from calibre.utils.date import parse_date, UNDEFINED_DATE, utc_tz
 from calibre.ebooks.metadata import author_to_author_sort
 
@@ -47,8 +52,266 @@ ONE_ONE, MANY_ONE, MANY_MANY = xrange(3)
 null = object()
 
 
+class LazyLoader(object):
+
+    '''
+    Reads tables from the database the first time any of their data is
+    accessed, instead of reading everything up front. Also records how long
+    reading each table took, for diagnosing slow startup.
+    '''
+
+    def __init__(self, db):
+        self.db = db
+        self.lock = RLock()
+        self.load_times = {}
+
+    def attach(self, table):
+        table.__dict__['lazy_loader'] = self
+
+    def load(self, table):
+        with self.lock:
+            if table.__dict__.get('lazy_loader') is not self:
+                # Another thread loaded the table while we were waiting for
+                # the lock
+                return
+            st = monotonic()
+            # Read into a private copy of the table and publish the data only
+            # once it is complete. Other threads take the lock only when a
+            # data attribute is missing, so they must never see partially
+            # built maps.
+            staging = object.__new__(table.__class__)
+            staging.__dict__.update(table.__dict__)
+            del staging.__dict__['lazy_loader']
+            with self.db.conn:
+                staging.read(self.db)
+            table.__dict__.update(staging.__dict__)
+            del table.__dict__['lazy_loader']
+            self.load_times[table.name] = monotonic() - st
+
+
+# Compact storage for one-to-one tables {{{
+
+# The state of each slot in a CompactMap
+ABSENT, NONE, OVERFLOW, FLOAT, INT, BOOL, DATE, OBJECT = xrange(8)
+EPOCH = datetime(1970, 1, 1, tzinfo=utc_tz)
+MAX_EXACT_INT = 2**53
+
+
+class CompactMap(MutableMapping):
+
+    '''
+    A replacement for the book_id -> value dict used by one-to-one tables,
+    that uses a small fraction of the memory. Values are stored in a typed
+    array (or for text, a list) indexed directly by book_id, with a parallel
+    bytearray recording the type of each value, so that the values returned
+    are identical to the ones stored. Values that cannot be represented
+    exactly (for example, naive datetimes) are stored in an ordinary dict.
+
+    kind must be one of 'number', 'date' or 'object'.
+    '''
+
+    def __init__(self, kind, items=(), intern_values=False):
+        self.kind = kind
+        self.values = [] if kind == 'object' else array(b'd')
+        self.state = bytearray()
+        self.overflow = {}
+        self.count = 0
+        if intern_values:
+            pool = {}
+            for k, v in items:
+                try:
+                    v = pool.setdefault(v, v)
+                except TypeError:
+                    pass
+                self[k] = v
+        else:
+            self.update(items)
+
+    def _grow(self, book_id):
+        extra = max(book_id + 1, int(len(self.state) * 1.5) + 64) - len(self.state)
+        self.state.extend(bytearray(extra))
+        if self.kind == 'object':
+            self.values.extend([None] * extra)
+        else:
+            self.values.extend(array(b'd', [0.0]) * extra)
+
+    def _decode(self, book_id, state):
+        if state == OBJECT or state == FLOAT:
+            return self.values[book_id]
+        if state == DATE:
+            return EPOCH + timedelta(seconds=self.values[book_id])
+        if state == INT:
+            return int(self.values[book_id])
+        if state == NONE:
+            return None
+        if state == BOOL:
+            return self.values[book_id] != 0
+        return self.overflow[book_id]
+
+    def _encode(self, val):
+        if val is None:
+            return NONE, None
+        kind = self.kind
+        if kind == 'object':
+            return OBJECT, val
+        t = type(val)
+        if kind == 'number':
+            if t is float:
+                return FLOAT, val
+            if t is bool:
+                return BOOL, 1.0 if val else 0.0
+            if (t is int or t is long) and -MAX_EXACT_INT < val < MAX_EXACT_INT:
+                return INT, float(val)
+        elif kind == 'date' and t is datetime and val.utcoffset() is not None:
+            d = val - EPOCH
+            x = d.days * 86400 + d.seconds + d.microseconds / 1e6
+            if EPOCH + timedelta(seconds=x) == val:
+                return DATE, x
+        return OVERFLOW, val
+
+    def __getitem__(self, book_id):
+        try:
+            state = self.state[book_id]
+        except (IndexError, TypeError):
+            raise KeyError(book_id)
+        if state == ABSENT or book_id < 0:
+            raise KeyError(book_id)
+        return self._decode(book_id, state)
+
+    def get(self, book_id, default=None):
+        try:
+            state = self.state[book_id]
+        except (IndexError, TypeError):
+            return default
+        if state == ABSENT or book_id < 0:
+            return default
+        return self._decode(book_id, state)
+
+    def __setitem__(self, book_id, val):
+        if book_id < 0:
+            raise KeyError(book_id)
+        if book_id >= len(self.state):
+            self._grow(book_id)
+        old = self.state[book_id]
+        if old == ABSENT:
+            self.count += 1
+        elif old == OVERFLOW:
+            del self.overflow[book_id]
+        state, x = self._encode(val)
+        self.state[book_id] = state
+        if state == OVERFLOW:
+            self.overflow[book_id] = val
+        elif x is not None:
+            self.values[book_id] = x
+        elif self.kind == 'object':
+            self.values[book_id] = None
+
+    def __delitem__(self, book_id):
+        try:
+            state = self.state[book_id]
+        except (IndexError, TypeError):
+            raise KeyError(book_id)
+        if state == ABSENT or book_id < 0:
+            raise KeyError(book_id)
+        self.state[book_id] = ABSENT
+        self.count -= 1
+        if state == OVERFLOW:
+            del self.overflow[book_id]
+        elif self.kind == 'object':
+            self.values[book_id] = None
+
+    def pop(self, book_id, *default):
+        try:
+            ans = self[book_id]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[book_id]
+        return ans
+
+    def __contains__(self, book_id):
+        try:
+            return self.state[book_id] != ABSENT and book_id >= 0
+        except (IndexError, TypeError):
+            return False
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for book_id, state in enumerate(self.state):
+            if state != ABSENT:
+                yield book_id
+    iterkeys = __iter__
+
+    def itervalues(self):
+        decode = self._decode
+        for book_id, state in enumerate(self.state):
+            if state != ABSENT:
+                yield decode(book_id, state)
+
+    def iteritems(self):
+        decode = self._decode
+        for book_id, state in enumerate(self.state):
+            if state != ABSENT:
+                yield book_id, decode(book_id, state)
+
+    def clear(self):
+        self.__init__(self.kind)
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def __copy__(self):
+        # Unlike copy(), keeps the compact storage
+        ans = CompactMap.__new__(CompactMap)
+        ans.kind, ans.count = self.kind, self.count
+        ans.values, ans.state, ans.overflow = self.values[:], bytearray(self.state), self.overflow.copy()
+        return ans
+
+    def __sizeof__(self):
+        ans = object.__sizeof__(self) + sys.getsizeof(self.values) + sys.getsizeof(self.state) + data_size(self.overflow)
+        if self.kind == 'object':
+            seen = set()
+            for x in self.values:
+                if x is not None and id(x) not in seen:
+                    seen.add(id(x))
+                    ans += sys.getsizeof(x)
+        return ans
+
+    def __repr__(self):
+        return 'CompactMap(%r, %r)' % (self.kind, self.copy())
+
+
+def create_book_col_map(metadata, items):
+    ''' Create the book_id -> value map for a one-to-one table, using compact
+    storage unless disabled by the newdb_compact_tables tweak. '''
+    if not tweaks.get('newdb_compact_tables', True):
+        return dict(items)
+    kind = {'datetime': 'date', 'int': 'number', 'float': 'number', 'bool': 'number',
+            'rating': 'number'}.get(metadata['datatype'], 'object')
+    return CompactMap(kind, items, intern_values=kind == 'object')
+# }}}
+
+
+def data_size(obj):
+    ' Approximate number of bytes used by obj and the containers/strings inside it '
+    ans = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.iteritems():
+            ans += data_size(k) + data_size(v)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for x in obj:
+            ans += data_size(x)
+    return ans
+
+
 class Table(object):
 
+    # The names of the attributes set by read()
+    data_attributes = frozenset()
+
     def __init__(self, name, metadata, link_table=None):
         self.name, self.metadata = name, metadata
         self.sort_alpha = metadata.get('is_multiple', False) and metadata.get('display', {}).get('sort_alpha', False)
@@ -65,6 +328,25 @@ class Table(object):
         self.link_table = (link_table if link_table else
                 'books_%s_link'%self.metadata['table'])
 
+    def __getattr__(self, name):
+        # Only called when normal attribute lookup fails, for a lazily loaded
+        # table that means the data attributes have not been read yet.
+        loader = self.__dict__.get('lazy_loader')
+        if loader is None or name not in self.data_attributes:
+            raise AttributeError(name)
+        loader.load(self)
+        return object.__getattribute__(self, name)
+
+    @property
+    def is_loaded(self):
+        return 'lazy_loader' not in self.__dict__
+
+    def memory_usage(self):
+        ''' Approximate memory used by the in-memory data of this table, in
+        bytes. Does not cause a lazily loaded table to be read. '''
+        return sum(data_size(v) for k, v in self.__dict__.iteritems()
+                   if k not in {'metadata', 'lazy_loader'} and isinstance(v, (dict, list, tuple, set, CompactMap)))
+
     def remove_books(self, book_ids, db):
         return set()
 
@@ -100,6 +382,7 @@ class OneToOneTable(Table):
     '''
 
     table_type = ONE_ONE
+    data_attributes = frozenset(('book_col_map',))
 
     def read(self, db):
         idcol = 'id' if self.metadata['table'] == 'books' else 'book'
@@ -107,16 +390,16 @@ class OneToOneTable(Table):
             self.metadata['column'], self.metadata['table']))
         if self.unserialize is None:
             try:
-                self.book_col_map = dict(query)
+                self.book_col_map = create_book_col_map(self.metadata, query)
             except UnicodeDecodeError:
                 # The db is damaged, try to work around it by ignoring
                 # failures to decode utf-8
                 query = db.execute('SELECT {0}, cast({1} as blob) FROM {2}'.format(idcol,
                     self.metadata['column'], self.metadata['table']))
-                self.book_col_map = {k:bytes(val).decode('utf-8', 'replace') for k, val in query}
+                self.book_col_map = create_book_col_map(self.metadata, ((k, bytes(val).decode('utf-8', 'replace')) for k, val in query))
         else:
             us = self.unserialize
-            self.book_col_map = {book_id:us(val) for book_id, val in query}
+            self.book_col_map = create_book_col_map(self.metadata, ((book_id, us(val)) for book_id, val in query))
 
     def remove_books(self, book_ids, db):
         clean = set()
@@ -141,7 +424,7 @@ class SizeTable(OneToOneTable):
         query = db.execute(
             'SELECT books.id, (SELECT MAX(uncompressed_size) FROM data '
             'WHERE data.book=books.id) FROM books')
-        self.book_col_map = dict(query)
+        self.book_col_map = create_book_col_map(self.metadata, query)
 
     def update_sizes(self, size_map):
         self.book_col_map.update(size_map)
@@ -149,6 +432,8 @@ class SizeTable(OneToOneTable):
 
 class UUIDTable(OneToOneTable):
 
+    data_attributes = OneToOneTable.data_attributes | {'uuid_to_id_map'}
+
     def read(self, db):
         OneToOneTable.read(self, db)
         self.uuid_to_id_map = {v:k for k, v in self.book_col_map.iteritems()}
@@ -173,6 +458,9 @@ class UUIDTable(OneToOneTable):
 
 class CompositeTable(OneToOneTable):
 
+    data_attributes = OneToOneTable.data_attributes | {
+        'composite_template', 'contains_html', 'make_category', 'composite_sort', 'use_decorations'}
+
     def read(self, db):
         self.book_col_map = {}
         d = self.metadata['display']
@@ -196,6 +484,7 @@ class ManyToOneTable(Table):
     '''
 
     table_type = MANY_ONE
+    data_attributes = frozenset(('id_map', 'col_book_map', 'book_col_map'))
 
     def read(self, db):
         self.id_map = {}
@@ -525,6 +814,8 @@ class ManyToManyTable(ManyToOneTable):
 
 class AuthorsTable(ManyToManyTable):
 
+    data_attributes = ManyToManyTable.data_attributes | {'alink_map', 'asort_map'}
+
     def read_id_maps(self, db):
         self.alink_map = lm = {}
         self.asort_map = sm = {}
@@ -578,6 +869,7 @@ class AuthorsTable(ManyToManyTable):
 class FormatsTable(ManyToManyTable):
 
     do_clean_on_remove = False
+    data_attributes = ManyToManyTable.data_attributes | {'fname_map', 'size_map', 'digest_map', 'changed_map'}
 
     def read_id_maps(self, db):
         pass
@@ -588,24 +880,31 @@ class FormatsTable(ManyToManyTable):
     def read_maps(self, db):
         self.fname_map = fnm = defaultdict(dict)
         self.size_map = sm = defaultdict(dict)
+        self.digest_map = dm = defaultdict(dict)
+        self.changed_map = chm = defaultdict(dict)
         self.col_book_map = cbm = defaultdict(set)
         bcm = defaultdict(list)
 
-        for book, fmt, name, sz in db.execute('SELECT book, format, name, uncompressed_size FROM data'):
+        for book, fmt, name, sz, digest, dsz, dmtime, changed in db.execute(
+                'SELECT book, format, name, uncompressed_size, digest, digest_size, digest_mtime, changed FROM data'):
             if fmt is not None:
                 fmt = fmt.upper()
                 cbm[fmt].add(book)
                 bcm[book].append(fmt)
                 fnm[book][fmt] = name
                 sm[book][fmt] = sz
+                if digest is not None:
+                    dm[book][fmt] = (digest, dsz, dmtime)
+                if changed:
+                    chm[book][fmt] = changed
 
         self.book_col_map = {k:tuple(sorted(v)) for k, v in bcm.iteritems()}
 
     def remove_books(self, book_ids, db):
         clean = ManyToManyTable.remove_books(self, book_ids, db)
         for book_id in book_ids:
-            self.fname_map.pop(book_id, None)
-            self.size_map.pop(book_id, None)
+            for m in (self.fname_map, self.size_map, self.digest_map, self.changed_map):
+                m.pop(book_id, None)
         return clean
 
     def set_fname(self, book_id, fmt, fname, db):
@@ -616,7 +915,7 @@ class FormatsTable(ManyToManyTable):
     def remove_formats(self, formats_map, db):
         for book_id, fmts in formats_map.iteritems():
             self.book_col_map[book_id] = [fmt for fmt in self.book_col_map.get(book_id, []) if fmt not in fmts]
-            for m in (self.fname_map, self.size_map):
+            for m in (self.fname_map, self.size_map, self.digest_map, self.changed_map):
                 m[book_id] = {k:v for k, v in m[book_id].iteritems() if k not in fmts}
             for fmt in fmts:
                 try:
@@ -640,7 +939,30 @@ class FormatsTable(ManyToManyTable):
     def rename_item(self, item_id, new_name, db):
         raise NotImplementedError('Cannot rename formats')
 
-    def update_fmt(self, book_id, fmt, fname, size, db):
+    def set_digest(self, book_id, fmt, digest, new_content=False):
+        ''' Store digest, a tuple of (sha256, size, mtime) or None if the
+        contents of the format changed and the digest is not known. The change
+        time is updated if the contents changed, returns the values for the
+        digest and changed columns. '''
+        old = self.digest_map[book_id].get(fmt)
+        if digest is None or (old[0] != digest[0] if old is not None else new_content):
+            self.changed_map[book_id][fmt] = time.time()
+        if digest is None:
+            self.digest_map[book_id].pop(fmt, None)
+        else:
+            self.digest_map[book_id][fmt] = digest
+        return (digest or (None, None, None)) + (self.changed_map[book_id].get(fmt, 0),)
+
+    def update_digests(self, digest_map, db, new_content=False):
+        ''' Store the digests in digest_map, a mapping of (book_id, fmt) to
+        digest, see set_digest() '''
+        vals = []
+        for (book_id, fmt), digest in digest_map.iteritems():
+            if fmt in self.fname_map.get(book_id, {}):
+                vals.append(self.set_digest(book_id, fmt, digest, new_content) + (book_id, fmt))
+        db.executemany('UPDATE data SET digest=?,digest_size=?,digest_mtime=?,changed=? WHERE book=? AND format=?', vals)
+
+    def update_fmt(self, book_id, fmt, fname, size, db, digest=None):
         fmts = list(self.book_col_map.get(book_id, []))
         try:
             fmts.remove(fmt)
@@ -656,8 +978,12 @@ class FormatsTable(ManyToManyTable):
 
         self.fname_map[book_id][fmt] = fname
         self.size_map[book_id][fmt] = size
-        db.execute('INSERT OR REPLACE INTO data (book,format,uncompressed_size,name) VALUES (?,?,?,?)',
-                        (book_id, fmt, size, fname))
+        if digest is None:
+            dvals = (self.digest_map[book_id].get(fmt) or (None, None, None)) + (self.changed_map[book_id].get(fmt, 0),)
+        else:
+            dvals = self.set_digest(book_id, fmt, digest, new_content=True)
+        db.execute('INSERT OR REPLACE INTO data (book,format,uncompressed_size,name,digest,digest_size,digest_mtime,changed) VALUES (?,?,?,?,?,?,?,?)',
+                        (book_id, fmt, size, fname) + dvals)
         return max(self.size_map[book_id].itervalues())
 
 
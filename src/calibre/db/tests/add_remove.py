@@ -103,6 +103,71 @@ class AddRemoveTest(BaseTest):
 
     # }}}
 
+    def test_format_digests(self):  # {{{
+        'Test the stored hashes of formats and change detection'
+        import hashlib, time
+        ae, at = self.assertEqual, self.assertTrue
+        cache = self.init_cache()
+        table = cache.fields['formats'].table
+        NF = b'test_format_digestsxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx'
+        sha = lambda raw: hashlib.sha256(raw).hexdigest()
+
+        # Hashes of existing formats are computed by the background pass
+        ae(cache.formats_changed_since(0), {})
+        ae(cache.update_format_digests(), sum(len(cache.formats(book_id)) for book_id in cache.all_book_ids()))
+        ae(cache.update_format_digests(), 0)
+        ae(cache.format_hash(1, 'FMT1'), sha(cache.format(1, 'FMT1')))
+        ae(cache.formats_changed_since(0), {})
+
+        # Adding a format stores its hash and records the change
+        stamp = time.time() - 1
+        at(cache.add_format(1, 'FMT1', BytesIO(NF)))
+        ae(table.digest_map[1]['FMT1'][0], sha(NF))
+        ae(cache.format_hash(1, 'fmt1'), sha(NF))
+        ae(cache.formats_changed_since(stamp), {1:{'FMT1'}})
+        ae(cache.formats_changed_since(stamp, book_ids=(2,)), {})
+        ae(cache.formats_changed_since(time.time() + 1), {})
+
+        # Replacing a format with the same contents is not a change
+        table.changed_map[1]['FMT1'] = stamp
+        at(cache.add_format(1, 'FMT1', BytesIO(NF)))
+        ae(cache.formats_changed_since(stamp), {})
+
+        # Changes to the file are detected when the hash is computed again
+        path = cache.format_abspath(2, 'FMT1')
+        with open(path, 'ab') as f:
+            f.write(b'changed')
+        os.utime(path, (1, 1))
+        ae(cache.update_format_digests(book_ids=(1, 2)), 1)
+        ae(cache.format_hash(2, 'FMT1'), sha(cache.format(2, 'FMT1')))
+        ae(cache.formats_changed_since(stamp), {2:{'FMT1'}})
+
+        # The hashes are persisted
+        cache = self.init_cache()
+        table = cache.fields['formats'].table
+        ae(table.digest_map[1]['FMT1'][0], sha(NF))
+        ae(cache.formats_changed_since(stamp), {2:{'FMT1'}})
+        ae(cache.update_format_digests(), 0)
+
+        # Hashes computed by format_hash() are stored later, by the backup
+        # thread, which also hashes all formats periodically
+        from calibre.db.backup import MetadataBackup
+        for fmt in ('FMT1', 'FMT2'):
+            path = cache.format_abspath(1, fmt)
+            with open(path, 'ab') as f:
+                f.write(b'changed')
+            os.utime(path, (2, 2))
+        ae(cache.format_hash(1, 'FMT1'), sha(cache.format(1, 'FMT1')))
+        ae(table.digest_map[1]['FMT1'][0], sha(NF))
+        MetadataBackup(cache).update_digests()
+        for fmt in ('FMT1', 'FMT2'):
+            ae(table.digest_map[1][fmt][0], sha(cache.format(1, fmt)))
+        ae(cache.store_pending_format_digests(), 0)
+        ae(cache.update_format_digests(), 0)
+        cache.remove_formats({2:('FMT1',)})
+        ae(cache.formats_changed_since(stamp), {})
+    # }}}
+
     def test_remove_formats(self):  # {{{
         'Test removal of formats from book records'
         af, ae, at = self.assertFalse, self.assertEqual, self.assertTrue
@@ -209,6 +274,51 @@ class AddRemoveTest(BaseTest):
         self.assertEqual(cache.format(book_id, 'FMT2'), FMT2)
     # }}}
 
+    def test_recursive_import(self):  # {{{
+        'Test importing a directory tree of books in batches'
+        from calibre.db.adding import ImportStats, compile_rule, recursive_import
+        from calibre.ptempfile import TemporaryDirectory
+        cache = self.init_cache()
+        titles = set(cache.all_field_for('title', cache.all_book_ids()).itervalues())
+        with TemporaryDirectory('_test_import') as tdir:
+            for i, title in enumerate(('Imported One', 'Imported Two', 'Imported Three', 'Title One')):
+                dirpath = os.path.join(tdir, 'd%d' % (i % 2), 'b%d' % i)
+                os.makedirs(dirpath)
+                for fmt in ('txt', 'rtf'):
+                    with open(os.path.join(dirpath, '%s - Some Author.%s' % (title, fmt)), 'wb') as f:
+                        f.write(b'{\\rtf1 some text}' if fmt == 'rtf' else b'some text')
+            os.mkdir(os.path.join(tdir, 'd1', 'skip'))
+            with open(os.path.join(tdir, 'd1', 'skip', 'Skipped - Some Author.txt'), 'wb') as f:
+                f.write(b'some text')
+            added_ids, stats, seen = set(), ImportStats(), []
+            duplicates = recursive_import(
+                cache, tdir, added_ids=added_ids, max_workers=0, stats=stats, callback=seen.append,
+                compiled_rules=(compile_rule({'match_type':'startswith', 'query':'skipped', 'action':'ignore'}),))
+            self.assertEqual([mi.title for mi, formats in duplicates], ['Title One'])
+            self.assertEqual(len(added_ids), 3)
+            self.assertEqual(sorted(seen), ['Imported One', 'Imported Three', 'Imported Two', 'Title One'])
+            for book_id in added_ids:
+                self.assertEqual(set(cache.formats(book_id)), {'TXT', 'RTF'})
+                self.assertEqual(cache.field_for('authors', book_id), ('Some Author',))
+            self.assertEqual(set(cache.all_field_for('title', cache.all_book_ids()).itervalues()) - titles, set(seen) - {'Title One'})
+            self.assertEqual((stats.counts['scan'], stats.counts['read'], stats.counts['add'], stats.duplicates), (4, 4, 3, 1))
+
+            # Aborting stops the import before the next book is read
+            added_ids, stats = set(), ImportStats()
+            recursive_import(cache, tdir, added_ids=added_ids, max_workers=0, stats=stats, add_duplicates=True, callback=lambda title: True)
+            self.assertEqual((len(added_ids), stats.counts['scan']), (0, 1))
+
+            # Books already in the library are not added again
+            added_ids = set()
+            duplicates = recursive_import(cache, tdir, added_ids=added_ids, max_workers=0, single_book_per_directory=False)
+            self.assertEqual(len(added_ids), 1)
+            self.assertTrue(cache.field_for('title', next(iter(added_ids))).startswith('Skipped'))
+            self.assertEqual(len(duplicates), 4)
+            added_ids = set()
+            duplicates = recursive_import(cache, tdir, added_ids=added_ids, max_workers=0, add_duplicates=True)
+            self.assertEqual((len(added_ids), duplicates), (5, []))
+    # }}}
+
     def test_remove_books(self):  # {{{
         'Test removal of books'
         cl = self.cloned_library
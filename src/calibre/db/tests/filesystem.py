@@ -170,6 +170,100 @@ class FilesystemTest(BaseTest):
                         self.assertEqual(cache.format(book_id, fmt), ic.format(book_id, fmt))
                         self.assertEqual(cache.format_metadata(book_id, fmt)['mtime'], cache.format_metadata(book_id, fmt)['mtime'])
 
+    def test_check_library(self):
+        from calibre.library.check_library import CheckLibrary
+        db = self.init_legacy()
+        cache = db.new_api
+        # Listings of folders modified in the last few seconds are not stored
+        for dirpath, dirnames, filenames in os.walk(self.library_path):
+            os.utime(dirpath, (1, 1))
+        with TemporaryDirectory('check_library') as tdir:
+            state_path = os.path.join(tdir, 'state.pickle')
+
+            def check(incremental=True, **kw):
+                checker = CheckLibrary(self.library_path, db)
+                checker.scan_library([], [], state_path=state_path if incremental else None, **kw)
+                return checker
+
+            c = check()
+            self.assertFalse(c.extra_files or c.missing_formats or c.extra_titles or c.failed_folders)
+            self.assertGreater(c.folders_listed, len(cache.all_book_ids()))
+            self.assertEqual(c.folders_reused, 0)
+            listed = c.folders_listed
+            c = check(max_workers=1)
+            self.assertGreaterEqual(c.folders_reused, listed - 1)
+
+            # A changed folder is listed again
+            path = os.path.dirname(cache.format_abspath(1, 'FMT1'))
+            open(os.path.join(path, 'extra.xyz'), 'wb').close()
+            c = check()
+            self.assertEqual([os.path.basename(x[1]) for x in c.extra_files], ['extra.xyz'])
+            self.assertEqual(c.extra_files, check(incremental=False).extra_files)
+            self.assertGreaterEqual(c.folders_reused, listed - 2)
+
+            # Formats whose contents no longer match their stored hash are reported
+            cache.update_format_digests()
+            self.assertFalse(check(incremental=False).changed_formats)
+            path = cache.format_abspath(2, 'FMT1')
+            with open(path, 'ab') as f:
+                f.write(b'changed')
+            os.utime(path, (2, 2))
+            c = check(incremental=False)
+            self.assertEqual([(os.path.basename(x[1]), x[2]) for x in c.changed_formats], [(os.path.basename(path), 2)])
+            self.assertFalse(check(incremental=False).changed_formats)
+            # Incremental checks report the changes since the previous check
+            self.assertEqual(check().changed_formats, c.changed_formats)
+            self.assertFalse(check().changed_formats)
+        db.close()
+
+    def test_restore(self):
+        from calibre.db.restore import Restore
+        cache = self.init_cache()
+        cache.dump_metadata(cache.all_book_ids())
+        titles = {book_id:cache.field_for('title', book_id) for book_id in cache.all_book_ids()}
+        cache.close()
+
+        class Interrupted(Exception):
+            pass
+
+        def interrupt(msg, step):
+            if msg in titles.itervalues() and step == 2:
+                raise Interrupted()
+
+        with TemporaryDirectory('restore') as tdir:
+            checkpoint_dir = os.path.join(tdir, 'checkpoint')
+            r = Restore(self.library_path, progress_callback=interrupt, max_workers=0, batch_size=1, checkpoint_dir=checkpoint_dir)
+            r.run()
+            self.assertIn('Interrupted', r.tb)
+            self.assertTrue(os.path.exists(checkpoint_dir))
+            r = Restore(self.library_path, max_workers=0, batch_size=1, checkpoint_dir=checkpoint_dir)
+            r.run()
+            self.assertIsNone(r.tb)
+            self.assertTrue(r.resumed)
+            self.assertEqual(len(r.restored_ids), 1)
+            self.assertEqual(r.successes, len(titles))
+            self.assertFalse(os.path.exists(checkpoint_dir))
+        cache = self.init_cache()
+        self.assertEqual(titles, {book_id:cache.field_for('title', book_id) for book_id in cache.all_book_ids()})
+        cache.close()
+
+        # Read the book folders in worker processes, a folder at a time
+        with TemporaryDirectory('restore') as tdir:
+            checkpoint_dir = os.path.join(tdir, 'checkpoint')
+            r = Restore(self.library_path, progress_callback=interrupt, max_workers=1, chunk_size=1, batch_size=1, checkpoint_dir=checkpoint_dir)
+            r.run()
+            self.assertIn('Interrupted', r.tb)
+            self.assertFalse(r.failed_dirs)
+            r = Restore(self.library_path, max_workers=1, chunk_size=1, batch_size=1, checkpoint_dir=checkpoint_dir)
+            r.run()
+            self.assertIsNone(r.tb)
+            self.assertTrue(r.resumed)
+            self.assertFalse(r.failed_dirs)
+            self.assertEqual(len(r.restored_ids), 1)
+            self.assertEqual(r.successes, len(titles))
+        cache = self.init_cache()
+        self.assertEqual(titles, {book_id:cache.field_for('title', book_id) for book_id in cache.all_book_ids()})
+
     def test_find_books_in_directory(self):
         from calibre.db.adding import find_books_in_directory, compile_rule
         strip = lambda files: frozenset({os.path.basename(x) for x in files})
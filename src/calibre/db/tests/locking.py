@@ -178,3 +178,51 @@ class TestLock(BaseTest):
         self.assertEqual(len(done), len(threads), 'SHLock locking failed')
         self.assertFalse(lock.is_shared)
         self.assertFalse(lock.is_exclusive)
+
+    def test_policies(self):
+        def acquire_order(lock):
+            order, concurrent = [], []
+
+            def get_lock(name, shared):
+                lock.acquire(shared=shared)
+                order.append(name)
+                concurrent.append(lock.is_shared)
+                time.sleep(0.1)
+                lock.release()
+
+            lock.acquire(shared=False)
+            threads = []
+            for name, shared in (('r1', True), ('r2', True), ('r3', True), ('w', False)):
+                t = Thread(target=get_lock, args=(name, shared))
+                t.daemon = True
+                t.start()
+                threads.append(t)
+                time.sleep(0.05)
+            lock.release()
+            for t in threads:
+                t.join(5)
+            self.assertFalse([t for t in threads if t.is_alive()], 'SHLock hung')
+            self.assertFalse(lock.is_shared)
+            self.assertFalse(lock.is_exclusive)
+            return order, max(concurrent)
+
+        order, concurrent = acquire_order(SHLock())
+        self.assertEqual(order[-1], 'w')
+        self.assertEqual(concurrent, 3)
+        order, concurrent = acquire_order(SHLock(prefer_writers=True))
+        self.assertEqual(order[0], 'w')
+        order, concurrent = acquire_order(SHLock(max_reader_batch=1))
+        self.assertEqual(order, ['r1', 'w', 'r2', 'r3'])
+        self.assertEqual(concurrent, 1)
+
+    def test_lock_stats(self):
+        cache = self.init_cache()
+        cache.lock_statistics(enable=True)
+        cache.all_book_ids()
+        cache.set_field('title', {1: 'x'})
+        self.assertIn('set_field: 1 calls', str(cache.lock_stats))
+        stats = cache.lock_statistics(enable=False, clear=True)
+        self.assertEqual(stats['all_book_ids']['calls'], 1)
+        self.assertEqual(sum(stats['set_field']['hold']['histogram']), 1)
+        cache.all_book_ids()
+        self.assertEqual(cache.lock_statistics(), {})
@@ -214,6 +214,39 @@ class ReadingTest(BaseTest):
         ae([5, 4, 3, 2, 1, 10, 9, 8, 7, 6], cache.multisort([('#one', True), ('#two', False), ('#three', False)], ids_to_sort=sorted(cache.all_book_ids())))
     # }}}
 
+    def test_sort_index(self):  # {{{
+        'Test that the precomputed sort orders are kept up to date'
+        from calibre.ebooks.metadata.book.base import Metadata
+        cache = self.init_cache()
+        ae = self.assertEqual
+        fields = ('title', 'authors', 'series', 'tags', 'rating', 'timestamp', 'languages', '#series', '#float', 'size', 'id')
+        for field in fields:
+            cache.multisort([(field, True)])
+        ae(set(fields) - {'id'}, set(cache.sort_indices))
+        ae(cache.multisort([('ondevice', True)]), cache.multisort([('ondevice', True)]))
+        self.assertNotIn('ondevice', cache.sort_indices)
+        cache.set_field('title', {1:'Zzz', 3:'Aaa'})
+        cache.set_field('series', {2:'Aaa'})
+        cache.set_field('#float', {1:-1.0})
+        cache.set_field('languages', {3:('deu',)})
+        cache.rename_items('tags', {cache.get_item_id('tags', 'Tag One'):'Aaa'})
+        cache.add_format(3, 'FMT1', BytesIO(b'a'*1000), run_hooks=False)
+        cache.create_book_entry(Metadata('Mmm', ['Author Two']), apply_import_tags=False)
+        cache.remove_books((2,))
+        fresh = self.init_cache()
+        for field in fields:
+            for order in (True, False):
+                ae(cache.multisort([(field, order)]), fresh.multisort([(field, order)]), field)
+        for sort in ([('series', True), ('title', False)], [('rating', False), ('tags', True), ('authors', True)],
+                     [('ondevice', True), ('title', True)], [('title', True), ('ondevice', False)]):
+            ae(cache.multisort(sort), fresh.multisort(sort), sort)
+        ae(cache.multisort([('title', True)], ids_to_sort=(3, 1, 4)), [3, 4, 1])
+        ae(cache.multisort([('title', True)], ids_to_sort=(1, 3)), [3, 1])
+        ae(cache.multisort([('title', True)], ids_to_sort=(1, 3, 2)), fresh.multisort([('title', True)], ids_to_sort=(1, 3, 2)))
+        cache.clear_caches()
+        ae({}, cache.sort_indices)
+    # }}}
+
     def test_get_metadata(self):  # {{{
         'Test get_metadata() returns the same data for both backends'
         from calibre.library.database2 import LibraryDatabase2
@@ -518,14 +551,14 @@ class ReadingTest(BaseTest):
 
     def test_search_caching(self):  # {{{
         ' Test caching of searches '
-        from calibre.db.search import LRUCache
+        from calibre.db.search import ResultCache
 
-        class TestCache(LRUCache):
+        class TestCache(ResultCache):
             hit_counter = 0
             miss_counter = 0
 
             def get(self, key, default=None):
-                ans = LRUCache.get(self, key, default=default)
+                ans = ResultCache.get(self, key, default=default)
                 if ans is not None:
                     self.hit_counter += 1
                 else:
@@ -572,6 +605,133 @@ class ReadingTest(BaseTest):
         test(True, {2, 3}, 'title:=xxx or title:"=Title One"')
     # }}}
 
+    def test_search_result_cache(self):  # {{{
+        ' Test selective invalidation, size limits and warming of the search result cache '
+        cache = self.init_cache()
+        c = cache._search_api.cache
+        cache._search_api.MAX_CACHE_UPDATE = 0
+        for q in ('title:=xxx', 'tags:one', 'Unknown', 'series_sort:series'):
+            cache.search(q)
+        self.assertEqual(c.fields('title:=xxx'), {'title'})
+        self.assertIsNone(c.fields('Unknown'))
+        cache.set_field('tags', {3:'one'})
+        self.assertEqual(set(c.keys()), {'title:=xxx', 'series_sort:series'})
+        self.assertEqual(cache.search('tags:one'), {1, 2, 3})
+        cache.set_field('languages', {3:'eng'})
+        self.assertEqual(set(c.keys()), {'title:=xxx', 'tags:one'})
+        cache.set_field('title', {3:'xxx'})
+        self.assertEqual(cache.search('title:=xxx'), {3})
+        cache._search_api.MAX_CACHE_UPDATE = 100
+        cache.set_field('title', {2:'xxx'})
+        self.assertIn('title:=xxx', c.keys())
+        self.assertEqual(cache.search('title:=xxx'), {2, 3})
+        cache.remove_books((2,))
+        self.assertEqual(c.peek('title:=xxx'), {3})
+        self.assertEqual(c.num_ids, sum(len(c.peek(k)) for k in c.keys()))
+
+        c.clear()
+        c.max_ids = 2
+        cache.search('id:1 or id:3')
+        cache.search('id:3')
+        self.assertEqual(c.keys(), ['id:3'])
+        cache.search('id:>0')
+        self.assertEqual(c.keys(), ['id:>0'])
+
+        c.clear()
+        c.max_ids = 1000
+        cache.set_pref('virtual_libraries', {'1':'title:"=xxx"', '2':'not id:1'})
+        cache.saved_search_add('ss', 'id:1')
+        self.assertEqual(cache.warm_search_cache(), 2 + len(cache.saved_search_names()))
+        self.assertLessEqual({'title:"=xxx"', 'not id:1', 'search:"ss"'}, set(c.keys()))
+    # }}}
+
+    def test_search_text_index(self):  # {{{
+        ' Test that the text index used for searching does not change search results '
+        from calibre.ebooks.metadata.book.base import Metadata
+        cache = self.init_cache(self.cloned_library)
+        plain = self.init_cache(self.cloned_library)
+        plain._search_api.text_index = None
+        queries = ('title:one', 'title:"=title one"', 'title:itl', 'authors:author', 'authors:"=author one"',
+                   'tags:news', 'tags:"=.news"', 'series:ser', 'publisher:pub', '#tags:tag', 'one', 'unknown',
+                   'title:~one', 'tags:"..news"', 'nomatch', '#enum:one', '#series:ser')
+        for query in queries:
+            self.assertEqual(cache.search(query), plain.search(query), query)
+        ti = cache._search_api.text_index
+        self.assertIn('title', ti.field_indices)
+        # Ensure changes are reflected in the index
+        for c in (cache, plain):
+            c._search_api.MAX_CACHE_UPDATE = 0
+            c.set_field('title', {1:'Xylophone Concerto', 2:'Xylophone concerto é'})
+            c.set_field('tags', {3:('Instrument.Xylophone', 'Percussion')})
+            c.create_book_entry(Metadata('Another xylophone'))
+            c.remove_books((2,))
+        queries += ('xylophone', 'title:xylo', 'title:"=xylophone concerto"', 'tags:"=.xylophone"', 'title:concerto')
+        for query in queries:
+            self.assertEqual(cache.search(query), plain.search(query), query)
+        self.assertEqual(cache.search('xylophone'), {1, 3, 4})
+        self.assertFalse(ti.dirty)
+        ti.stale = 10**6
+        cache.set_field('title', {1:'Title One'})
+        self.assertEqual(cache.search('title:xylophone'), {4})
+        self.assertFalse(ti.field_indices.get('tags'))
+    # }}}
+
+    def test_search_columns(self):  # {{{
+        ' Test that searching date, number and yes/no fields using columns gives the same results '
+        from calibre.utils.date import UNDEFINED_DATE
+        cache = self.init_cache(self.cloned_library)
+        plain = self.init_cache(self.cloned_library)
+        plain._search_api.columns = None
+        queries = (
+            'date:9/6/2011', 'date:true', 'date:false', 'pubdate:1/9/2011', '#date:true', 'date:<100daysago',
+            'date:>9/6/2011', '#date:>9/1/2011', '#date:=2011', 'pubdate:<2010', 'pubdate:>=2011-09',
+            'pubdate:!=2011', 'timestamp:today', 'last_modified:thismonth', 'cover:false', 'cover:true',
+            '#float:>11', '#float:<1k', '#float:10.01', '#float:false', '#float:true', 'series_index:1',
+            'series_index:<3', 'size:>1', 'size:<1k', '#yesno:true', '#yesno:false', '#yesno:yes',
+            '#yesno:no', '#yesno:empty', 'rating:>2', 'id:>1',
+        )
+        for query in queries:
+            self.assertEqual(cache.search(query), plain.search(query), query)
+        self.assertIn('pubdate', cache._search_api.columns.columns)
+        for c in (cache, plain):
+            c._search_api.MAX_CACHE_UPDATE = 0
+            c.set_field('#float', {1:20.5, 2:None, 3:1.5})
+            c.set_field('pubdate', {3:UNDEFINED_DATE, 2:datetime.datetime(2009, 1, 1, tzinfo=utc_tz)})
+            c.set_field('#yesno', {1:None, 3:True})
+            c.remove_books((1,))
+        for query in queries:
+            self.assertEqual(cache.search(query), plain.search(query), query)
+        self.assertEqual(cache.search('#float:>1'), {3})
+        self.assertEqual(cache.search('#float:false'), {2})
+        self.assertEqual(cache.search('pubdate:false'), {3})
+    # }}}
+
+    def test_search_plan(self):  # {{{
+        ' Test that reordering the terms of a search does not change its results '
+        cache = self.init_cache()
+        sqp = cache._search_api.create_parser(cache)
+        sqp.all_book_ids = cache.all_book_ids(type=set)
+        tree = sqp.plan(sqp.parser.parse('title:"~^t" and (#float:>1 and tags:one)', sqp.locations))
+        self.assertEqual(tree[0], 'and')
+        self.assertEqual(tree[1], ['token', '#float', '>1'])
+        self.assertEqual(tree[2][2], ['token', 'title', '~^t'])
+        for query in (
+            'title:"~^t" and #float:>1 and tags:one', 'not title:"~^t" or #float:>1 or tags:=one',
+            '(title:"~^t" or #yesno:true) and not (authors:=unknown or #float:<1)', 'title:"Title One" #date:>2000',
+        ):
+            self.assertEqual(cache.search(query), sqp.evaluate(sqp.parser.parse(query, sqp.locations), cache.all_book_ids(type=set)), query)
+        ans = cache.explain_search('title:"~^t" and #float:>1', restriction='tags:one')
+        self.assertIn('Restriction:', ans)
+        self.assertIn('title:~^t', ans)
+        self.assertTrue(ans.endswith('Matches: %d' % len(cache.search('title:"~^t" and #float:>1', restriction='tags:one'))))
+        # Invalid terms are only an error if the terms before them in the
+        # query leave candidates for them
+        from calibre.utils.search_query_parser import ParseException
+        self.assertEqual(cache.search('title:"~^nomatch" and #date:garbage'), set())
+        self.assertRaises(ParseException, cache.search, 'title:"~^t" and #date:garbage')
+        self.assertEqual(cache.search('not title:"~^nomatch" or #date:garbage'), cache.all_book_ids())
+    # }}}
+
     def test_proxy_metadata(self):  # {{{
         ' Test the ProxyMetadata object used for composite columns '
         from calibre.ebooks.metadata.book.base import STANDARD_METADATA_FIELDS
@@ -678,8 +838,80 @@ class ReadingTest(BaseTest):
         self.assertEqual('FMT2', cache.field_for('#ccf', 1))
     # }}}
 
+    def test_composite_dependencies(self):  # {{{
+        ' Test that changes only clear the composite columns that depend on the changed fields '
+        cache = self.init_cache()
+        cache.create_custom_column('cpub', 'CC1', 'composite', False, display={'composite_template': '{publisher}'})
+        cache.create_custom_column('ctitle', 'CC2', 'composite', False, display={'composite_template': '{title:uppercase()}-{#cpub}'})
+        cache.create_custom_column('cprog', 'CC3', 'composite', False, display={'composite_template': "program: field('#tags')"})
+        cache.create_custom_column('cany', 'CC4', 'composite', False, display={'composite_template': "program: field(strcat('ta', 'gs'))"})
+        cache.create_custom_column('cassign', 'CC5', 'composite', False, display={
+            'composite_template': "program: a = field('#Tags'); assign(b, raw_list('author', ',')); strcat(a, b)"})
+        cache.create_custom_column('cfmt', 'CC6', 'composite', False, display={'composite_template': "{#tags:'strcat($, raw_field(\"series\"))'}"})
+        cache.create_custom_column('cnested', 'CC7', 'composite', False, display={'composite_template': '{title:{#tags}}'})
+        cache = self.init_cache()
+        self.assertEqual(cache.composite_fields('#cpub'), {'publisher'})
+        self.assertEqual(cache.composite_fields('#ctitle'), {'title', '#cpub', 'publisher'})
+        self.assertEqual(cache.composite_fields('#cprog'), {'#tags'})
+        self.assertIsNone(cache.composite_fields('#cany'))
+        self.assertEqual(cache.composite_fields('#cassign'), {'#tags', 'authors'})
+        self.assertEqual(cache.composite_fields('#cfmt'), {'#tags', 'series'})
+        self.assertIsNone(cache.composite_fields('#cnested'))
+        names = ('#cpub', '#ctitle', '#cprog', '#cany')
+        rendered = lambda: {n for n in names if 1 in cache.fields[n]._render_cache}
+        for name in names:
+            cache.field_for(name, 1)
+        cache.set_field('#tags', {1:'x'})
+        self.assertEqual(rendered(), {'#cpub', '#ctitle'})
+        self.assertEqual(cache.field_for('#cprog', 1), 'x')
+        cache.set_field('publisher', {1:'P'})
+        self.assertEqual(rendered(), {'#cprog'})
+        self.assertEqual(cache.field_for('#ctitle', 1), 'TITLE TWO-P')
+        self.assertEqual(cache.search('#ctitle:"=TITLE TWO-P"'), {1})
+        self.assertEqual(cache._search_api.cache.fields('#ctitle:"=TITLE TWO-P"'), {'#ctitle', 'title', '#cpub', 'publisher'})
+
+        # Test pre-rendering of cleared values
+        while cache.prerender_composites(1):
+            pass
+        self.assertEqual(rendered(), set(names))
+        self.assertEqual(cache.prerender_composites(), 0)
+
+        # A full clear drops the rendered values, they are not re-rendered
+        cache.clear_caches()
+        self.assertEqual(rendered(), set())
+        self.assertEqual(cache.prerender_composites(), 0)
+    # }}}
+
+    def test_compiled_templates(self):  # {{{
+        ' Test that compiled templates give the same results as the template interpreter '
+        from calibre.ebooks.metadata.book.formatter import SafeFormat
+        from calibre.utils.formatter import TemplateFormatter
+        cache = self.init_cache()
+        templates = (
+            '{title} - {authors}', '{series:|[|]}{series_index:0>5.2f}', '{tags:sublist(0,1,\\,)}', '{title:test(a)}',
+            "{title:'uppercase($)'}", "{:'strcat(field(\"title\"), \"x\")'}", '{title:nosuch()}', '{title', '{title:{series}}',
+            '{#tags:re(One\\,x,Two)}', "program: a = field('title'); strcat(a, '-', a)", 'program: nosuchvar',
+            'program: nosuchfunc(1)', 'program: strcat(1,2', 'program: add(1)', 'program: assign(x, 3); x', 'program: ;',
+            "program: first_non_empty(field('#series'), 'x'); field('#tags')",
+        )
+        try:
+            for template in templates:
+                for book_id in cache.all_book_ids():
+                    results = []
+                    for compiled in (False, True, True):
+                        TemplateFormatter.compile_templates = compiled
+                        mi = cache.get_metadata(book_id)
+                        results.append(SafeFormat().safe_format(template, mi, 'TEMPLATE ERROR', mi))
+                    self.assertEqual(len(set(results)), 1, 'The template %r gave different results: %r' % (template, results))
+        finally:
+            TemplateFormatter.compile_templates = True
+        self.assertTrue(TemplateFormatter.compiled_programs[' nosuchvar'])
+        self.assertIs(TemplateFormatter.compiled_programs[' ;'], False)
+    # }}}
+
     def test_find_identical_books(self):  # {{{
         ' Test find_identical_books '
+        import cPickle
         from calibre.ebooks.metadata.book.base import Metadata
         from calibre.db.utils import find_identical_books
         # 'find_identical_books': [(,), (Metadata('unknown'),), (Metadata('xxxx'),)],
@@ -698,6 +930,30 @@ class ReadingTest(BaseTest):
         ):
             self.assertEqual(books, cache.find_identical_books(mi))
             self.assertEqual(books, find_identical_books(mi, data))
+        self.assertEqual(cache.find_identical_books(Metadata('title one', ['author one']), book_ids={1, 3}), set())
+        self.assertEqual(cache.find_identical_books(Metadata('title one', ['author one']), search_restriction='id:2'), {2})
+
+        # The index is updated when books change
+        self.assertEqual(cache.find_duplicate_books(), [])
+        cache.set_field('title', {3: 'The Title One'})
+        cache.set_field('authors', {3: ['Author One']})
+        self.assertEqual(cache.find_identical_books(Metadata('title one', ['author one'])), {2, 3})
+        self.assertEqual(cache.find_duplicate_books(), [{2, 3}])
+        self.assertTrue(cache.has_book(Metadata('the title one')))
+        self.assertFalse(cache.has_book(Metadata(_('Unknown'))))
+        cache.set_field('languages', {2: ('eng',), 3: ('fra',)})
+        self.assertEqual(cache.find_duplicate_books(), [])
+        cache.remove_books((3,))
+        self.assertEqual(cache.find_identical_books(Metadata('title one', ['author one'])), {2})
+        book_id = cache.add_books([(Metadata('Title One', ['Author One']), {})])[0][0]
+        self.assertEqual(cache.find_duplicate_books(), [{2, book_id}])
+
+        # The data can be updated and pickled, for use in worker processes
+        data = cPickle.loads(cPickle.dumps(cache.data_for_find_identical_books(), -1))
+        book_id = cache.create_book_entry(Metadata('Title X', ['Author X']))
+        self.assertEqual(find_identical_books(Metadata('title x', ['author x']), data), set())
+        cache.update_data_for_find_identical_books(book_id, data)
+        self.assertEqual(find_identical_books(Metadata('title x', ['author x']), data), {book_id})
     # }}}
 
     def test_last_read_positions(self):  # {{{
@@ -711,3 +967,83 @@ class ReadingTest(BaseTest):
         cache.set_last_read_position(1, 'EPUB', 'user', 'device')
         self.assertFalse(cache.get_last_read_positions(1, 'ePuB', 'user'))
     # }}}
+
+    def test_lazy_load_tables(self):  # {{{
+        ' Test that lazily loaded tables give the same results as eagerly loaded ones '
+        from calibre.db.backend import DB
+        from calibre.db.cache import Cache
+        eager = self.init_cache(self.library_path)
+        lazy = Cache(DB(self.library_path))
+        lazy.init(lazy_load_tables=True)
+        report = lazy.table_load_report()
+        self.assertFalse(any(x['loaded'] for x in report.itervalues()))
+        self.assertEqual(eager.field_for('tags', 1), lazy.field_for('tags', 1))
+        report = lazy.table_load_report()
+        self.assertTrue(report['tags']['loaded'])
+        self.assertFalse(report['comments']['loaded'])
+        self.assertGreater(report['tags']['memory'], 0)
+        # Probing for attributes that are not table data does not read the table
+        table = lazy.fields['publisher'].table
+        self.assertFalse(hasattr(table, 'no_such_attribute'))
+        self.assertFalse(table.is_loaded)
+        # Threads that access the data while the table is being read see only
+        # the complete data
+        from threading import Thread
+        results = []
+
+        def read_publishers():
+            results.append((dict(table.book_col_map), {k:set(v) for k, v in table.col_book_map.iteritems()}))
+        threads = [Thread(target=read_publishers) for i in xrange(5)]
+        [t.start() for t in threads], [t.join() for t in threads]
+        expected = eager.fields['publisher'].table
+        expected = (dict(expected.book_col_map), {k:set(v) for k, v in expected.col_book_map.iteritems()})
+        self.assertEqual(results, [expected] * len(threads))
+        for query in ('tags:=News', 'one', 'rating:>2', '#float:>10', 'identifiers:true'):
+            self.assertEqual(eager.search(query), lazy.search(query), query)
+        for field in ('title', 'authors', 'series', '#tags', 'pubdate'):
+            self.assertEqual(eager.multisort([(field, True)]), lazy.multisort([(field, True)]), field)
+        lazy.set_field('comments', {1: 'new comments'})
+        self.assertEqual(lazy.field_for('comments', 1), 'new comments')
+        self.assertEqual(eager.field_for('comments', 2), lazy.field_for('comments', 2))
+        report = lazy.table_load_report()
+        self.assertTrue(all(x['loaded'] for k, x in report.iteritems() if k in {'title', 'comments', 'rating'}))
+    # }}}
+
+    def test_compact_tables(self):  # {{{
+        ' Test the compact storage used for one-to-one tables '
+        from datetime import datetime
+        from calibre.db.tables import CompactMap
+        m = CompactMap('number', [(1, 2), (3, 2.5), (4, None), (5, True)])
+        self.assertEqual(len(m), 4)
+        self.assertIs(type(m[1]), int), self.assertIs(type(m[5]), bool)
+        self.assertIn(4, m), self.assertNotIn(2, m), self.assertNotIn(100, m)
+        self.assertIsNone(m[4]), self.assertEqual(m.get(2, 'x'), 'x')
+        self.assertRaises(KeyError, m.__getitem__, 2)
+        m[2], m[1] = 2**60, 'xxx'
+        self.assertEqual(m.copy(), {1:'xxx', 2:2**60, 3:2.5, 4:None, 5:True})
+        del m[1]
+        self.assertEqual(m.pop(3), 2.5), self.assertEqual(len(m), 3), self.assertEqual(m.overflow, {2:2**60})
+        now = datetime(2015, 3, 4, 5, 6, 7, 123456, tzinfo=utc_tz)
+        m = CompactMap('date', [(1, now), (2, datetime(101, 1, 1, tzinfo=utc_tz)), (3, datetime(2015, 1, 1))])
+        self.assertEqual(m.copy(), {1:now, 2:datetime(101, 1, 1, tzinfo=utc_tz), 3:datetime(2015, 1, 1)})
+        self.assertIsNone(m[3].tzinfo)
+
+        from calibre.utils.config_base import tweaks
+        cache = self.init_cache(self.library_path)
+        tweaks['newdb_compact_tables'] = False
+        try:
+            plain = self.init_cache(self.library_path)
+        finally:
+            del tweaks['newdb_compact_tables']
+        self.assertIsInstance(cache.fields['title'].table.book_col_map, CompactMap)
+        self.assertIsInstance(cache.fields['size'].table.book_col_map, CompactMap)
+        self.assertIs(type(plain.fields['title'].table.book_col_map), dict)
+        for field in ('title', 'size', 'timestamp', 'pubdate', 'comments', 'uuid', '#date', '#float', '#yesno', '#comments'):
+            self.assertEqual(cache.fields[field].table.book_col_map.copy(), plain.fields[field].table.book_col_map, field)
+            self.assertEqual(cache.multisort([(field, True)]), plain.multisort([(field, True)]), field)
+        for query in ('size:>1', 'date:>2000', '#float:>10', '#yesno:true', '#date:<2010', 'title:one'):
+            self.assertEqual(cache.search(query), plain.search(query), query)
+        from calibre.ebooks.metadata.book.base import Metadata
+        book_id = cache.create_book_entry(Metadata('test compact'))
+        self.assertEqual(cache.field_for('title', book_id), 'test compact')
+    # }}}
@@ -0,0 +1,72 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2026, agent <agent at local>
+
+'''
+Compare the speed of compiled templates with the template interpreter, using
+the test library. Run with:
+
+    calibre-debug -c "from calibre.db.tests.template_benchmark import main; main()"
+'''
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os, shutil, tempfile, time
+
+TEMPLATES = (
+    '{title} - {authors}',
+    '{series:|[|] }{series_index:0>5.2f|| }{title:shorten(10,...,10)}',
+    '{tags:sublist(0,2,\\,)}',
+    "{authors:'list_item($, 0, \"&\")'}",
+    "program: strcat(field('title'), ' (', uppercase(field('publisher')), ')')",
+    "program: a = field('tags'); b = field('#tags'); test(a, strcat(a, ', ', b), b)",
+    "program: first_non_empty(field('#series'), field('series'), 'none')",
+)
+
+
+def run(cache, template, book_ids, repeat, compiled):
+    from calibre.ebooks.metadata.book.formatter import SafeFormat
+    from calibre.utils.formatter import TemplateFormatter
+    TemplateFormatter.compile_templates = compiled
+    TemplateFormatter.compiled_programs.clear(), TemplateFormatter.compiled_templates.clear()
+    template_cache = {}
+    template_functions = cache.backend.get_template_functions()
+    mis = [cache.get_metadata(book_id) for book_id in book_ids]
+    formatter = SafeFormat()
+    ans = []
+    st = time.time()
+    for i in xrange(repeat):
+        ans = [formatter.safe_format(template, mi, 'TEMPLATE ERROR', mi, column_name='#benchmark',
+                                     template_cache=template_cache, template_functions=template_functions) for mi in mis]
+    return time.time() - st, ans
+
+
+def main(repeat=10000):
+    from calibre.db.backend import DB
+    from calibre.db.cache import Cache
+    from calibre.utils.formatter import TemplateFormatter
+    tdir = tempfile.mkdtemp()
+    try:
+        shutil.copyfile(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'metadata.db'), os.path.join(tdir, 'metadata.db'))
+        cache = Cache(DB(tdir))
+        cache.init()
+        book_ids = sorted(cache.all_book_ids())
+        total = [0, 0]
+        print('Evaluating each template %d times for %d books' % (repeat, len(book_ids)))
+        for template in TEMPLATES:
+            interpreted, expected = run(cache, template, book_ids, repeat, False)
+            compiled, actual = run(cache, template, book_ids, repeat, True)
+            if actual != expected:
+                raise SystemExit('Compiled template %r gave: %r instead of: %r' % (template, actual, expected))
+            total[0] += interpreted
+            total[1] += compiled
+            print('%-80s interpreted: %6.2fs compiled: %6.2fs speedup: %.1fx' % (template, interpreted, compiled, interpreted / compiled))
+        print('%-80s interpreted: %6.2fs compiled: %6.2fs speedup: %.1fx' % ('Total', total[0], total[1], total[0] / total[1]))
+        cache.close()
+    finally:
+        TemplateFormatter.compile_templates = True
+        shutil.rmtree(tdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -81,4 +81,14 @@ class UtilsTest(BaseTest):
         self.assertIsNone(c[1][0])
         self.assertEqual(len(c), 0)
         self.assertEqual(tuple(walk(c.location)), ())
+
+        # Statistics
+        c = self.init_tc()
+        self.basic_fill(c)
+        self.assertEqual(c[1][1], 1)
+        self.assertEqual(c[99], (None, None))
+        stats = c.statistics()
+        self.assertEqual((stats['hits'], stats['misses'], stats['count'], stats['hit_rate']), (1, 1, 5, 0.5))
+        c.clear_statistics()
+        self.assertEqual(c.statistics()['hits'], 0)
     # }}}
@@ -7,6 +7,7 @@ __license__   = 'GPL v3'
 __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
+import os
 from collections import namedtuple
 from functools import partial
 from io import BytesIO
@@ -335,6 +336,139 @@ class WritingTest(BaseTest):
             c.nowf = onowf
     # }}}
 
+    def test_bulk_edit(self):  # {{{
+        'Test making many changes in a single transaction'
+        cl = self.cloned_library
+        cache = self.init_cache(cl)
+        ae, af = self.assertEqual, self.assertFalse
+        cache.dump_metadata()
+        ae(cache.search('tags:"=Tag One"'), {1, 2})
+        lm = cache.field_for('last_modified', 1)
+        with cache.bulk_edit():
+            ae(cache.set_field('tags', {1:('a', 'b'), 2:('a',)}), {1, 2})
+            with cache.bulk_edit():
+                ae(cache.set_field('rating', {3:8}), {3})
+            ae(cache.set_field('#enum', {1:'One'}), {1})
+            af(cache.dirtied_cache)
+            ae(cache.field_for('tags', 1), ('a', 'b'))
+        ae(set(cache.dirtied_cache), {1, 2, 3})
+        self.assertGreater(cache.field_for('last_modified', 1), lm)
+        ae(cache.search('tags:"=Tag One"'), set())
+        ae(cache.search('tags:"=a"'), {1, 2})
+        ae(cache.search('rating:4'), {3})
+        cache.dump_metadata()
+
+        # Moving the files of a book is deferred until the changes are committed
+        path = cache.field_for('path', 2)
+        with cache.bulk_edit():
+            cache.set_field('title', {2:'moved'})
+            ae(cache.field_for('path', 2), path)
+        self.assertNotEqual(cache.field_for('path', 2), path)
+        self.assertTrue(os.path.isdir(os.path.join(cl, cache.field_for('path', 2))))
+        af(os.path.exists(os.path.join(cl, path)))
+        cache.dump_metadata()
+
+        try:
+            with cache.bulk_edit():
+                cache.set_field('tags', {1:('x',), 3:('x',)})
+                cache.set_field('title', {1:'changed'})
+                raise ValueError('abort')
+        except ValueError:
+            pass
+        af(cache.dirtied_cache)
+        ae(cache.field_for('tags', 1), ('a', 'b'))
+        ae(cache.field_for('title', 1), 'Title Two')
+        self.assertTrue(os.path.isdir(os.path.join(cl, cache.field_for('path', 1))))
+        ae(cache.search('tags:"=x"'), set())
+        cache = self.init_cache(cl)
+        ae(cache.field_for('tags', 1), ('a', 'b'))
+        ae(cache.field_for('tags', 3), ())
+        ae(cache.field_for('title', 1), 'Title Two')
+        ae(cache.field_for('rating', 3), 8)
+        af(cache.dirtied_cache)
+    # }}}
+
+    def test_category_cache(self):  # {{{
+        'Test that the cached tag browser categories are updated when books are changed'
+        cl = self.cloned_library
+        cache = self.init_cache(cl)
+        ae = self.assertEqual
+
+        from calibre.db.categories import category_sort_keys, create_tag_class, find_categories
+        from calibre.ebooks.metadata import author_to_author_sort
+
+        def as_tuples(items):
+            return [(t.name, t.id, t.count, t.avg_rating, t.sort, t.id_set) for t in items]
+
+        def uncached(book_ids, sort, first_letter_sort):
+            # The categories of the fields, computed without the category
+            # cache, the way get_categories() used to
+            fm = cache.field_metadata
+            book_ids = frozenset(book_ids) if book_ids else book_ids
+            book_rating_map = cache.fields['rating'].book_value_map
+            lang_map = cache.fields['languages'].book_value_map
+            ans = {}
+            for category, is_multiple, is_composite in find_categories(fm):
+                tag_class = create_tag_class(category, fm)
+                sort_on, reverse = sort, False
+                if is_composite:
+                    cats = cache.fields[category].get_composite_categories(
+                        tag_class, book_rating_map, cache.all_book_ids() if book_ids is None else book_ids, is_multiple, cache.get_proxy_metadata)
+                elif category == 'news':
+                    cats = cache.fields['tags'].get_news_category(tag_class, book_ids)
+                else:
+                    cat = fm[category]
+                    brm = book_rating_map
+                    if cat['datatype'] == 'rating':
+                        if category != 'rating':
+                            brm = cache.fields[category].book_value_map
+                        if sort_on == 'name':
+                            sort_on, reverse = 'rating', True
+                    cats = cache.fields[category].get_categories(tag_class, brm, lang_map, book_ids)
+                    if (category != 'authors' and cat['datatype'] == 'text' and
+                            cat['is_multiple'] and cat['display'].get('is_names', False)):
+                        for item in cats:
+                            item.sort = author_to_author_sort(item.sort)
+                cats.sort(key=category_sort_keys[bool(first_letter_sort)][sort_on], reverse=reverse)
+                ans[category] = cats
+            for r in ans['rating']:
+                for x in tuple(ans['rating']):
+                    if r.name == x.name and r.id != x.id:
+                        r.id_set = r.id_set | x.id_set
+                        r.count = len(r.id_set)
+                        ans['rating'].remove(x)
+                        break
+            return {category: as_tuples(items) for category, items in ans.iteritems()}
+
+        def check():
+            for book_ids in (None, {1, 2}, {3}, set()):
+                for sort, first_letter_sort in (('name', False), ('popularity', False), ('rating', False), ('name', True)):
+                    expected = uncached(book_ids, sort, first_letter_sort)
+                    actual = cache.get_categories(sort=sort, book_ids=book_ids, first_letter_sort=first_letter_sort)
+                    for category, items in expected.iteritems():
+                        ae(as_tuples(actual[category]), items, 'The %s category differs for books: %s sorted by: %s' % (category, book_ids, sort))
+
+        check()
+        cached = cache.category_cache.categories
+        self.assertIn('tags', cached), self.assertIn('#series', cached)
+        cache.set_field('tags', {1:('Tag One', 'xxx'), 3:('News', 'yyy')})
+        self.assertNotIn('tags', cached), self.assertNotIn('news', cached)
+        self.assertIn('authors', cached), self.assertIn('#series', cached)
+        check()
+        cache.set_field('languages', {1:('fra',), 2:('deu',)})
+        self.assertNotIn('series', cached), self.assertNotIn('#series', cached)
+        self.assertIn('authors', cached)
+        check()
+        cache.set_field('rating', {1:10, 3:4})
+        self.assertNotIn('authors', cached), self.assertIn('#rating', cached)
+        check()
+        cache.rename_items('series', {cache.get_item_id('series', 'A Series One'):'Series Two'})
+        cache.set_sort_for_authors({cache.get_item_id('authors', 'Author One'):'aaa'}, update_books=False)
+        check()
+        cache.remove_books((2,))
+        check()
+    # }}}
+
     def test_backup(self):  # {{{
         'Test the automatic backup of changed metadata'
         cl = self.cloned_library
@@ -367,6 +501,47 @@ class WritingTest(BaseTest):
             ae(opf.authors, ['author1', 'author2'])
     # }}}
 
+    def test_backup_batches(self):  # {{{
+        'Test backing up metadata in batches'
+        from calibre.db.backup import backup_books, create_write_pool
+        cache = self.init_cache(self.cloned_library)
+        ae, af = self.assertEqual, self.assertFalse
+        cache.dump_metadata()
+        af(cache.dirtied_cache)
+        for book_id in (3, 1, 2):
+            cache.set_field('title', {book_id:'new title %d' % book_id})
+        ae(cache.get_dirtied_books(), [3, 1, 2])
+        ae(cache.get_dirtied_books(2), [3, 1])
+        ae(cache.get_dirtied_books(2, exclude={3}), [1, 2])
+
+        # Books whose backups cannot be written remain dirtied
+        write_backup = cache.backend.write_backup
+
+        def failing_write_backup(path, raw):
+            if path == cache.field_for('path', 1):
+                raise EnvironmentError('Failed to write')
+            return write_backup(path, raw)
+        cache.backend.write_backup = failing_write_backup
+        before = cache.backup_status()
+        pool = create_write_pool()
+        try:
+            with self.assertRaises(EnvironmentError):
+                cache.write_backup(1, b'')
+            ae(backup_books(cache, cache.get_dirtied_books(), pool=pool), {1})
+        finally:
+            pool.terminate()
+            del cache.backend.write_backup
+        ae(cache.get_dirtied_books(), [1])
+        status = cache.backup_status()
+        ae((status['written'] - before['written'], status['failed'] - before['failed'], status['queue_length']), (2, 1, 1))
+        from calibre.ebooks.metadata.opf2 import OPF
+        for book_id in (2, 3):
+            ae(OPF(BytesIO(cache.read_backup(book_id))).title, 'new title %d' % book_id)
+        ae(backup_books(cache, [1]), set())
+        af(cache.dirtied_cache)
+        ae(OPF(BytesIO(cache.read_backup(1))).title, 'new title 1')
+    # }}}
+
     def test_set_cover(self):  # {{{
         ' Test setting of cover '
         cache = self.init_cache()
@@ -748,3 +923,65 @@ class WritingTest(BaseTest):
         prefs['test mutable'] = {k:k for k in reversed(range(10))}
         self.assertEqual(len(changes), 3, 'The database was written to despite there being no change in value')
     # }}}
+
+    def test_snapshot(self):  # {{{
+        ' Test that snapshots are not affected by later changes '
+        cache = self.init_cache()
+        ae = self.assertEqual
+        book_ids = cache.all_book_ids()
+        fields = ('title', 'authors', 'tags', 'rating', 'identifiers', 'formats', 'series', '#tags')
+        before = {f:cache.all_field_for(f, book_ids) for f in fields}
+        tag_map = cache.get_id_map('tags')
+        snapshot = cache.snapshot()
+        ae(before['title'], snapshot.all_field_for('title', book_ids))
+        self.assertIn(snapshot, cache.snapshots)
+        cache.set_field('title', {1:'changed'})
+        self.assertIn('sort', snapshot.fields, 'Writing the title did not copy the title sort')
+        self.assertNotIn('tags', snapshot.fields, 'Writing the title copied an unrelated field')
+        self.assertIn(snapshot, cache.snapshots)
+        cache.set_field('tags', {1:('a', 'b'), 2:()})
+        self.assertIn('tags', snapshot.fields)
+        self.assertNotIn('rating', snapshot.fields)
+        cache.set_field('rating', {1:2, 2:None})
+        cache.set_field('identifiers', {1:{'isbn':'1'}})
+        cache.set_field('#tags', {1:('x',)})
+        cache.set_field('series', {1:'new series'})
+        cache.remove_formats({1:('FMT1',)})
+        cache.rename_items('tags', {next(iter(tag_map)):'renamed'})
+        cache.remove_books((3,))
+        self.assertNotIn(snapshot, cache.snapshots, 'Removing books did not copy the remaining fields')
+        ae(snapshot.all_book_ids(), book_ids)
+        self.assertTrue(snapshot.has_id(3))
+        self.assertFalse(cache.has_id(3))
+        for f in fields:
+            ae(before[f], snapshot.all_field_for(f, book_ids), 'The snapshot of %s changed' % f)
+        ae(tag_map, snapshot.get_id_map('tags'))
+        ae(snapshot.field_for('#tags', 1), before['#tags'][1])
+        ae(snapshot.field_for('nosuchfield', 1, default_value='x'), 'x')
+        for tag_id in tag_map:
+            ae(snapshot.books_for_field('tags', tag_id), {book_id for book_id in book_ids if tag_map[tag_id] in before['tags'][book_id]})
+        ae(cache.field_for('title', 1), 'changed')
+        snapshot.release()
+        ae(snapshot.field_for('title', 1, default_value='released'), 'released')
+
+        # A snapshot limited to some fields copies them as they are read,
+        # and is freed when it goes out of scope
+        with cache.snapshot(fields=('tags',)) as snapshot:
+            ae(snapshot.field_for('tags', 1), ('a', 'b'))
+            self.assertIn('tags', snapshot.fields)
+            self.assertNotIn('authors', snapshot.field_names)
+        self.assertFalse(cache.snapshots)
+        cache.snapshot()
+        import gc
+        gc.collect()
+        self.assertFalse(cache.snapshots)
+
+        # calibredb list reads from a snapshot
+        from calibre.db.cli.cmd_list import implementation as list_books
+        ans = list_books(cache, None, ['title', 'tags', 'isbn', '*tags', 'formats'], 'id', True, '', -1)
+        ae(set(ans['data']['formats']), set(ans['book_ids']))
+        ae(ans['data']['title'], cache.all_field_for('title', ans['book_ids']))
+        ae(ans['data']['#tags'], cache.all_field_for('#tags', ans['book_ids']))
+        ae(ans['data']['isbn'], {k:v.get('isbn') or '' for k, v in cache.all_field_for('identifiers', ans['book_ids']).iteritems()})
+        self.assertFalse(cache.snapshots)
+    # }}}
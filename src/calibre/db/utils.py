@@ -8,9 +8,9 @@ __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 
 import os, errno, cPickle, sys, re
 from locale import localeconv
-from collections import OrderedDict, namedtuple
-from future_builtins import map
-from threading import Lock
+from collections import OrderedDict, defaultdict, namedtuple
+from future_builtins import map, zip
+from threading import Lock, RLock
 
 from calibre import as_unicode, prints
 from calibre.constants import cache_dir, get_windows_number_formats, iswindows
@@ -62,36 +62,144 @@ def fuzzy_title(title):
 
 
 def find_identical_books(mi, data):
-    author_map, aid_map, title_map, lang_map = data
-    found_books = None
-    for a in mi.authors:
-        author_ids = author_map.get(icu_lower(a))
-        if author_ids is None:
-            return set()
-        books_by_author = {book_id for aid in author_ids for book_id in aid_map.get(aid, ())}
-        if found_books is None:
-            found_books = books_by_author
-        else:
-            found_books &= books_by_author
-        if not found_books:
-            return set()
-
-    ans = set()
-    titleq = fuzzy_title(mi.title)
-    for book_id in found_books:
-        title = title_map.get(book_id, '')
-        if fuzzy_title(title) == titleq:
-            ans.add(book_id)
+    ''' Return the ids of the books in data that have a superset of the authors
+    in mi, the same title (fuzzy matched) and compatible languages. data is a
+    :class:`DuplicatesIndex`, such as the one returned by
+    Cache.data_for_find_identical_books(). '''
+    return data.find(mi)
+
+
+def languages_for_matching(languages):
+    return tuple(filter(lambda x: x and x != 'und', map(canonicalize_lang, languages or ())))
+
+
+class DuplicatesIndex(object):
+
+    '''
+    An index of the books in the library by fuzzy title (see
+    :func:`fuzzy_title`) and by case-insensitive title, used for duplicate
+    detection. Finding the books identical to a given book only has to look
+    at the books with the same fuzzy title. Books that have changed are
+    re-indexed the next time the index is used. Instances can be pickled, for
+    use in worker processes.
+    '''
+
+    def __init__(self):
+        # Reentrant, so that callers can bring the index up to date and look
+        # up books in it while holding the lock
+        self.lock = RLock()
+        self.built = False
+        self.dirty = set()
+        self.entries = {}  # book_id -> (fuzzy title, title, authors, languages)
+        self.fuzzy_titles = {}  # fuzzy title -> set of book ids
+        self.titles = {}  # lower cased title -> number of books
+
+    def __getstate__(self):
+        ans = self.__dict__.copy()
+        del ans['lock']
+        return ans
 
-    langq = tuple(filter(lambda x: x and x != 'und', map(canonicalize_lang, mi.languages or ())))
-    if not langq:
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = RLock()
+
+    def copy(self):
+        ans = DuplicatesIndex()
+        ans.built = self.built
+        ans.dirty = set(self.dirty)
+        ans.entries = self.entries.copy()
+        ans.fuzzy_titles = {k:set(v) for k, v in self.fuzzy_titles.iteritems()}
+        ans.titles = self.titles.copy()
         return ans
 
-    def lang_matches(book_id):
-        book_langq = lang_map.get(book_id)
-        return not book_langq or langq == book_langq
+    def clear(self):
+        with self.lock:
+            self.built = False
+            self.dirty = set()
+            self.entries, self.fuzzy_titles, self.titles = {}, {}, {}
 
-    return {book_id for book_id in ans if lang_matches(book_id)}
+    def books_changed(self, book_ids):
+        with self.lock:
+            if self.built:
+                self.dirty.update(book_ids)
+
+    def update(self, all_book_ids, entry_func):
+        ''' Bring the index up to date with the library and return it.
+        entry_func(book_id) must return the title, authors and languages of
+        the book. Callers that look up books in the returned index must hold
+        its lock across both the update and the lookup, since read_api
+        methods run concurrently. '''
+        with self.lock:
+            if not self.built:
+                self.clear()
+                dirty, self.built = all_book_ids, True
+            else:
+                dirty, self.dirty = self.dirty, set()
+            for book_id in dirty:
+                self.discard(book_id)
+                if book_id in all_book_ids:
+                    self.add(book_id, *entry_func(book_id))
+        return self
+
+    def add(self, book_id, title, authors, languages):
+        self.discard(book_id)
+        title = icu_lower(title or '')
+        ftitle = fuzzy_title(title)
+        self.entries[book_id] = (ftitle, title, frozenset(icu_lower(a) for a in authors or ()), tuple(languages or ()))
+        try:
+            self.fuzzy_titles[ftitle].add(book_id)
+        except KeyError:
+            self.fuzzy_titles[ftitle] = {book_id}
+        self.titles[title] = self.titles.get(title, 0) + 1
+
+    def discard(self, book_id):
+        entry = self.entries.pop(book_id, None)
+        if entry is not None:
+            ftitle, title = entry[:2]
+            ids = self.fuzzy_titles[ftitle]
+            ids.discard(book_id)
+            if not ids:
+                del self.fuzzy_titles[ftitle]
+            self.titles[title] -= 1
+            if not self.titles[title]:
+                del self.titles[title]
+
+    def has_title(self, title):
+        ''' True iff a book with the specified title (case-insensitive) is in the index '''
+        return icu_lower(title).strip() in self.titles
+
+    def find(self, mi):
+        ''' Return the books that have a superset of the authors in mi, the same
+        title (fuzzy matched) and compatible languages '''
+        authors = {icu_lower(a) for a in mi.authors or ()}
+        book_ids = self.fuzzy_titles.get(fuzzy_title(mi.title or ''))
+        if not authors or not book_ids:
+            return set()
+        langq = languages_for_matching(mi.languages)
+        ans = set()
+        for book_id in book_ids:
+            book_authors, book_langs = self.entries[book_id][2:]
+            if authors.issubset(book_authors) and (not langq or not book_langs or book_langs == langq):
+                ans.add(book_id)
+        return ans
+
+    def duplicate_groups(self):
+        ''' Return a list of sets of book ids, each set containing books that
+        have the same title (fuzzy matched), the same authors and compatible
+        languages. A book with no languages can be in more than one set. '''
+        ans = []
+        for book_ids in self.fuzzy_titles.itervalues():
+            if len(book_ids) < 2:
+                continue
+            by_authors = defaultdict(lambda: defaultdict(set))
+            for book_id in book_ids:
+                authors, langs = self.entries[book_id][2:]
+                by_authors[authors][langs].add(book_id)
+            for by_langs in by_authors.itervalues():
+                no_langs = by_langs.pop((), set())
+                groups = [no_langs | x for x in by_langs.itervalues()] or [no_langs]
+                ans.extend(g for g in groups if len(g) > 1)
+        return ans
 
 
 Entry = namedtuple('Entry', 'path size timestamp thumbnail_size')
@@ -119,6 +227,7 @@ class ThumbnailCache(object):
         self.group_id = 'group'
         self.thumbnail_size = thumbnail_size
         self.size_changed = False
+        self.hits = self.misses = 0
         self.lock = Lock()
         self.min_disk_cache = min_disk_cache
         if test_mode:
@@ -314,6 +423,7 @@ class ThumbnailCache(object):
             key = (self.group_id, book_id)
             entry = self.items.pop(key, None)
             if entry is None:
+                self.misses += 1
                 return None, None
             if entry.thumbnail_size != self.thumbnail_size:
                 try:
@@ -322,6 +432,7 @@ class ThumbnailCache(object):
                     if getattr(err, 'errno', None) != errno.ENOENT:
                         self.log('Failed to remove cached thumbnail:', entry.path, as_unicode(err))
                 self.total_size -= entry.size
+                self.misses += 1
                 return None, None
             self.items[key] = entry
             try:
@@ -329,9 +440,28 @@ class ThumbnailCache(object):
                     data = f.read()
             except EnvironmentError as err:
                 self.log('Failed to read cached thumbnail:', entry.path, as_unicode(err))
+                self.misses += 1
                 return None, None
+            self.hits += 1
             return data, entry.timestamp
 
+    def statistics(self):
+        ''' Return the number of hits and misses since the cache was created
+        or the statistics were cleared, the hit rate, the number of
+        thumbnails and the space used on disk. '''
+        with self.lock:
+            if not hasattr(self, 'total_size'):
+                self._load_index()
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                'count': len(self.items), 'total_size': self.total_size, 'max_size': self.max_size,
+            }
+
+    def clear_statistics(self):
+        with self.lock:
+            self.hits = self.misses = 0
+
     def invalidate(self, book_ids):
         with self.lock:
             if hasattr(self, 'total_size'):
@@ -378,6 +508,56 @@ class ThumbnailCache(object):
                 self._apply_size()
 
 
+class SortIndex(object):
+
+    '''
+    All books in the library in sorted order for a single sort field, used to
+    turn sorting into a lookup of precomputed ranks. Books with equal sort
+    keys have equal ranks, so sorting on ranks gives exactly the same order as
+    sorting on the keys themselves. Books that have changed are re-keyed and
+    merged back into the index the next time it is used.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.keys = self.book_ids = None
+        self.ranks = {}
+        self.dirty = set()
+
+    def books_changed(self, book_ids):
+        if self.keys is not None:
+            self.dirty.update(book_ids)
+
+    def ranks_for(self, all_book_ids, sort_key_func):
+        ''' Return a mapping of book id to rank for all books in the library.
+        sort_key_func must return a function mapping book ids to sort keys, it
+        is only called if some books need to be (re-)keyed. '''
+        with self.lock:
+            if self.dirty or len(self.ranks) != len(all_book_ids):
+                self.dirty |= set(all_book_ids).difference(self.ranks)
+            if self.keys is not None and not self.dirty:
+                return self.ranks
+            key = sort_key_func()
+            if self.keys is None or len(self.dirty) > len(self.book_ids) // 2:
+                pairs = [(key(book_id), book_id) for book_id in all_book_ids]
+            else:
+                dirty = self.dirty
+                pairs = [(k, book_id) for k, book_id in zip(self.keys, self.book_ids) if book_id not in dirty]
+                pairs.extend((key(book_id), book_id) for book_id in dirty if book_id in all_book_ids)
+            # Mostly sorted data is sorted in linear time
+            pairs.sort()
+            self.keys = [k for k, book_id in pairs]
+            self.book_ids = [book_id for k, book_id in pairs]
+            self.ranks = ranks = {}
+            rank, prev = -1, self
+            for k, book_id in pairs:
+                if k != prev:
+                    rank, prev = rank + 1, k
+                ranks[book_id] = rank
+            self.dirty = set()
+            return ranks
+
+
 number_separators = None
 
 
@@ -346,46 +346,36 @@ class MyBlockingBusy(QDialog):  # {{{
                 self.progress_update.emit(1)
             self.progress_finished_cur_step.emit()
 
-        # Various fields
+        # Various fields, set in a single transaction. Only the set_field()
+        # calls are made in bulk_edit(), as it holds the write lock
+        changes = []
         if args.rating != -1:
-            self.progress_next_step_range.emit(0)
-            cache.set_field('rating', {bid: args.rating for bid in self.ids})
-            self.progress_finished_cur_step.emit()
+            changes.append(('rating', {bid: args.rating for bid in self.ids}))
 
         if args.clear_pub:
-            self.progress_next_step_range.emit(0)
-            cache.set_field('publisher', {bid: '' for bid in self.ids})
-            self.progress_finished_cur_step.emit()
+            changes.append(('publisher', {bid: '' for bid in self.ids}))
 
         if args.pub:
-            self.progress_next_step_range.emit(0)
-            cache.set_field('publisher', {bid: args.pub for bid in self.ids})
-            self.progress_finished_cur_step.emit()
+            changes.append(('publisher', {bid: args.pub for bid in self.ids}))
 
         if args.clear_series:
-            self.progress_next_step_range.emit(0)
-            cache.set_field('series', {bid: '' for bid in self.ids})
-            self.progress_finished_cur_step.emit()
+            changes.append(('series', {bid: '' for bid in self.ids}))
 
         if args.pubdate is not None:
-            self.progress_next_step_range.emit(0)
-            cache.set_field('pubdate', {bid: args.pubdate for bid in self.ids})
-            self.progress_finished_cur_step.emit()
+            changes.append(('pubdate', {bid: args.pubdate for bid in self.ids}))
 
         if args.adddate is not None:
-            self.progress_next_step_range.emit(0)
-            cache.set_field('timestamp', {bid: args.adddate for bid in self.ids})
-            self.progress_finished_cur_step.emit()
+            changes.append(('timestamp', {bid: args.adddate for bid in self.ids}))
 
         if args.do_series:
-            self.progress_next_step_range.emit(0)
             sval = args.series_start_value if args.do_series_restart else cache.get_next_series_num_for(args.series, current_indices=True)
-            cache.set_field('series', {bid:args.series for bid in self.ids})
-            self.progress_finished_cur_step.emit()
+            if args.clear_series and not args.do_series_restart:
+                # The series of the books is cleared before it is set
+                for bid in self.ids:
+                    sval.pop(bid, None)
+            changes.append(('series', {bid:args.series for bid in self.ids}))
             if not args.series:
-                self.progress_next_step_range.emit(0)
-                cache.set_field('series_index', {bid:1.0 for bid in self.ids})
-                self.progress_finished_cur_step.emit()
+                changes.append(('series_index', {bid:1.0 for bid in self.ids}))
             else:
                 def next_series_num(bid, i):
                     if args.do_series_restart:
@@ -396,36 +386,32 @@ class MyBlockingBusy(QDialog):  # {{{
 
                 smap = {bid:next_series_num(bid, i) for i, bid in enumerate(self.ids)}
                 if args.do_autonumber:
-                    self.progress_next_step_range.emit(0)
-                    cache.set_field('series_index', smap)
-                    self.progress_finished_cur_step.emit()
+                    changes.append(('series_index', smap))
                 elif tweaks['series_index_auto_increment'] != 'no_change':
-                    self.progress_next_step_range.emit(0)
-                    cache.set_field('series_index', {bid:1.0 for bid in self.ids})
-                    self.progress_finished_cur_step.emit()
+                    changes.append(('series_index', {bid:1.0 for bid in self.ids}))
 
         if args.comments is not null:
-            self.progress_next_step_range.emit(0)
-            cache.set_field('comments', {bid: args.comments for bid in self.ids})
-            self.progress_finished_cur_step.emit()
-
-        if args.do_remove_conv:
-            self.progress_next_step_range.emit(0)
-            cache.delete_conversion_options(self.ids)
-            self.progress_finished_cur_step.emit()
+            changes.append(('comments', {bid: args.comments for bid in self.ids}))
 
         if args.clear_languages:
-            self.progress_next_step_range.emit(0)
-            cache.set_field('languages', {bid: () for bid in self.ids})
-            self.progress_finished_cur_step.emit()
+            changes.append(('languages', {bid: () for bid in self.ids}))
         elif args.languages:
-            self.progress_next_step_range.emit(0)
-            cache.set_field('languages', {bid: args.languages for bid in self.ids})
-            self.progress_finished_cur_step.emit()
+            changes.append(('languages', {bid: args.languages for bid in self.ids}))
 
         if args.remove_all:
+            changes.append(('tags', {bid: () for bid in self.ids}))
+
+        if changes:
+            with cache.bulk_edit():
+                for field, book_id_val_map in changes:
+                    cache.set_field(field, book_id_val_map)
+            for change in changes:
+                self.progress_next_step_range.emit(0)
+                self.progress_finished_cur_step.emit()
+
+        if args.do_remove_conv:
             self.progress_next_step_range.emit(0)
-            cache.set_field('tags', {bid: () for bid in self.ids})
+            cache.delete_conversion_options(self.ids)
             self.progress_finished_cur_step.emit()
 
         if args.add or args.remove:
@@ -440,8 +426,10 @@ class MyBlockingBusy(QDialog):  # {{{
                 self.progress_update.emit(1)
             if self.sr_calls:
                 self.progress_next_step_range.emit(len(self.ids))
-                for field, book_id_val_map in self.sr_calls.iteritems():
-                    self.refresh_books.update(self.db.new_api.set_field(field, book_id_val_map))
+                with cache.bulk_edit():
+                    for field, book_id_val_map in self.sr_calls.iteritems():
+                        self.refresh_books.update(cache.set_field(field, book_id_val_map))
+                for field in self.sr_calls:
                     self.progress_update.emit(1)
                 self.progress_finished_cur_step.emit()
             self.progress_finished_cur_step.emit()
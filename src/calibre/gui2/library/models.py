@@ -209,7 +209,7 @@ class BooksModel(QAbstractTableModel):  # {{{
         self.headers = {}
         self.alignment_map = {}
         self.buffer_size = buffer
-        self.metadata_backup = None
+        self.metadata_backup = self.composite_renderer = None
         icon_height = (parent.fontMetrics() if hasattr(parent, 'fontMetrics') else QApplication.instance().fontMetrics()).lineSpacing()
         self.bool_yes_icon = QIcon(I('ok.png')).pixmap(icon_height)
         self.bool_no_icon = QIcon(I('list_remove.png')).pixmap(icon_height)
@@ -310,14 +310,21 @@ class BooksModel(QAbstractTableModel):  # {{{
 
     def start_metadata_backup(self):
         from calibre.db.backup import MetadataBackup
+        from calibre.db.prerender import CompositeRenderer
         self.metadata_backup = MetadataBackup(self.db)
         self.metadata_backup.start()
+        # Composite columns are re-rendered in the background after changes,
+        # this is stopped along with the backup, for example, during bulk edits
+        self.composite_renderer = CompositeRenderer(self.db)
+        self.composite_renderer.start()
 
     def stop_metadata_backup(self):
         if getattr(self, 'metadata_backup', None) is not None:
             self.metadata_backup.stop()
             # Would like to to a join here, but the thread might be waiting to
             # do something on the GUI thread. Deadlock.
+        if getattr(self, 'composite_renderer', None) is not None:
+            self.composite_renderer.stop()
 
     def refresh_ids(self, ids, current_row=-1):
         self._clear_caches()
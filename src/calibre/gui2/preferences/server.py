@@ -184,7 +184,7 @@ class AdvancedTab(QWidget):
         self.widget_map = {}
         self.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Fixed)
         for name in sorted(options, key=lambda n: options[n].shortdoc.lower()):
-            if name in ('auth', 'port', 'allow_socket_preallocation', 'userdb'):
+            if name in ('auth', 'port', 'allow_socket_preallocation', 'userdb', 'event_loop'):
                 continue
             opt = options[name]
             if opt.choices:
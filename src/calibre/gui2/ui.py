@@ -991,9 +991,7 @@ class Main(MainWindow, MainWindowMixin, DeviceMixin, EmailMixin,  # {{{
                 pass
         sys.excepthook = eh
 
-        mb = self.library_view.model().metadata_backup
-        if mb is not None:
-            mb.stop()
+        self.library_view.model().stop_metadata_backup()
 
         self.library_view.model().close()
 
@@ -5,14 +5,19 @@ __license__   = 'GPL v3'
 __copyright__ = '2010, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
-import re, os, traceback, fnmatch
+import re, os, traceback, fnmatch, time, cPickle, hashlib
+from contextlib import closing
+from functools import partial
+from multiprocessing.pool import ThreadPool
 
-from calibre import isbytestring
-from calibre.constants import filesystem_encoding
+from calibre import isbytestring, detect_ncpus as cpu_count
+from calibre.constants import filesystem_encoding, cache_dir
 from calibre.ebooks import BOOK_EXTENSIONS
+from calibre.utils.filenames import atomic_rename
 
 EBOOK_EXTENSIONS = frozenset(BOOK_EXTENSIONS)
 NORMALS = frozenset(['metadata.opf', 'cover.jpg'])
+STATE_VERSION = 1
 
 '''
 Checks fields:
@@ -32,10 +37,20 @@ CHECKS = [('invalid_titles',    _('Invalid titles'), True, False),
           ('extra_files',       _('Unknown files in books'), True, False),
           ('missing_covers',    _('Missing cover files'), False, True),
           ('extra_covers',      _('Cover files not in database'), True, True),
+          ('changed_formats',   _('Book formats with changed contents'), False, False),
           ('failed_folders',    _('Folders raising exception'), False, False)
       ]
 
 
+def default_state_path(library_path):
+    ''' The file in which the folder listings of the library are stored for
+    incremental checks '''
+    if isbytestring(library_path):
+        library_path = library_path.decode(filesystem_encoding)
+    key = hashlib.sha1(os.path.abspath(library_path).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir(), 'check-library', key + '.pickle')
+
+
 class CheckLibrary(object):
 
     def __init__(self, library_path, db):
@@ -71,8 +86,12 @@ class CheckLibrary(object):
         self.missing_covers = []
         self.extra_covers = []
 
+        self.changed_formats = []
+
         self.failed_folders = []
 
+        self.folders_listed = self.folders_reused = 0
+
     def dbpath(self, id_):
         return self.db.path(id_, index_is_id=True)
 
@@ -87,69 +106,154 @@ class CheckLibrary(object):
                 return True
         return False
 
-    def scan_library(self, name_ignores, extension_ignores):
+    def load_state(self, state_path):
+        self.previous_state, self.state, self.previous_scan = {}, {}, None
+        if state_path and os.path.exists(state_path):
+            try:
+                with open(state_path, 'rb') as f:
+                    state = cPickle.load(f)
+                if state.get('version') == STATE_VERSION and state.get('library_path') == self.src_library_path:
+                    self.previous_state = state['folders']
+                    self.previous_scan = state.get('scan_started')
+            except Exception:
+                traceback.print_exc()
+
+    def save_state(self, state_path):
+        state = {'version':STATE_VERSION, 'library_path':self.src_library_path, 'folders':self.state,
+                 'scan_started':self.scan_started}
+        try:
+            base = os.path.dirname(state_path)
+            if not os.path.exists(base):
+                os.makedirs(base)
+            with open(state_path + '.tmp', 'wb') as f:
+                cPickle.dump(state, f, -1)
+            atomic_rename(state_path + '.tmp', state_path)
+        except Exception:
+            traceback.print_exc()
+
+    def list_folder(self, relpath, with_types=False):
+        # Runs in the thread pool. Return the mtime and the entries of the
+        # folder, re-using the entries from the previous scan if the folder
+        # has not been modified since.
+        path = os.path.join(self.src_library_path, relpath)
+        try:
+            mtime = os.stat(path).st_mtime
+            prev = self.previous_state.get(relpath)
+            if prev is not None and prev[0] == mtime:
+                return mtime, prev[1], True, None
+            entries = os.listdir(path)
+            if with_types:
+                entries = [(x, os.path.isdir(os.path.join(path, x))) for x in entries]
+            return mtime, entries, False, None
+        except Exception:
+            return None, None, False, traceback.format_exc()
+
+    def record_listing(self, relpath, result):
+        mtime, entries, reused, tb = result
+        if tb is not None:
+            self.failed_folders.append((os.path.join(self.src_library_path, relpath), tb, []))
+            return
+        if reused:
+            self.folders_reused += 1
+        else:
+            self.folders_listed += 1
+        # Listings of recently modified folders are not stored, as a change
+        # made in the same second would not change their mtime
+        if mtime < self.scan_started - 2:
+            self.state[relpath] = (mtime, entries)
+        return entries
+
+    def scan_library(self, name_ignores, extension_ignores, max_workers=None, state_path=None):
+        '''
+        Check the library. Folders are listed and checked for existence by
+        max_workers threads, since on network filesystems most of the time
+        is spent waiting for the filesystem. If state_path is specified, the
+        folder listings are stored in it and later scans re-use the listings
+        of folders whose modification time has not changed, see
+        :func:`default_state_path`.
+        '''
         self.ignore_names = frozenset(name_ignores)
         self.ignore_ext = frozenset(['.'+ e for e in extension_ignores])
+        self.scan_started = time.time()
+        self.folders_listed = self.folders_reused = 0
+        self.load_state(state_path)
 
         lib = self.src_library_path
-        for auth_dir in os.listdir(lib):
-            if self.ignore_name(auth_dir) or auth_dir in {'metadata.db',
-                    'metadata_db_prefs_backup.json'}:
-                continue
-            auth_path = os.path.join(lib, auth_dir)
-            # First check: author must be a directory
-            if not os.path.isdir(auth_path):
-                self.invalid_authors.append((auth_dir, auth_dir, 0))
-                continue
-
-            self.potential_authors[auth_dir] = {}
-
-            # Look for titles in the author directories
-            found_titles = False
-            for title_dir in os.listdir(auth_path):
-                if self.ignore_name(title_dir):
+        pool = ThreadPool(max_workers or min(32, 4 * cpu_count()))
+        with closing(pool):
+            result = self.list_folder('', with_types=True)
+            if result[-1] is not None:
+                raise EnvironmentError('Failed to list the library folder %s:\n%s' % (lib, result[-1]))
+            auth_dirs = []
+            for auth_dir, is_dir in self.record_listing('', result):
+                if self.ignore_name(auth_dir) or auth_dir in {'metadata.db',
+                        'metadata_db_prefs_backup.json'}:
                     continue
-                title_path = os.path.join(auth_path, title_dir)
-                db_path = os.path.join(auth_dir, title_dir)
-                m = self.db_id_regexp.search(title_dir)
-                # Second check: title must have an ID and must be a directory
-                if m is None or not os.path.isdir(title_path):
-                    self.invalid_titles.append((auth_dir, db_path, 0))
+                # First check: author must be a directory
+                if not is_dir:
+                    self.invalid_authors.append((auth_dir, auth_dir, 0))
                     continue
+                auth_dirs.append(auth_dir)
 
-                id_ = m.group(1)
-                # Third check: the id_ must be in the DB and the paths must match
-                if self.is_case_sensitive:
-                    if int(id_) not in self.all_ids or \
-                            db_path not in self.all_dbpaths:
-                        self.extra_titles.append((title_dir, db_path, 0))
+            for auth_dir, result in zip(auth_dirs, pool.map(partial(self.list_folder, with_types=True), auth_dirs)):
+                entries = self.record_listing(auth_dir, result)
+                if entries is None:
+                    continue
+                self.potential_authors[auth_dir] = {}
+
+                # Look for titles in the author directories
+                found_titles = False
+                for title_dir, is_dir in entries:
+                    if self.ignore_name(title_dir):
                         continue
-                else:
-                    if int(id_) not in self.all_ids or \
-                            db_path.lower() not in self.all_lc_dbpaths:
-                        self.extra_titles.append((title_dir, db_path, 0))
+                    db_path = os.path.join(auth_dir, title_dir)
+                    m = self.db_id_regexp.search(title_dir)
+                    # Second check: title must have an ID and must be a directory
+                    if m is None or not is_dir:
+                        self.invalid_titles.append((auth_dir, db_path, 0))
                         continue
 
-                # Record the book to check its formats
-                self.book_dirs.append((db_path, title_dir, id_))
-                found_titles = True
-
-            # Fourth check: author directories that contain no titles
-            if not found_titles:
-                self.extra_authors.append((auth_dir, auth_dir, 0))
-
-        for x in self.book_dirs:
-            try:
-                self.process_book(lib, x)
-            except:
-                traceback.print_exc()
-                # Sort-of check: exception processing directory
-                self.failed_folders.append((title_path, traceback.format_exc(), []))
-
-        # Check for formats and covers in db for book dirs that are gone
-        for id_ in self.all_ids:
-            path = self.dbpath(id_)
-            if not os.path.exists(os.path.join(lib, path)):
+                    id_ = m.group(1)
+                    # Third check: the id_ must be in the DB and the paths must match
+                    if self.is_case_sensitive:
+                        if int(id_) not in self.all_ids or \
+                                db_path not in self.all_dbpaths:
+                            self.extra_titles.append((title_dir, db_path, 0))
+                            continue
+                    else:
+                        if int(id_) not in self.all_ids or \
+                                db_path.lower() not in self.all_lc_dbpaths:
+                            self.extra_titles.append((title_dir, db_path, 0))
+                            continue
+
+                    # Record the book to check its formats
+                    self.book_dirs.append((db_path, title_dir, id_))
+                    found_titles = True
+
+                # Fourth check: author directories that contain no titles
+                if not found_titles:
+                    self.extra_authors.append((auth_dir, auth_dir, 0))
+
+            listings = pool.map(self.list_folder, [x[0] for x in self.book_dirs])
+            for x, result in zip(self.book_dirs, listings):
+                filenames = self.record_listing(x[0], result)
+                if filenames is None:
+                    continue
+                try:
+                    self.process_book(lib, x, filenames)
+                except:
+                    traceback.print_exc()
+                    # Sort-of check: exception processing directory
+                    self.failed_folders.append((os.path.join(lib, x[0]), traceback.format_exc(), []))
+
+            # Check for formats and covers in db for book dirs that are gone
+            found = {x[0].replace(os.sep, '/') for x in self.book_dirs}
+            ids = [book_id for book_id in self.all_ids if self.dbpath(book_id) not in found]
+            exists = pool.map(os.path.exists, [os.path.join(lib, self.dbpath(book_id)) for book_id in ids])
+
+        for id_, path_exists in zip(ids, exists):
+            if not path_exists:
+                path = self.dbpath(id_)
                 title_dir = os.path.basename(path)
                 book_formats = frozenset([x for x in
                             self.db.format_files(id_, index_is_id=True)])
@@ -160,6 +264,30 @@ class CheckLibrary(object):
                     self.missing_covers.append((title_dir,
                             os.path.join(path, 'cover.jpg'), id_))
 
+        self.check_format_contents([int(x[2]) for x in self.book_dirs])
+
+        if state_path:
+            self.save_state(state_path)
+
+    def check_format_contents(self, book_ids):
+        '''
+        Find the formats whose contents have changed, using the hashes stored
+        in the database. The formats whose size or modification time no
+        longer match their stored hash are hashed again, formats that have no
+        stored hash are left to the metadata backup thread. Reports the formats
+        that changed since the previous incremental check or, if there was
+        none, the formats found to have changed by this check.
+        '''
+        db = getattr(self.db, 'new_api', self.db)
+        db.update_format_digests(book_ids, hash_new=False)
+        changed = db.formats_changed_since(self.previous_scan or self.scan_started, book_ids=book_ids)
+        for book_id, fmts in sorted(changed.iteritems()):
+            path = self.dbpath(book_id)
+            for name, fmt in self.db.format_files(book_id, index_is_id=True):
+                if fmt in fmts:
+                    self.changed_formats.append((os.path.basename(path),
+                            os.path.join(path, name + '.' + fmt.lower()), book_id))
+
     def is_ebook_file(self, filename):
         ext = os.path.splitext(filename)[1]
         if not ext:
@@ -171,9 +299,11 @@ class CheckLibrary(object):
             return True
         return False
 
-    def process_book(self, lib, book_info):
+    def process_book(self, lib, book_info, filenames=None):
         (db_path, title_dir, book_id) = book_info
-        filenames = frozenset([f for f in os.listdir(os.path.join(lib, db_path))
+        if filenames is None:
+            filenames = os.listdir(os.path.join(lib, db_path))
+        filenames = frozenset([f for f in filenames
                                if os.path.splitext(f)[1] not in self.ignore_ext or
                                f == 'cover.jpg'])
         book_id = int(book_id)
@@ -17,6 +17,7 @@ from calibre.customize.ui import plugin_for_input_format
 from calibre.srv.metadata import book_as_json
 from calibre.srv.render_book import RENDER_VERSION
 from calibre.srv.errors import HTTPNotFound, BookNotFound
+from calibre.srv.pool import BULK
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_library_data, get_db
 
@@ -124,7 +125,7 @@ def job_done(job):
                 failed_jobs[bhash] = (False, traceback.format_exc())
 
 
-@endpoint('/book-manifest/{book_id}/{fmt}', postprocess=json, types={'book_id':int})
+@endpoint('/book-manifest/{book_id}/{fmt}', postprocess=json, types={'book_id':int}, priority=BULK)
 def book_manifest(ctx, rd, book_id, fmt):
     db, library_id = get_library_data(ctx, rd)[:2]
     force_reload = rd.query.get('force_reload') == '1'
@@ -163,7 +164,7 @@ def book_manifest(ctx, rd, book_id, fmt):
     return {'aborted': aborted, 'traceback':tb, 'job_status':status, 'job_id':job_id}
 
 
-@endpoint('/book-file/{book_id}/{fmt}/{size}/{mtime}/{+name}', types={'book_id':int, 'size':int, 'mtime':int})
+@endpoint('/book-file/{book_id}/{fmt}/{size}/{mtime}/{+name}', types={'book_id':int, 'size':int, 'mtime':int}, priority=BULK)
 def book_file(ctx, rd, book_id, fmt, size, mtime, name):
     db, library_id = get_library_data(ctx, rd)[:2]
     if not ctx.has_id(rd, db, book_id):
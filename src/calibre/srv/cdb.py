@@ -13,6 +13,7 @@ from calibre.db.cli import module_for_cmd
 from calibre.ebooks.metadata.meta import get_metadata
 from calibre.srv.changes import books_added, books_deleted
 from calibre.srv.errors import HTTPBadRequest, HTTPForbidden, HTTPNotFound
+from calibre.srv.pool import BACKGROUND
 from calibre.srv.routes import endpoint, json, msgpack_or_json
 from calibre.srv.utils import get_db, get_library_data
 from calibre.utils.serialize import MSGPACK_MIME, json_loads, msgpack_loads
@@ -20,7 +21,7 @@ from calibre.utils.serialize import MSGPACK_MIME, json_loads, msgpack_loads
 receive_data_methods = {'GET', 'POST'}
 
 
-@endpoint('/cdb/cmd/{which}/{version=0}', postprocess=msgpack_or_json, methods=receive_data_methods, cache_control='no-cache')
+@endpoint('/cdb/cmd/{which}/{version=0}', postprocess=msgpack_or_json, methods=receive_data_methods, cache_control='no-cache', priority=BACKGROUND)
 def cdb_run(ctx, rd, which, version):
     try:
         m = module_for_cmd(which)
@@ -57,7 +58,7 @@ def cdb_run(ctx, rd, which, version):
 
 
 @endpoint('/cdb/add-book/{job_id}/{add_duplicates}/{filename}/{library_id=None}',
-          needs_db_write=True, postprocess=json, methods=receive_data_methods, cache_control='no-cache')
+          needs_db_write=True, postprocess=json, methods=receive_data_methods, cache_control='no-cache', priority=BACKGROUND)
 def cdb_add_book(ctx, rd, job_id, add_duplicates, filename, library_id):
     '''
     Add a file as a new book. The file contents must be in the body of the request.
@@ -89,12 +90,12 @@ def cdb_add_book(ctx, rd, job_id, add_duplicates, filename, library_id):
     ans = {'title': mi.title, 'authors': mi.authors, 'languages': mi.languages, 'filename': filename, 'id': job_id}
     if ids:
         ans['book_id'] = ids[0]
-        books_added(ids)
+        ctx.notify_changes(db.backend.library_path, books_added(ids))
     return ans
 
 
 @endpoint('/cdb/delete-books/{book_ids}/{library_id=None}',
-          needs_db_write=True, postprocess=json, methods=receive_data_methods, cache_control='no-cache')
+          needs_db_write=True, postprocess=json, methods=receive_data_methods, cache_control='no-cache', priority=BACKGROUND)
 def cdb_delete_book(ctx, rd, book_ids, library_id):
     db = get_db(ctx, rd, library_id)
     if ctx.restriction_for(rd, db):
@@ -104,5 +105,5 @@ def cdb_delete_book(ctx, rd, book_ids, library_id):
     except Exception:
         raise HTTPBadRequest('invalid book_ids: {}'.format(book_ids))
     db.remove_books(ids)
-    books_deleted(ids)
+    ctx.notify_changes(db.backend.library_path, books_deleted(ids))
     return {}
@@ -8,6 +8,10 @@ from future_builtins import map
 
 class ChangeEvent(object):
 
+    # The names of the fields that may have been changed, None if any field
+    # may have been changed
+    fields = None
+
     def __init__(self):
         pass
 
@@ -33,6 +37,8 @@ class BooksDeleted(ChangeEvent):
 
 class FormatsAdded(ChangeEvent):
 
+    fields = frozenset(('formats', 'size'))
+
     def __init__(self, formats_map):
         ChangeEvent.__init__(self)
         self.formats_map = formats_map
@@ -44,6 +50,8 @@ class FormatsAdded(ChangeEvent):
 
 class FormatsRemoved(ChangeEvent):
 
+    fields = frozenset(('formats', 'size'))
+
     def __init__(self, formats_map):
         ChangeEvent.__init__(self)
         self.formats_map = formats_map
@@ -55,9 +63,11 @@ class FormatsRemoved(ChangeEvent):
 
 class MetadataChanged(ChangeEvent):
 
-    def __init__(self, book_ids):
+    def __init__(self, book_ids, fields=None):
         ChangeEvent.__init__(self)
         self.book_ids = frozenset(book_ids)
+        if fields is not None:
+            self.fields = frozenset(fields)
 
 
 class SavedSearchesChanged(ChangeEvent):
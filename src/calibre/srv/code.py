@@ -21,9 +21,10 @@ from calibre.srv.errors import (
     BookNotFound, HTTPBadRequest, HTTPForbidden, HTTPNotFound
 )
 from calibre.srv.metadata import (
-    book_as_json, categories_as_json, categories_settings, icon_map
+    book_json_field_set, categories_as_json, categories_settings,
+    encoded_book_as_json, icon_map
 )
-from calibre.srv.routes import endpoint, json
+from calibre.srv.routes import EncodedJSON, EncodedJSONMap, endpoint, json
 from calibre.srv.utils import get_library_data, get_use_roman
 from calibre.utils.config import prefs, tweaks
 from calibre.utils.icu import sort_key
@@ -194,17 +195,18 @@ def get_library_init_data(ctx, rd, db, num, sorts, orders, vl):
         ans['field_metadata'] = db.field_metadata.all_metadata()
         ans['virtual_libraries'] = db._pref('virtual_libraries', {})
         ans['book_display_fields'] = get_field_list(db)
-        mdata = ans['metadata'] = {}
+        mdata = ans['metadata'] = EncodedJSONMap()
         try:
             extra_books = set(
                 int(x) for x in rd.query.get('extra_books', '').split(',')
             )
         except Exception:
             extra_books = ()
+        field_set = book_json_field_set(db)
         for coll in (ans['search_result']['book_ids'], extra_books):
             for book_id in coll:
                 if book_id not in mdata:
-                    data = book_as_json(db, book_id)
+                    data = encoded_book_as_json(db, book_id, field_set)
                     if data is not None:
                         mdata[book_id] = data
     return ans
@@ -287,9 +289,10 @@ def more_books(ctx, rd):
         ans['search_result'] = search_result(
             ctx, rd, db, query, num, offset, sorts, orders, vl
         )
-        mdata = ans['metadata'] = {}
+        mdata = ans['metadata'] = EncodedJSONMap()
+        field_set = book_json_field_set(db)
         for book_id in ans['search_result']['book_ids']:
-            data = book_as_json(db, book_id)
+            data = encoded_book_as_json(db, book_id, field_set)
             if data is not None:
                 mdata[book_id] = data
 
@@ -329,7 +332,7 @@ def get_books(ctx, rd):
     searchq = rd.query.get('search', '')
     db = get_library_data(ctx, rd)[0]
     ans = {}
-    mdata = ans['metadata'] = {}
+    mdata = ans['metadata'] = EncodedJSONMap()
     with db.safe_read_lock:
         try:
             ans['search_result'] = search_result(
@@ -339,8 +342,9 @@ def get_books(ctx, rd):
             # This must not be translated as it is used by the front end to
             # detect invalid search expressions
             raise HTTPBadRequest('Invalid search expression: %s' % as_unicode(err))
+        field_set = book_json_field_set(db)
         for book_id in ans['search_result']['book_ids']:
-            data = book_as_json(db, book_id)
+            data = encoded_book_as_json(db, book_id, field_set)
             if data is not None:
                 mdata[book_id] = data
     return ans
@@ -360,11 +364,11 @@ def book_metadata(ctx, rd, book_id):
         book_id = random.choice(tuple(all_ids))
     elif not ctx.has_id(rd, db, book_id):
         raise BookNotFound(book_id, db)
-    data = book_as_json(db, book_id)
+    data = encoded_book_as_json(db, book_id)
     if data is None:
         raise BookNotFound(book_id, db)
-    data['id'] = book_id  # needed for random book view (when book_id=0)
-    return data
+    # The id is needed for random book view (when book_id=0)
+    return EncodedJSON(data[:-1] + (b',"id":%d}' % book_id))
 
 
 @endpoint('/interface-data/tag-browser')
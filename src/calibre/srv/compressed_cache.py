@@ -0,0 +1,187 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2026, agent <agent at local>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+from collections import OrderedDict, namedtuple
+from functools import partial
+from itertools import count
+from Queue import Full
+from threading import Lock
+
+from calibre.srv.pool import BACKGROUND
+from calibre.utils.speedups import ReadOnlyFileBuffer
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+CachedVariant = namedtuple('CachedVariant', 'data path size')
+
+
+def etag_for_encoding(etag, encoding):
+    ' The ETag of the variant of a response compressed with encoding '
+    if etag.endswith('"'):
+        return etag[:-1] + '-' + encoding + '"'
+    return etag + '-' + encoding
+
+
+def etag_without_encoding(etag):
+    for encoding in ('gzip', 'br'):
+        suffix = '-' + encoding + '"'
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)] + '"'
+    return etag
+
+
+class CompressedCache(object):
+
+    '''
+    An LRU cache of compressed response bodies, keyed by the ETag of the
+    uncompressed response, the encoding and the request URI. Small bodies are kept in memory,
+    larger ones are stored as files, so that they can be sent with
+    sendfile(). The files are written by the server's thread pool, so as not
+    to block the server loop thread, until then the body is served from
+    memory.
+    '''
+
+    # Bodies smaller than this are kept in memory
+    MAX_MEMORY_ENTRY_SIZE = 64 * 1024
+    # Total size of bodies kept in memory
+    MAX_MEMORY_SIZE = 16 * 1024 * 1024
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.memory_size = self.disk_size = 0
+        self.file_counter = count()
+        self.cache_dir = None
+        self.lock = Lock()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            return self._get(key)
+
+    def _get(self, key):
+        ans = self.entries.pop(key, None)
+        if ans is not None:
+            self.entries[key] = ans
+        return ans
+
+    def open(self, key):
+        ''' Return a (file object, size) tuple for the cached variant, or
+        (None, 0) if there is no such variant. '''
+        with self.lock:
+            entry = self._get(key)
+            if entry is None:
+                return None, 0
+            if entry.data is not None:
+                return ReadOnlyFileBuffer(entry.data), entry.size
+            try:
+                return lopen(entry.path, 'rb'), entry.size
+            except EnvironmentError:
+                # The temporary directory of a previous run of the server loop
+                self._remove(key)
+                return None, 0
+
+    def remove(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            if entry.path is None:
+                self.memory_size -= entry.size
+            else:
+                self.disk_size -= entry.size
+                try:
+                    os.remove(entry.path)
+                except EnvironmentError:
+                    pass  # The file is open on windows, it will be removed with tdir
+
+    def put(self, key, data, tdir, max_size, pool=None):
+        ''' Store data in the cache. Bodies too large to be kept in memory are
+        written to a file by a job in pool, or immediately if pool is None. '''
+        size = len(data)
+        with self.lock:
+            self._remove(key)
+            if size <= self.MAX_MEMORY_ENTRY_SIZE:
+                self.entries[key] = CachedVariant(data, None, size)
+                self.memory_size += size
+            else:
+                if size > max_size:
+                    return
+                if self.cache_dir is None or not os.path.isdir(self.cache_dir):
+                    self.cache_dir = os.path.join(tdir, 'compressed')
+                    if not os.path.isdir(self.cache_dir):
+                        os.mkdir(self.cache_dir)
+                path = os.path.join(self.cache_dir, '%d.%s' % (next(self.file_counter), key[1]))
+                entry = self.entries[key] = CachedVariant(data, path, size)
+                self.disk_size += size
+            self._prune(max_size)
+        if size > self.MAX_MEMORY_ENTRY_SIZE:
+            if pool is None:
+                self.write(key, entry)
+            else:
+                try:
+                    pool.put_nowait(None, partial(self.write, key, entry), priority=BACKGROUND)
+                except Full:
+                    self.remove(key)
+
+    def write(self, key, entry):
+        ''' Write the body of entry to its file and stop keeping it in
+        memory, runs in a worker thread. '''
+        try:
+            with lopen(entry.path, 'wb') as f:
+                f.write(entry.data)
+        except EnvironmentError:
+            with self.lock:
+                if self.entries.get(key) is entry:
+                    self._remove(key)
+            return
+        with self.lock:
+            if self.entries.get(key) is entry:
+                self.entries[key] = entry._replace(data=None)
+                return
+        # The entry was removed while the file was being written
+        try:
+            os.remove(entry.path)
+        except EnvironmentError:
+            pass
+
+    def prune(self, max_size):
+        with self.lock:
+            self._prune(max_size)
+
+    def _prune(self, max_size):
+        for key, entry in tuple(self.entries.iteritems()):
+            if self.memory_size <= self.MAX_MEMORY_SIZE and self.disk_size <= max_size:
+                break
+            if entry.path is None:
+                if self.memory_size > self.MAX_MEMORY_SIZE:
+                    self._remove(key)
+            elif self.disk_size > max_size:
+                self._remove(key)
+
+    def tee(self, key, chunks, tdir, max_size, pool=None):
+        ''' Yield the compressed chunks, storing them in the cache once all of
+        them have been generated. If the response is not completely sent, for
+        example, because the client disconnects, nothing is stored. '''
+        parts, size = [], 0
+        for chunk in chunks:
+            if parts is not None:
+                size += len(chunk)
+                if size > max_size:
+                    parts = None
+                else:
+                    parts.append(chunk)
+            yield chunk
+        if parts is not None:
+            self.put(key, b''.join(parts), tdir, max_size, pool)
@@ -23,6 +23,7 @@ from calibre.ebooks.metadata.meta import set_metadata
 from calibre.ebooks.metadata.opf2 import metadata_to_opf
 from calibre.library.save_to_disk import find_plugboard
 from calibre.srv.errors import HTTPNotFound, BookNotFound
+from calibre.srv.pool import BULK
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import http_date, get_db, get_use_roman
 from calibre.utils.config_base import tweaks
@@ -285,7 +286,7 @@ def icon(ctx, rd, which):
         return ans
 
 
-@endpoint('/get/{what}/{book_id}/{library_id=None}', android_workaround=True)
+@endpoint('/get/{what}/{book_id}/{library_id=None}', android_workaround=True, priority=BULK)
 def get(ctx, rd, what, book_id, library_id):
     book_id, rest = book_id.partition('_')[::2]
     try:
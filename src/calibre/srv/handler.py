@@ -199,6 +199,7 @@ class Handler(object):
         self.router.finalize()
         self.router.ctx.url_for = self.router.url_for
         self.dispatch = self.router.dispatch
+        self.classify_request = self.router.classify_request
 
     def set_log(self, log):
         self.router.ctx.log = log
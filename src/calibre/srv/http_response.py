@@ -16,7 +16,9 @@ from future_builtins import map
 
 from calibre import guess_type, force_unicode
 from calibre.constants import __version__, plugins
+from calibre.srv.compressed_cache import CompressedCache, brotli, etag_for_encoding, etag_without_encoding
 from calibre.srv.loop import WRITE
+from calibre.srv.pool import INTERACTIVE
 from calibre.srv.errors import HTTPSimpleResponse
 from calibre.srv.http_request import HTTPRequest, read_headers
 from calibre.srv.sendfile import file_metadata, sendfile_to_socket_async, CannotSendfile, SendfileInterrupted
@@ -29,6 +31,7 @@ from calibre.utils.monotonic import monotonic
 Range = namedtuple('Range', 'start stop size')
 MULTIPART_SEPARATOR = uuid.uuid4().hex.decode('ascii')
 COMPRESSIBLE_TYPES = {'application/json', 'application/javascript', 'application/xml', 'application/oebps-package+xml'}
+ACCEPTED_ENCODINGS = frozenset({'gzip', 'br'} if brotli is not None else {'gzip'})
 zlib, zlib2_err = plugins['zlib2']
 if zlib2_err:
     raise RuntimeError('Failed to laod the zlib2 module with error: ' + zlib2_err)
@@ -79,7 +82,9 @@ def parse_multipart_byterange(buf, content_type):  # {{{
 
 
 def parse_if_none_match(val):  # {{{
-    return {x.strip() for x in val.split(',')}
+    # A compressed variant of a response is not modified if the uncompressed
+    # response is not
+    return {etag_without_encoding(x.strip()) for x in val.split(',')}
 # }}}
 
 
@@ -179,6 +184,16 @@ def compress_readable_output(src_file, compress_level=6):
             data = gzip_prefix() + data
         yield data
     yield zobj.flush() + struct.pack(b"<L", crc & 0xffffffff) + struct.pack(b"<L", size)
+
+
+def brotli_compress_readable_output(src_file, quality=5):
+    compressor = brotli.Compressor(quality=quality)
+    while True:
+        data = src_file.read(DEFAULT_BUFFER_SIZE)
+        if not data:
+            break
+        yield compressor.process(data)
+    yield compressor.finish()
 # }}}
 
 
@@ -356,6 +371,8 @@ class StaticOutput(object):
 class HTTPConnection(HTTPRequest):
 
     use_sendfile = False
+    compressed_cache = None
+    classify_request = None
 
     def write(self, buf, end=None):
         pos = buf.tell()
@@ -435,7 +452,10 @@ class HTTPConnection(HTTPRequest):
             self.remote_addr, self.remote_port, self.is_local_connection,
             self.translator_cache, self.tdir, self.forwarded_for
         )
-        self.queue_job(self.run_request_handler, data)
+        priority, key = INTERACTIVE, None
+        if self.classify_request is not None:
+            priority, key = self.classify_request(data)
+        self.queue_job(self.run_request_handler, data, priority=priority, key=key)
 
     def run_request_handler(self, data):
         result = self.request_handler(data)
@@ -622,7 +642,7 @@ class HTTPConnection(HTTPRequest):
     def finalize_output(self, output, request, is_http1):
         none_match = parse_if_none_match(request.inheaders.get('If-None-Match', ''))
         if isinstance(output, ETaggedDynamicOutput):
-            matched = '*' in none_match or (output.etag and output.etag in none_match)
+            matched = '*' in none_match or (output.etag and etag_without_encoding(output.etag) in none_match)
             if matched:
                 if self.method in ('GET', 'HEAD'):
                     self.send_not_modified(output.etag)
@@ -654,11 +674,26 @@ class HTTPConnection(HTTPRequest):
         ct = outheaders.get('Content-Type', '').partition(';')[0]
         compressible = (not ct or ct.startswith('text/') or ct.startswith('image/svg') or
                         ct.partition(';')[0] in COMPRESSIBLE_TYPES)
-        compressible = (compressible and request.status_code == httplib.OK and
-                        (opts.compress_min_size > -1 and output.content_length >= opts.compress_min_size) and
-                        acceptable_encoding(request.inheaders.get('Accept-Encoding', '')) and not is_http1)
-        accept_ranges = (not compressible and output.accept_ranges is not None and request.status_code == httplib.OK and
-                        not is_http1)
+        encoding = (compressible and request.status_code == httplib.OK and
+                    (opts.compress_min_size > -1 and output.content_length >= opts.compress_min_size) and
+                    acceptable_encoding(request.inheaders.get('Accept-Encoding', ''), ACCEPTED_ENCODINGS) and not is_http1)
+        compressible = bool(encoding)
+        # Responses with an ETag are identical for all clients, so their
+        # compressed variants are cached and served as is, with support for
+        # ranges. An ETag only identifies the response for a single URL, for
+        # example, all the MathJax files share one, so the URL is part of the
+        # key.
+        cache_key = cached = None
+        cache_size = int(opts.compressed_cache_size * 1024 * 1024)
+        if compressible and output.etag and cache_size > 0 and self.compressed_cache is not None:
+            cache_key = (output.etag, encoding, self.request_line.split(b' ', 2)[1])
+            src, size = self.compressed_cache.open(cache_key)
+            if src is not None:
+                uncompressed_length = output.content_length
+                cached = output = ReadableOutput(src, etag=etag_for_encoding(output.etag, encoding), content_length=size)
+                output.use_sendfile = not isinstance(src, ReadOnlyFileBuffer)
+        accept_ranges = ((cached is not None or not compressible) and output.accept_ranges is not None and
+                         request.status_code == httplib.OK and not is_http1)
         ranges = get_ranges(request.inheaders.get('Range'), output.content_length) if output.accept_ranges and self.method in ('GET', 'HEAD') else None
         if_range = (request.inheaders.get('If-Range') or '').strip()
         if if_range and if_range != output.etag:
@@ -669,7 +704,7 @@ class HTTPConnection(HTTPRequest):
         for header in ('Accept-Ranges', 'Content-Encoding', 'Transfer-Encoding', 'ETag', 'Content-Length'):
             outheaders.pop(header, all=True)
 
-        matched = '*' in none_match or (output.etag and output.etag in none_match)
+        matched = '*' in none_match or (output.etag and etag_without_encoding(output.etag) in none_match)
         if matched:
             if self.method in ('GET', 'HEAD'):
                 self.send_not_modified(output.etag)
@@ -679,19 +714,33 @@ class HTTPConnection(HTTPRequest):
 
         output.ranges = None
 
+        if cached is not None:
+            outheaders.set('Content-Encoding', encoding, replace_all=True)
+            if uncompressed_length:
+                outheaders.set('Calibre-Uncompressed-Length', '%d' % uncompressed_length)
+        compress_now = compressible and cached is None and not ranges
+        if compress_now:
+            outheaders.set('Content-Encoding', encoding, replace_all=True)
+            if getattr(output, 'content_length', None):
+                outheaders.set('Calibre-Uncompressed-Length', '%d' % output.content_length)
+            etag = output.etag
+            if encoding == 'br':
+                chunks = brotli_compress_readable_output(output.src_file, quality=(9 if cache_key else 5))
+            else:
+                chunks = compress_readable_output(output.src_file, compress_level=(9 if cache_key else 6))
+            if cache_key is not None:
+                chunks = self.compressed_cache.tee(cache_key, chunks, self.tdir, cache_size, self.pool)
+            if etag:
+                etag = etag_for_encoding(etag, encoding)
+            output = GeneratedOutput(chunks, etag=etag)
         if output.etag and self.method in ('GET', 'HEAD'):
             outheaders.set('ETag', output.etag, replace_all=True)
         if accept_ranges:
             outheaders.set('Accept-Ranges', 'bytes', replace_all=True)
-        if compressible and not ranges:
-            outheaders.set('Content-Encoding', 'gzip', replace_all=True)
-            if getattr(output, 'content_length', None):
-                outheaders.set('Calibre-Uncompressed-Length', '%d' % output.content_length)
-            output = GeneratedOutput(compress_readable_output(output.src_file), etag=output.etag)
-        if output.content_length is not None and not compressible and not ranges:
+        if output.content_length is not None and not compress_now and not ranges:
             outheaders.set('Content-Length', '%d' % output.content_length, replace_all=True)
 
-        if compressible or output.content_length is None:
+        if compress_now or output.content_length is None:
             outheaders.set('Transfer-Encoding', 'chunked', replace_all=True)
 
         if ranges:
@@ -710,10 +759,11 @@ class HTTPConnection(HTTPRequest):
         return output
 
 
-def create_http_handler(handler=None, websocket_handler=None):
+def create_http_handler(handler=None, websocket_handler=None, classify_request=None):
     from calibre.srv.web_socket import WebSocketConnection
     static_cache = {}
     translator_cache = {}
+    compressed_cache = CompressedCache()
     if handler is None:
         def dummy_http_handler(data):
             return 'Hello'
@@ -725,6 +775,8 @@ def create_http_handler(handler=None, websocket_handler=None):
         ans.request_handler = handler
         ans.websocket_handler = websocket_handler
         ans.static_cache = static_cache
+        ans.compressed_cache = compressed_cache
+        ans.classify_request = classify_request
         ans.translator_cache = translator_cache
         return ans
     return wrapper
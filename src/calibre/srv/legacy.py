@@ -15,6 +15,7 @@ from calibre.db.view import sanitize_sort_field_name
 from calibre.ebooks.metadata import authors_to_string
 from calibre.srv.content import get, book_filename
 from calibre.srv.errors import HTTPRedirect, HTTPBadRequest
+from calibre.srv.pool import BULK
 from calibre.srv.routes import endpoint
 from calibre.srv.utils import get_library_data, http_date
 from calibre.utils.cleantext import clean_xml_chars
@@ -273,7 +274,7 @@ def stanza(ctx, rd, rest):
     raise HTTPRedirect(ctx.url_for('/opds'))
 
 
-@endpoint('/legacy/get/{what}/{book_id}/{library_id}/{+filename=""}', android_workaround=True)
+@endpoint('/legacy/get/{what}/{book_id}/{library_id}/{+filename=""}', android_workaround=True, priority=BULK)
 def legacy_get(ctx, rd, what, book_id, library_id, filename):
     # See https://www.mobileread.com/forums/showthread.php?p=3531644 for why
     # this is needed for Kobo browsers
@@ -6,11 +6,13 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import os
 from collections import OrderedDict, defaultdict
-from threading import RLock as Lock
+from threading import RLock as Lock, Thread
 
 from calibre import filesystem_encoding
 from calibre.db.cache import Cache
 from calibre.db.legacy import LibraryDatabase, create_backend, set_global_state
+from calibre.db.prerender import CompositeRenderer
+from calibre.srv.metadata import attach_book_json_cache
 from calibre.utils.filenames import samefile as _samefile
 from calibre.utils.monotonic import monotonic
 
@@ -45,9 +47,29 @@ def init_library(library_path, is_default_library):
         create_backend(
             library_path, load_user_formatter_functions=is_default_library))
     db.init()
+    attach_book_json_cache(db)
+    # Run the searches for the virtual libraries and saved searches in the
+    # background, so that the first request that uses them is fast
+    t = Thread(target=db.warm_search_cache, name='WarmSearchCache')
+    t.daemon = True
+    t.start()
+    if db.composites:
+        db.composite_renderer = CompositeRenderer(db)
+        db.composite_renderer.start()
     return db
 
 
+def close_library(db):
+    ' Stop the background threads started by init_library() and close the library '
+    if db is None:
+        return
+    renderer = getattr(getattr(db, 'new_api', db), 'composite_renderer', None)
+    if renderer is not None:
+        renderer.stop()
+        renderer.join()
+    db.close()
+
+
 def make_library_id_unique(library_id, existing):
     bname = library_id
     c = 0
@@ -112,10 +134,33 @@ class LibraryBroker(object):
         library_path = self.original_path_map.get(library_path, library_path)
         return init_library(library_path, is_default_library)
 
+    def reload_library(self, library_path, fields=None, book_ids=None):
+        ''' Re-read the data of the library at library_path from the
+        database, if it is loaded. Used when the library has been changed by
+        another process. If fields is not None, only the data of those fields
+        is re-read and only the cached data of book_ids is cleared. Returns
+        True if the library was reloaded. '''
+        path = canonicalize_path(library_path)
+        with self:
+            for library_id, q in self.lmap.iteritems():
+                if samefile(path, q):
+                    break
+            else:
+                return False
+            db = self.loaded_dbs.get(library_id)
+        if db is None:
+            return False
+        db = getattr(db, 'new_api', db)
+        if fields is None:
+            db.reload_from_db()
+        else:
+            db.reload_fields_from_db(fields, book_ids)
+        return True
+
     def close(self):
         with self:
             for db in self.loaded_dbs.itervalues():
-                getattr(db, 'close', lambda: None)()
+                close_library(db)
             self.lmap, self.loaded_dbs = OrderedDict(), {}
 
     @property
@@ -168,7 +213,9 @@ class GuiLibraryBroker(LibraryBroker):
 
     def init_library(self, library_path, is_default_library):
         library_path = self.original_path_map.get(library_path, library_path)
-        return LibraryDatabase(library_path, is_second_db=True)
+        db = LibraryDatabase(library_path, is_second_db=True)
+        attach_book_json_cache(db)
+        return db
 
     def get(self, library_id=None):
         try:
@@ -229,6 +276,7 @@ class GuiLibraryBroker(LibraryBroker):
             self.original_path_map[newloc] = original_path
             self.loaded_dbs[library_id] = db
         db.new_api.server_library_id = library_id
+        attach_book_json_cache(db)
         if olddb is not None and samefile(path_for_db(olddb), path_for_db(db)):
             # This happens after a restore database, for example
             olddb.close(), olddb.break_cycles()
@@ -246,7 +294,7 @@ class GuiLibraryBroker(LibraryBroker):
             if library_id != self.gui_library_id and now - self.last_used_times[
                 library_id] > EXPIRED_AGE:
                 db = self.loaded_dbs.pop(library_id)
-                db.close()
+                close_library(db)
                 db.break_cycles()
 
     def prune_loaded_dbs(self):
@@ -263,7 +311,7 @@ class GuiLibraryBroker(LibraryBroker):
                 return
             db = self.loaded_dbs.pop(library_id, None)
             if db is not None:
-                db.close()
+                close_library(db)
                 db.break_cycles()
 
     def remove_library(self, path):
@@ -278,5 +326,5 @@ class GuiLibraryBroker(LibraryBroker):
                 library_id, None), self.original_path_map.pop(path, None)
             db = self.loaded_dbs.pop(library_id, None)
             if db is not None:
-                db.close()
+                close_library(db)
                 db.break_cycles()
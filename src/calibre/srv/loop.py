@@ -6,17 +6,21 @@ from __future__ import (unicode_literals, division, absolute_import,
 __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
-import ssl, socket, select, os, traceback
+import ssl, socket, select, os, traceback, weakref
+from collections import deque
+from heapq import heappush, heappop, heapify
 from io import BytesIO
+from itertools import count
 from Queue import Empty, Full
 from functools import partial
 
 from calibre import as_unicode
 from calibre.ptempfile import TemporaryDirectory
 from calibre.srv.errors import JobQueueFull
-from calibre.srv.pool import ThreadPool, PluginPool
+from calibre.srv.pool import ThreadPool, PluginPool, INTERACTIVE
 from calibre.srv.opts import Options
 from calibre.srv.jobs import JobsManager
+from calibre.srv.poller import create_poller
 from calibre.srv.utils import (
     socket_errors_socket_closed, socket_errors_nonblocking, HandleInterrupt,
     socket_errors_eintr, start_cork, stop_cork, DESIRED_SEND_BUFFER_SIZE,
@@ -120,6 +124,10 @@ class ReadBuffer(object):  # {{{
 
 class Connection(object):  # {{{
 
+    # Set by the server loop, called whenever wait_for changes, so that the
+    # loop can update what the socket is registered for before the next poll
+    on_state_change = None
+
     def __init__(self, socket, opts, ssl_context, tdir, addr, pool, log, access_log, wakeup):
         self.opts, self.pool, self.log, self.wakeup, self.access_log = opts, pool, log, wakeup, access_log
         try:
@@ -164,6 +172,16 @@ class Connection(object):  # {{{
         if self.send_bufsize != self.orig_send_bufsize:
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.orig_send_bufsize)
 
+    @property
+    def wait_for(self):
+        return self._wait_for
+
+    @wait_for.setter
+    def wait_for(self, val):
+        self._wait_for = val
+        if self.on_state_change is not None:
+            self.on_state_change()
+
     def set_state(self, wait_for, func, *args, **kwargs):
         self.wait_for = wait_for
         if args or kwargs:
@@ -283,18 +301,21 @@ class Connection(object):  # {{{
 
     def close(self):
         self.ready = False
-        self.handle_event = None  # prevent reference cycles
+        self.handle_event = self.on_state_change = None  # prevent reference cycles
         try:
             self.socket.shutdown(socket.SHUT_WR)
             self.socket.close()
         except socket.error:
             pass
 
-    def queue_job(self, func, *args):
+    def queue_job(self, func, *args, **kwargs):
+        # The priority and key (the library) of the job, used to schedule it,
+        # can be specified as keyword arguments
+        priority, key = kwargs.pop('priority', INTERACTIVE), kwargs.pop('key', None)
         if args:
             func = partial(func, *args)
         try:
-            self.pool.put_nowait(self.socket.fileno(), func)
+            self.pool.put_nowait(self.socket.fileno(), func, priority=priority, key=key)
         except Full:
             raise JobQueueFull()
         self.set_state(WAIT, self._job_done)
@@ -326,6 +347,7 @@ class Connection(object):  # {{{
 class ServerLoop(object):
 
     LISTENING_MSG = 'calibre server listening on'
+    ACCEPT_BATCH = 32
 
     def __init__(
         self,
@@ -337,7 +359,11 @@ class ServerLoop(object):
         log=None,
         # A calibre logging object for access logging, by default no access
         # logging is performed
-        access_log=None
+        access_log=None,
+        # Set SO_REUSEPORT on the listening socket, so that several processes
+        # can listen on the same port, with the kernel distributing incoming
+        # connections between them
+        reuse_port=False
     ):
         self.ready = False
         self.handler = handler
@@ -345,6 +371,7 @@ class ServerLoop(object):
         self.log = log or ThreadSafeLog(level=ThreadSafeLog.DEBUG)
         self.jobs_manager = JobsManager(self.opts, self.log)
         self.access_log = access_log
+        self.reuse_port = reuse_port
 
         ba = (self.opts.listen_on, int(self.opts.port))
         if not ba[0]:
@@ -353,6 +380,14 @@ class ServerLoop(object):
         self.bind_address = ba
         self.bound_address = None
         self.connection_map = {}
+        self.poller = None
+        # Sockets whose connections changed state since the last poll, a
+        # deque as connections can change state from other threads
+        self.changed = deque()
+        # A heap of (deadline, sequence number, socket, weakref to connection)
+        # used to find connections that have been idle for too long
+        self.timeouts = []
+        self.timeout_seq = count()
 
         self.ssl_context = None
         if self.opts.ssl_certfile is not None and self.opts.ssl_keyfile is not None:
@@ -369,7 +404,10 @@ class ServerLoop(object):
                 self.bind_address = self.pre_activated_socket.getsockname()
 
         self.create_control_connection()
-        self.pool = ThreadPool(self.log, self.job_completed, count=self.opts.worker_count)
+        self.pool = ThreadPool(
+            self.log, self.job_completed, count=self.opts.worker_count, max_count=self.opts.max_worker_count,
+            reserved_count=self.opts.reserved_worker_count, max_per_key=self.opts.max_slow_requests_per_library,
+            target_queue_time=self.opts.target_queue_time)
         self.plugin_pool = PluginPool(self, plugins)
 
     def on_ssl_servername(self, socket, server_name, ssl_context):
@@ -381,7 +419,11 @@ class ServerLoop(object):
             return ssl.ALERT_DESCRIPTION_NO_RENEGOTIATION
 
     def create_control_connection(self):
+        if self.poller is not None:
+            self.poller.unregister(self.control_out.fileno())
         self.control_in, self.control_out = create_sock_pair()
+        if self.poller is not None:
+            self.poller.register(self.control_out.fileno())
 
     def __str__(self):
         return "%s(%r)" % (self.__class__.__name__, self.bind_address)
@@ -443,10 +485,15 @@ class ServerLoop(object):
 
     def serve(self):
         self.connection_map = {}
+        self.changed.clear()
+        del self.timeouts[:]
         self.socket.listen(min(socket.SOMAXCONN, 128))
         self.bound_address = ba = self.socket.getsockname()
         if isinstance(ba, tuple):
             ba = ':'.join(map(type(''), ba))
+        self.poller = create_poller(self.opts.event_loop)
+        self.poller.register(self.socket.fileno())
+        self.poller.register(self.control_out.fileno())
         self.pool.start()
         with TemporaryDirectory(prefix='srv-') as tdir:
             self.tdir = tdir
@@ -474,6 +521,8 @@ class ServerLoop(object):
 
     def setup_socket(self):
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
         # If listening on the IPV6 any address ('::' = IN6ADDR_ANY),
@@ -496,62 +545,94 @@ class ServerLoop(object):
         self.setup_socket()
         self.socket.bind(self.bind_address)
 
-    def tick(self):
-        now = monotonic()
-        read_needed, write_needed, readable, remove, close_needed = [], [], [], [], []
+    def add_timeout(self, s, conn, deadline):
+        heappush(self.timeouts, (deadline, next(self.timeout_seq), s, weakref.ref(conn)))
+
+    def check_timeouts(self, now):
+        # Entries are not removed when a connection is active or closed,
+        # instead the deadline is re-checked when the entry is reached
+        heap, timeout = self.timeouts, self.opts.timeout
+        while heap and heap[0][0] <= now:
+            deadline, seq, s, ref = heappop(heap)
+            conn = ref()
+            if conn is None or self.connection_map.get(s) is not conn:
+                continue
+            deadline = conn.last_activity + timeout
+            if deadline > now:
+                self.add_timeout(s, conn, deadline)
+            elif conn.handle_timeout():
+                conn.last_activity = now
+                self.changed.append(s)
+                self.add_timeout(s, conn, now + timeout)
+            else:
+                self.log('Closing connection because of extended inactivity: %s' % conn.state_description)
+                self.close(s, conn)
+        if len(heap) > 2 * len(self.connection_map) + 64:
+            # Drop the entries of closed connections
+            cmap = self.connection_map
+            heap[:] = [x for x in heap if cmap.get(x[2]) is x[3]()]
+            heapify(heap)
+
+    def update_registrations(self):
+        # Update what the sockets of changed connections are registered for
+        # and return the sockets that have data buffered, which can be read
+        # without waiting
+        readable = []
         has_ssl = self.ssl_context is not None
-        for s, conn in self.connection_map.iteritems():
-            if now - conn.last_activity > self.opts.timeout:
-                if conn.handle_timeout():
-                    conn.last_activity = now
-                else:
-                    remove.append((s, conn))
-                    continue
+        changed, cmap, register = self.changed, self.connection_map, self.poller.register
+        seen = set()
+        while True:
+            try:
+                s = changed.popleft()
+            except IndexError:
+                break
+            if s in seen:
+                continue
+            seen.add(s)
+            conn = cmap.get(s)
+            if conn is None:
+                continue
             wf = conn.wait_for
-            if wf is READ or wf is RDWR:
-                if wf is RDWR:
-                    write_needed.append(s)
+            wants_read = wf is READ or wf is RDWR
+            register(s, wants_read, wf is WRITE or wf is RDWR)
+            if wants_read:
                 if conn.read_buffer.has_data:
                     readable.append(s)
-                else:
-                    if has_ssl:
-                        conn.drain_ssl_buffer()
-                        if conn.ready:
-                            (readable if conn.read_buffer.has_data else read_needed).append(s)
-                        else:
-                            close_needed.append((s, conn))
-                    else:
-                        read_needed.append(s)
-            elif wf is WRITE:
-                write_needed.append(s)
-
-        for s, conn in remove:
-            self.log('Closing connection because of extended inactivity: %s' % conn.state_description)
-            self.close(s, conn)
+                elif has_ssl:
+                    conn.drain_ssl_buffer()
+                    if not conn.ready:
+                        self.close(s, conn)
+                    elif conn.read_buffer.has_data:
+                        readable.append(s)
+        return readable
 
-        for x, conn in close_needed:
-            self.close(s, conn)
+    def tick(self):
+        now = monotonic()
+        self.check_timeouts(now)
+        readable = self.update_registrations()
 
         if readable:
             writable = []
+            # Sockets with buffered data are handled before waiting, make
+            # sure they are checked again after being handled
+            self.changed.extend(readable)
         else:
+            timeout = self.opts.timeout
+            if self.timeouts:
+                timeout = max(0, min(timeout, self.timeouts[0][0] - now))
             try:
-                readable, writable, _ = select.select([self.socket.fileno(), self.control_out.fileno()] + read_needed, write_needed, [], self.opts.timeout)
+                readable, writable = self.poller.poll(timeout)
             except ValueError:  # self.socket.fileno() == -1
                 self.ready = False
                 self.log.error('Listening socket was unexpectedly terminated')
                 return
-            except (select.error, socket.error) as e:
+            except (select.error, EnvironmentError) as e:
                 # select.error has no errno attribute. errno is instead
                 # e.args[0]
                 if getattr(e, 'errno', e.args[0]) in socket_errors_eintr:
                     return
-                for s, conn in tuple(self.connection_map.iteritems()):
-                    try:
-                        select.select([s], [], [], 0)
-                    except (select.error, socket.error) as e:
-                        if getattr(e, 'errno', e.args[0]) not in socket_errors_eintr:
-                            self.close(s, conn)  # Bad socket, discard
+                for s in self.poller.bad_fds(tuple(self.connection_map)):
+                    self.close(s, self.connection_map[s])  # Bad socket, discard
                 return
 
         if not self.ready:
@@ -565,6 +646,10 @@ class ServerLoop(object):
                 conn.handle_event(event)
                 if not conn.ready:
                     self.close(s, conn)
+                else:
+                    # The handler may have buffered data without changing
+                    # state
+                    self.changed.append(s)
             except JobQueueFull:
                 self.log.exception('Server busy handling request: %s' % conn.state_description)
                 if conn.ready:
@@ -613,6 +698,10 @@ class ServerLoop(object):
 
     def close(self, s, conn):
         self.connection_map.pop(s, None)
+        if self.poller is not None:
+            # Must be done before the socket is closed, as its file
+            # descriptor can be re-used as soon as it is
+            self.poller.unregister(s)
         conn.close()
 
     def get_actions(self, readable, writable):
@@ -620,12 +709,19 @@ class ServerLoop(object):
         control = self.control_out.fileno()
         for s in readable:
             if s == listener:
-                sock, addr = self.accept()
-                if sock is not None:
+                # Accept all pending connections, so that a burst of
+                # connections does not need one poll per connection
+                for i in xrange(self.ACCEPT_BATCH):
+                    sock, addr = self.accept()
+                    if sock is None:
+                        break
                     s = sock.fileno()
                     if s > -1:
                         self.connection_map[s] = conn = self.handler(
                             sock, self.opts, self.ssl_context, self.tdir, addr, self.pool, self.log, self.access_log, self.wakeup)
+                        conn.on_state_change = partial(self.changed.append, s)
+                        self.changed.append(s)
+                        self.add_timeout(s, conn, conn.last_activity + self.opts.timeout)
                         if self.ssl_context is not None:
                             yield s, conn, RDWR
             elif s == control:
@@ -678,6 +774,8 @@ class ServerLoop(object):
             pass
         for s, conn in tuple(self.connection_map.iteritems()):
             self.close(s, conn)
+        if self.poller is not None:
+            self.poller.close()
         wait_till = monotonic() + self.opts.shutdown_timeout
         for pool in (self.plugin_pool, self.pool):
             pool.stop(wait_till)
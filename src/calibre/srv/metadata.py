@@ -6,7 +6,7 @@ from __future__ import (unicode_literals, division, absolute_import,
                         print_function)
 import os
 from copy import copy
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
 from datetime import datetime, time
 from functools import partial
 from threading import Lock
@@ -15,12 +15,14 @@ from urllib import quote
 from calibre.constants import config_dir
 from calibre.db.categories import Tag
 from calibre.ebooks.metadata.sources.identify import urls_from_identifiers
+from calibre.srv.routes import EncodedJSON
 from calibre.utils.date import isoformat, UNDEFINED_DATE, local_tz
 from calibre.utils.config import tweaks
 from calibre.utils.formatter import EvalFormatter
 from calibre.utils.file_type_icons import EXT_MAP
 from calibre.utils.icu import collation_order
 from calibre.utils.localization import calibre_langcode_to_name
+from calibre.utils.serialize import json_dumps
 from calibre.library.comments import comments_to_html, markdown
 from calibre.library.field_metadata import category_icon_map
 
@@ -90,6 +92,101 @@ def book_as_json(db, book_id):
     return ans
 
 
+class BookJSONCache(object):
+
+    '''
+    An LRU cache of the JSON encoded metadata of the books in a library. It
+    is invalidated by the library when books are changed, see
+    :meth:`calibre.db.cache.Cache.add_metadata_cache`. Entries also record
+    the last modified time of the book and the set of fields, so that changes
+    that do not invalidate the cache are still noticed.
+    '''
+
+    # Total size of the cached data, in bytes
+    MAX_SIZE = 32 * 1024 * 1024
+
+    def __init__(self):
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, book_id, last_modified, field_set):
+        with self.lock:
+            entry = self.entries.pop(book_id, None)
+            if entry is None:
+                return
+            if entry[0] != last_modified or entry[1] != field_set:
+                self.size -= len(entry[2])
+                return
+            self.entries[book_id] = entry
+            return entry[2]
+
+    def put(self, book_id, last_modified, field_set, data):
+        with self.lock:
+            old = self.entries.pop(book_id, None)
+            if old is not None:
+                self.size -= len(old[2])
+            self.entries[book_id] = (last_modified, field_set, data)
+            self.size += len(data)
+            while self.size > self.MAX_SIZE and self.entries:
+                self.size -= len(self.entries.popitem(last=False)[1][2])
+
+    def invalidate(self, book_ids=None):
+        with self.lock:
+            if book_ids is None:
+                self.entries.clear()
+                self.size = 0
+            else:
+                for book_id in book_ids:
+                    entry = self.entries.pop(book_id, None)
+                    if entry is not None:
+                        self.size -= len(entry[2])
+
+
+def attach_book_json_cache(db):
+    ' Create a cache for :func:`encoded_book_as_json` for the library, if it does not already have one '
+    db = db.new_api
+    if getattr(db, 'book_json_cache', None) is None:
+        db.book_json_cache = BookJSONCache()
+        db.add_metadata_cache(db.book_json_cache)
+    return db.book_json_cache
+
+
+def book_json_field_set(db):
+    ' The set of fields the cached metadata of the books in db depends on '
+    return frozenset(db.new_api.field_metadata.all_field_keys())
+
+
+def encoded_book_as_json(db, book_id, field_set=None):
+    ''' The same as :func:`book_as_json`, except that the metadata is returned
+    as :class:`calibre.srv.routes.EncodedJSON`, from the cache of the library,
+    if it has one. When getting the metadata of many books, pass in the
+    result of :func:`book_json_field_set` as field_set, so that it is computed
+    only once. '''
+    db = db.new_api
+    cache = getattr(db, 'book_json_cache', None)
+    with db.safe_read_lock:
+        if cache is None:
+            data = book_as_json(db, book_id)
+            return None if data is None else EncodedJSON(json_dumps(data))
+        # The read lock is held until the data is in the cache, so that a
+        # change to the book cannot happen between reading and caching it
+        last_modified = db._field_for('last_modified', book_id)
+        if field_set is None:
+            field_set = book_json_field_set(db)
+        ans = cache.get(book_id, last_modified, field_set)
+        if ans is None:
+            data = book_as_json(db, book_id)
+            if data is None:
+                return
+            ans = EncodedJSON(json_dumps(data))
+            cache.put(book_id, last_modified, field_set, ans)
+        return ans
+
+
 _include_fields = frozenset(Tag.__slots__) - frozenset({
     'state', 'is_editable', 'is_searchable', 'original_name', 'use_sort_as_name', 'is_hierarchical'
 })
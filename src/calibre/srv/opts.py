@@ -64,10 +64,46 @@ raw_options = (
     'compress_min_size', 1024,
     None,
 
+    _('Max. size of the cache of compressed responses (in MB)'),
+    'compressed_cache_size', 100.0,
+    _('Compressed copies of responses that are the same for all clients, such as'
+      ' the files that make up the web interface, are kept in this cache, so that'
+      ' they do not have to be compressed again for every request. Set to zero'
+      ' to disable the cache.'),
+
     _('Number of worker threads used to process requests'),
     'worker_count', 10,
     None,
 
+    _('Max. number of worker threads used to process requests'),
+    'max_worker_count', 30,
+    _('When the server is busy and requests have to wait to be processed, more worker'
+      ' threads are started, up to this number. They are stopped again once they are'
+      ' no longer needed.'),
+
+    _('Max. time (in seconds) requests wait to be processed'),
+    'target_queue_time', 0.5,
+    _('If requests have to wait longer than this before being processed, because all'
+      ' worker threads are busy, more worker threads are started.'),
+
+    _('Number of worker threads reserved for quick requests'),
+    'reserved_worker_count', 2,
+    _('These worker threads only process quick requests, such as requests for the'
+      ' metadata of books, and never slow requests, such as downloading of books and'
+      ' covers, so that the server stays responsive while slow requests are'
+      ' being processed.'),
+
+    _('Max. number of slow requests processed at the same time for a library'),
+    'max_slow_requests_per_library', 0,
+    _('Limit the number of slow requests, such as downloading of books and covers,'
+      ' that are processed at the same time for a single library, so that one'
+      ' library cannot use up all the worker threads. Zero means no limit.'),
+
+    _('Method used to wait for network activity'), 'event_loop', Choices('auto', 'epoll', 'select'),
+    _('The system call used by the server to wait for activity on its connections. The default,'
+      ' "auto", uses epoll where it is available (Linux) and select everywhere else. epoll performs'
+      ' much better with many simultaneous connections. select is only useful for troubleshooting.'),
+
     _('Maximum number of worker processes'),
     'max_jobs', 0,
     _('Worker processes are launched as needed and used for large jobs such as preparing'
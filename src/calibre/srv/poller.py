@@ -0,0 +1,131 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2026, agent <agent at local>'
+
+import select, errno
+
+from calibre.srv.utils import socket_errors_eintr
+
+
+class SelectPoller(object):
+
+    '''
+    Wait for sockets using select(). Available everywhere, but every call
+    passes all registered sockets to the kernel and it is limited to
+    FD_SETSIZE file descriptors.
+    '''
+
+    name = 'select'
+
+    def __init__(self):
+        self.readers, self.writers = set(), set()
+
+    def register(self, fd, read=True, write=False):
+        (self.readers.add if read else self.readers.discard)(fd)
+        (self.writers.add if write else self.writers.discard)(fd)
+
+    def unregister(self, fd):
+        self.readers.discard(fd), self.writers.discard(fd)
+
+    def poll(self, timeout):
+        readable, writable, _ = select.select(self.readers, self.writers, [], timeout)
+        return readable, writable
+
+    def bad_fds(self, fds):
+        ' Return the file descriptors from fds that cause select() to fail '
+        ans = []
+        for fd in fds:
+            try:
+                select.select([fd], [], [], 0)
+            except (select.error, EnvironmentError) as e:
+                if getattr(e, 'errno', e.args[0]) not in socket_errors_eintr:
+                    ans.append(fd)
+        return ans
+
+    def close(self):
+        self.readers.clear(), self.writers.clear()
+
+
+class EpollPoller(object):
+
+    '''
+    Wait for sockets using level triggered epoll (Linux only). The kernel
+    remembers the registered sockets, so only changes in what a socket is
+    waiting for cost a system call and the cost of a poll depends on the
+    number of ready sockets, not the number of idle ones.
+    '''
+
+    name = 'epoll'
+
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.registered = {}
+
+    def register(self, fd, read=True, write=False):
+        mask = (select.EPOLLIN if read else 0) | (select.EPOLLOUT if write else 0)
+        if not mask:
+            # Sockets that are not waiting for anything are removed, so that
+            # a hangup on them does not make every poll return immediately
+            return self.unregister(fd)
+        old = self.registered.get(fd)
+        if old == mask:
+            return
+        if fd < 0:
+            raise ValueError('Invalid file descriptor: %d' % fd)
+        if old is None:
+            try:
+                self.epoll.register(fd, mask)
+            except EnvironmentError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                self.epoll.modify(fd, mask)
+        else:
+            try:
+                self.epoll.modify(fd, mask)
+            except EnvironmentError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # The socket was closed and its file descriptor re-used
+                self.epoll.register(fd, mask)
+        self.registered[fd] = mask
+
+    def unregister(self, fd):
+        if self.registered.pop(fd, None) is not None:
+            try:
+                self.epoll.unregister(fd)
+            except (EnvironmentError, ValueError):
+                pass  # Closed file descriptors are removed automatically
+
+    def poll(self, timeout):
+        readable, writable = [], []
+        registered = self.registered
+        for fd, event in self.epoll.poll(-1 if timeout is None else timeout):
+            mask = registered.get(fd, 0)
+            # Errors and hangups are reported as readability or writability,
+            # the same as select() does, so that the next recv() or send()
+            # fails and the connection is closed
+            if mask & select.EPOLLIN and event & (select.EPOLLIN | select.EPOLLPRI | select.EPOLLERR | select.EPOLLHUP):
+                readable.append(fd)
+            if mask & select.EPOLLOUT and event & (select.EPOLLOUT | select.EPOLLERR | select.EPOLLHUP):
+                writable.append(fd)
+        return readable, writable
+
+    def bad_fds(self, fds):
+        # epoll.poll() does not fail because of a bad socket
+        return ()
+
+    def close(self):
+        self.registered.clear()
+        self.epoll.close()
+
+
+def create_poller(backend='auto'):
+    ''' Return a poller for the specified backend. auto uses epoll if it is
+    available, falling back to select otherwise. '''
+    if backend == 'select' or not hasattr(select, 'epoll'):
+        return SelectPoller()
+    return EpollPoller()
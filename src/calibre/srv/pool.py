@@ -7,18 +7,58 @@ __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
 import sys
+from collections import deque
 from Queue import Queue, Full
-from threading import Thread
+from threading import Thread, Condition
 
 from calibre.utils.monotonic import monotonic
 
+# The priority classes of jobs, jobs in a lower class are always started
+# before jobs in a higher class.
+# Quick requests that a user is waiting for, such as JSON metadata
+INTERACTIVE = 0
+# Requests that can take a long time, such as book downloads and covers
+BULK = 1
+# Requests that nobody is waiting on, such as calibredb commands
+BACKGROUND = 2
+PRIORITY_NAMES = ('interactive', 'bulk', 'background')
+
+
+class LaneStats(object):
+
+    __slots__ = ('jobs', 'total_queue_time', 'max_queue_time', 'average_queue_time')
+
+    def __init__(self):
+        self.jobs = 0
+        self.total_queue_time = self.max_queue_time = self.average_queue_time = 0.0
+
+    def add(self, queue_time):
+        self.jobs += 1
+        self.total_queue_time += queue_time
+        self.max_queue_time = max(self.max_queue_time, queue_time)
+        # An exponentially weighted moving average, so that it reflects
+        # recent load
+        self.average_queue_time += 0.1 * (queue_time - self.average_queue_time)
+
+    def as_dict(self):
+        return {k:getattr(self, k) for k in self.__slots__}
+
+
+class Job(object):
+
+    __slots__ = ('job_id', 'func', 'priority', 'key', 'queued_at')
+
+    def __init__(self, job_id, func, priority, key):
+        self.job_id, self.func, self.priority, self.key = job_id, func, priority, key
+        self.queued_at = monotonic()
+
 
 class Worker(Thread):
 
     daemon = True
 
-    def __init__(self, log, notify_server, num, request_queue, result_queue):
-        self.request_queue, self.result_queue = request_queue, result_queue
+    def __init__(self, log, notify_server, num, pool, result_queue):
+        self.pool, self.result_queue = pool, result_queue
         self.notify_server = notify_server
         self.log = log
         self.working = False
@@ -26,10 +66,10 @@ class Worker(Thread):
 
     def run(self):
         while True:
-            x = self.request_queue.get()
-            if x is None:
+            job = self.pool.next_job(self)
+            if job is None:
                 break
-            job_id, func = x
+            job_id, func = job.job_id, job.func
             self.working = True
             try:
                 result = func()
@@ -39,6 +79,8 @@ class Worker(Thread):
                 self.result_queue.put((job_id, True, result))
             finally:
                 self.working = False
+                self.pool.job_finished(job)
+                del func, job
             try:
                 self.notify_server()
             except Exception:
@@ -50,32 +92,156 @@ class Worker(Thread):
 
 class ThreadPool(object):
 
-    def __init__(self, log, notify_server, count=10, queue_size=1000):
-        self.request_queue, self.result_queue = Queue(queue_size), Queue(queue_size)
-        self.workers = [Worker(log, notify_server, i, self.request_queue, self.result_queue) for i in xrange(count)]
+    '''
+    A pool of worker threads that runs jobs in priority classes. Jobs in the
+    INTERACTIVE class are always started first and reserved_count threads
+    only run INTERACTIVE jobs, so that slow jobs cannot prevent quick ones
+    from running. At most max_per_key BULK and BACKGROUND jobs with the same
+    key (the library the request is for) run at the same time.
+
+    The pool starts with count threads and adds threads, up to max_count,
+    when jobs have to wait longer than target_queue_time seconds to start
+    while all threads are busy. Threads above count exit after having been
+    idle for idle_timeout seconds.
+    '''
+
+    def __init__(self, log, notify_server, count=10, queue_size=1000, max_count=None, reserved_count=0,
+                 max_per_key=0, target_queue_time=0.5, idle_timeout=60):
+        self.log, self.notify_server = log, notify_server
+        self.result_queue = Queue(queue_size)
+        self.queue_size = queue_size
+        self.count, self.max_count = count, max(count, max_count or count)
+        self.reserved_count = min(reserved_count, count - 1) if count > 1 else 0
+        self.max_per_key, self.target_queue_time, self.idle_timeout = max_per_key, target_queue_time, idle_timeout
+        self.lanes = tuple(deque() for x in PRIORITY_NAMES)
+        self.lane_stats = tuple(LaneStats() for x in PRIORITY_NAMES)
+        self.num_queued = self.num_running_slow = self.num_idle = 0
+        self.running_per_key = {}
+        self.cond = Condition()
+        self.stopping = False
+        self.worker_counter = 0
+        self.workers = [self.create_worker() for i in xrange(count)]
+
+    def create_worker(self):
+        w = Worker(self.log, self.notify_server, self.worker_counter, self, self.result_queue)
+        self.worker_counter += 1
+        return w
 
     def start(self):
         for w in self.workers:
             w.start()
 
-    def put_nowait(self, job_id, func):
-        self.request_queue.put_nowait((job_id, func))
+    def put_nowait(self, job_id, func, priority=INTERACTIVE, key=None):
+        with self.cond:
+            if self.num_queued >= self.queue_size:
+                raise Full()
+            if self.num_queued > 0 and self.num_idle == 0:
+                # All threads are busy and jobs are already waiting, no thread
+                # might dequeue a job for a long time, so check here as well
+                self._add_worker_if_needed(monotonic() - min(lane[0].queued_at for lane in self.lanes if lane))
+            self.lanes[priority].append(Job(job_id, func, priority, key))
+            self.num_queued += 1
+            self.cond.notify()
 
     def get_nowait(self):
         return self.result_queue.get_nowait()
 
     def stop(self, wait_till):
-        for w in self.workers:
-            try:
-                self.request_queue.put_nowait(None)
-            except Full:
-                break
-        for w in self.workers:
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+            workers = list(self.workers)
+        for w in workers:
             now = monotonic()
             if now >= wait_till:
                 break
             w.join(wait_till - now)
-        self.workers = [w for w in self.workers if w.is_alive()]
+        with self.cond:
+            self.workers = [w for w in self.workers if w.is_alive()]
+
+    def _pop_runnable_job(self):
+        # Must be called with the lock held
+        if self.lanes[INTERACTIVE]:
+            return self.lanes[INTERACTIVE].popleft()
+        if self.stopping:
+            # Run all remaining jobs, ignoring the limits
+            for lane in self.lanes:
+                if lane:
+                    return lane.popleft()
+            return
+        if self.num_running_slow >= len(self.workers) - self.reserved_count:
+            return
+        for priority in (BULK, BACKGROUND):
+            lane = self.lanes[priority]
+            for i, job in enumerate(lane):
+                if self.max_per_key > 0 and self.running_per_key.get(job.key, 0) >= self.max_per_key:
+                    continue
+                del lane[i]
+                return job
+
+    def next_job(self, worker):
+        with self.cond:
+            while True:
+                job = self._pop_runnable_job()
+                if job is not None:
+                    break
+                if self.stopping:
+                    return
+                self.num_idle += 1
+                st = monotonic()
+                # Only threads above count can exit, the others wait without a
+                # timeout, as waiting with a timeout polls
+                timeout = self.idle_timeout if len(self.workers) > self.count else None
+                try:
+                    self.cond.wait(timeout)
+                finally:
+                    self.num_idle -= 1
+                if timeout is not None and monotonic() - st >= timeout and len(self.workers) > self.count and not self.stopping:
+                    # Remove threads added during busy periods once they are
+                    # no longer needed
+                    self.workers.remove(worker)
+                    return
+            self.num_queued -= 1
+            if job.priority != INTERACTIVE:
+                self.num_running_slow += 1
+                self.running_per_key[job.key] = self.running_per_key.get(job.key, 0) + 1
+            queue_time = monotonic() - job.queued_at
+            self.lane_stats[job.priority].add(queue_time)
+            self._add_worker_if_needed(queue_time)
+            return job
+
+    def _add_worker_if_needed(self, queue_time):
+        # Must be called with the lock held
+        if (queue_time > self.target_queue_time and self.num_idle == 0 and self.num_queued > 0 and
+                len(self.workers) < self.max_count and not self.stopping):
+            w = self.create_worker()
+            self.workers.append(w)
+            w.start()
+
+    def job_finished(self, job):
+        if job.priority == INTERACTIVE:
+            return
+        with self.cond:
+            self.num_running_slow -= 1
+            n = self.running_per_key[job.key] - 1
+            if n > 0:
+                self.running_per_key[job.key] = n
+            else:
+                del self.running_per_key[job.key]
+            # A job that was waiting for this one to finish may be runnable
+            # now
+            if self.num_queued > 0:
+                self.cond.notify()
+
+    def stats(self):
+        ''' Return statistics about the time jobs spent waiting to start,
+        for each priority class '''
+        with self.cond:
+            ans = {name:s.as_dict() for name, s in zip(PRIORITY_NAMES, self.lane_stats)}
+            for name, lane in zip(PRIORITY_NAMES, self.lanes):
+                ans[name]['queued'] = len(lane)
+            ans['workers'] = len(self.workers)
+            return ans
 
     @property
     def busy(self):
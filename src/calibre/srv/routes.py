@@ -10,18 +10,52 @@ import httplib, sys, inspect, re, time, numbers, json as jsonlib, textwrap
 from urllib import quote as urlquote
 from itertools import izip
 from operator import attrgetter
+from uuid import uuid4
 
 from calibre.srv.errors import HTTPSimpleResponse, HTTPNotFound, RouteError
+from calibre.srv.pool import INTERACTIVE
 from calibre.srv.utils import http_date
 from calibre.utils.serialize import msgpack_dumps, json_dumps, MSGPACK_MIME
 
 default_methods = frozenset(('HEAD', 'GET'))
 
 
+class EncodedJSON(bytes):
+    ' Data that is already encoded as JSON '
+
+
+class EncodedJSONMap(dict):
+
+    ''' A dict whose values are :class:`EncodedJSON`. When it is a value in
+    the output of an endpoint using the json postprocessor, its values are
+    spliced into the response as is, instead of being encoded again. '''
+
+    def as_json(self):
+        return b'{' + b','.join(json_dumps(unicode(k)) + b':' + v for k, v in self.iteritems()) + b'}'
+
+
+SPLICE_CANARY = 'splice-' + uuid4().hex
+
+
+def json_dumps_with_splicing(output):
+    output, spliced = output.copy(), {}
+    for k, v in output.iteritems():
+        if isinstance(v, EncodedJSONMap):
+            placeholder = '%s-%d' % (SPLICE_CANARY, len(spliced))
+            spliced[json_dumps(placeholder)] = v.as_json()
+            output[k] = placeholder
+    ans = json_dumps(output)
+    for placeholder, data in spliced.iteritems():
+        ans = ans.replace(placeholder, data, 1)
+    return ans
+
+
 def json(ctx, rd, endpoint, output):
     rd.outheaders.set('Content-Type', 'application/json; charset=UTF-8', replace_all=True)
     if isinstance(output, bytes) or hasattr(output, 'fileno'):
         ans = output  # Assume output is already UTF-8 encoded json
+    elif isinstance(output, dict) and any(isinstance(v, EncodedJSONMap) for v in output.itervalues()):
+        ans = json_dumps_with_splicing(output)
     else:
         ans = json_dumps(output)
     return ans
@@ -69,7 +103,12 @@ def endpoint(route,
              postprocess=None,
 
              # Needs write access to the calibre database
-             needs_db_write=False
+             needs_db_write=False,
+
+             # The priority class (from calibre.srv.pool) used to schedule
+             # requests for this endpoint. Use BULK for requests that can take
+             # a long time, such as sending files.
+             priority=INTERACTIVE
 
 ):
     from calibre.srv.handler import Context
@@ -87,6 +126,7 @@ def endpoint(route,
         f.ok_code = ok_code
         f.is_endpoint = True
         f.needs_db_write = needs_db_write
+        f.priority = priority
         argspec = inspect.getargspec(f)
         if len(argspec.args) < 2:
             raise TypeError('The endpoint %r must take at least two arguments' % f.route)
@@ -189,7 +229,7 @@ class Route(object):
                 raise HTTPNotFound('Argument of incorrect type')
         for name, tc in self.type_checkers.iteritems():
             args_map[name] = check(tc, args_map[name])
-        return (args_map[name] for name in self.names)
+        return args_map
 
     def url_for(self, **kwargs):
         names = frozenset(kwargs)
@@ -263,6 +303,10 @@ class Router(object):
         self.soak_routes = sorted(frozenset(r for r in self if r.soak_up_extra), key=attrgetter('min_size'), reverse=True)
 
     def find_route(self, path):
+        route, args = self._find_route(path)
+        return route.endpoint, (args[name] for name in route.names)
+
+    def _find_route(self, path):
         if self.strip_path is not None and path[:len(self.strip_path)] == self.strip_path:
             path = path[len(self.strip_path):]
         size = len(path)
@@ -271,14 +315,22 @@ class Router(object):
         for route in sorted(routes, key=attrgetter('max_size'), reverse=True):
             args = route.matches(path)
             if args is not False:
-                return route.endpoint, args
+                return route, args
         for route in self.soak_routes:
             if route.min_size <= size:
                 args = route.matches(path)
                 if args is not False:
-                    return route.endpoint, args
+                    return route, args
         raise HTTPNotFound()
 
+    def classify_request(self, data):
+        ' Return the priority class of a request and the library it is for, used to schedule it '
+        try:
+            route, args = self._find_route(data.path)
+        except HTTPNotFound:
+            return INTERACTIVE, None
+        return route.endpoint.priority, args.get('library_id') or data.query.get('library_id')
+
     def read_cookies(self, data):
         data.cookies = c = {}
 
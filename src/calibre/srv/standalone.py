@@ -3,10 +3,16 @@
 # License: GPLv3 Copyright: 2015, Kovid Goyal <kovid at kovidgoyal.net>
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import errno
 import json
 import os
+import select
 import signal
 import sys
+import time
+import traceback
+from multiprocessing import Pipe
+from threading import Lock, Thread
 
 from calibre import as_unicode
 from calibre.constants import is_running_from_develop, isosx, iswindows, plugins
@@ -57,14 +63,14 @@ def daemonize():  # {{{
 
 class Server(object):
 
-    def __init__(self, libraries, opts):
+    def __init__(self, libraries, opts, notify_changes=None, reuse_port=False):
         log = access_log = None
         log_size = opts.max_log_size * 1024 * 1024
         if opts.log:
             log = RotatingLog(opts.log, max_size=log_size)
         if opts.access_log:
             access_log = RotatingLog(opts.access_log, max_size=log_size)
-        self.handler = Handler(libraries, opts)
+        self.handler = Handler(libraries, opts, notify_changes=notify_changes)
         if opts.custom_list_template:
             with lopen(opts.custom_list_template, 'rb') as f:
                 self.handler.router.ctx.custom_list_template = json.load(f)
@@ -72,11 +78,12 @@ class Server(object):
         if opts.use_bonjour:
             plugins.append(BonJour())
         self.loop = ServerLoop(
-            create_http_handler(self.handler.dispatch),
+            create_http_handler(self.handler.dispatch, classify_request=self.handler.classify_request),
             opts=opts,
             log=log,
             access_log=access_log,
-            plugins=plugins)
+            plugins=plugins,
+            reuse_port=reuse_port)
         self.handler.set_log(self.loop.log)
         self.handler.set_jobs_manager(self.loop.jobs_manager)
         self.serve_forever = self.loop.serve_forever
@@ -86,6 +93,203 @@ class Server(object):
             compile_srv()
 
 
+# Multi-process server {{{
+
+# Workers that exit sooner than this after being started are not restarted,
+# to avoid restarting workers that cannot start, for example, because the
+# port is in use, forever
+MIN_WORKER_LIFETIME = 10  # seconds
+
+
+class ChangesChannel(object):
+
+    ''' The connection from a worker process to the master process. Changes
+    made to a library by the worker are sent to the master, which forwards
+    them to all other workers. Changes received from the master cause the
+    changed fields of the library to be re-read from the database, so that
+    the in-memory caches of all workers stay coherent. Until then, the other
+    workers serve the data from before the change. '''
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.send_lock = Lock()
+
+    def notify_changes(self, library_path, change_event):
+        # Called from the worker threads of the server, so must be
+        # serialized
+        with self.send_lock:
+            try:
+                self.conn.send((library_path, change_event))
+            except EnvironmentError:
+                pass  # The master process has gone away
+
+    def start(self, server):
+        t = Thread(target=self.receive_changes, args=(server,), name='ReceiveChanges')
+        t.daemon = True
+        t.start()
+
+    def receive_changes(self, server):
+        broker, log = server.handler.ctx.library_broker, server.loop.log
+        while True:
+            try:
+                # Coalesce bursts of changes, so that each library is
+                # re-read only once
+                changes = [self.conn.recv()]
+                while self.conn.poll():
+                    changes.append(self.conn.recv())
+            except (EOFError, EnvironmentError):
+                break
+            # Map of library path to (fields, book_ids), None for changes that
+            # need the whole library to be re-read
+            pending = {}
+            for library_path, change_event in changes:
+                fields = change_event.fields
+                if fields is None or (library_path in pending and pending[library_path] is None):
+                    pending[library_path] = None
+                    continue
+                pfields, pbook_ids = pending.setdefault(library_path, (set(), set()))
+                pfields.update(fields), pbook_ids.update(change_event.book_ids)
+            for library_path, changed in pending.iteritems():
+                try:
+                    if changed is None:
+                        broker.reload_library(library_path)
+                    else:
+                        broker.reload_library(library_path, fields=changed[0], book_ids=changed[1])
+                except Exception:
+                    log.exception('Failed to reload the library at: %s' % library_path)
+        # The master process has gone away
+        server.loop.stop()
+
+
+def run_worker(libraries, opts, conn):
+    channel = ChangesChannel(conn)
+    server = Server(libraries, opts, notify_changes=channel.notify_changes, reuse_port=True)
+    channel.start(server)
+    signal.signal(signal.SIGTERM, lambda s, f: server.stop())
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    from calibre.gui2 import ensure_app, load_builtin_fonts
+    ensure_app(), load_builtin_fonts()
+    try:
+        server.serve_forever()
+    finally:
+        shutdown_delete_service()
+
+
+class Workers(object):
+
+    ''' Run the server in several worker processes, each with its own
+    ServerLoop listening on the same port using SO_REUSEPORT, so that
+    requests are handled in parallel, without contending for the GIL. '''
+
+    def __init__(self, libraries, opts, num_workers):
+        self.libraries, self.opts, self.num_workers = libraries, opts, num_workers
+        self.workers = {}
+        self.stopping = False
+
+    def spawn(self, num):
+        conn, child_conn = Pipe()
+        pid = os.fork()
+        if pid == 0:
+            conn.close()
+            for x in self.workers.itervalues():
+                x[1].close()
+            if num > 0:
+                # Only advertise the server once
+                self.opts.use_bonjour = False
+            code = 0
+            try:
+                run_worker(self.libraries, self.opts, child_conn)
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        child_conn.close()
+        self.workers[pid] = (num, conn, time.time())
+
+    def stop(self):
+        self.stopping = True
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            w = self.workers.pop(pid, None)
+            if w is None:
+                continue
+            num, conn, started_at = w
+            conn.close()
+            if not self.stopping:
+                if time.time() - started_at < MIN_WORKER_LIFETIME:
+                    print('Server worker process %d failed to start, not restarting it' % num, file=sys.stderr)
+                else:
+                    print('Server worker process %d exited unexpectedly, restarting it' % num, file=sys.stderr)
+                    self.spawn(num)
+
+    def relay_changes(self):
+        conns = {w[1].fileno():w[1] for w in self.workers.itervalues()}
+        try:
+            readable = select.select(list(conns), [], [], 1)[0]
+        except (select.error, EnvironmentError) as e:
+            if getattr(e, 'errno', e.args[0]) == errno.EINTR:
+                return
+            raise
+        for fd in readable:
+            src = conns[fd]
+            try:
+                msg = src.recv()
+            except (EOFError, EnvironmentError):
+                continue  # The worker has exited, it will be reaped
+            for conn in conns.itervalues():
+                if conn is not src:
+                    try:
+                        conn.send(msg)
+                    except EnvironmentError:
+                        pass
+
+    def shutdown(self):
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        wait_till = time.time() + self.opts.shutdown_timeout + 5
+        while self.workers and time.time() < wait_till:
+            self.reap()
+            time.sleep(0.05)
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def serve_forever(self):
+        for num in xrange(self.num_workers):
+            self.spawn(num)
+        try:
+            while not self.stopping:
+                self.reap()
+                if not self.workers:
+                    raise SystemExit('All server worker processes have exited')
+                self.relay_changes()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stopping = True
+            self.shutdown()
+# }}}
+
+
 def create_option_parser():
     parser = opts_to_parser(
         '%prog ' + _(
@@ -125,6 +329,19 @@ libraries that the main calibre program knows about will be used.
             default=False,
             action='store_true',
             help=_('Run process in background as a daemon (Linux only).'))
+        parser.add_option(
+            '--processes',
+            default=1,
+            type='int',
+            help=_(
+                'Number of processes used to serve requests (Linux only). With more'
+                ' than one process, requests are handled in parallel on multiple CPU'
+                ' cores. Every process keeps its own copy of the library metadata'
+                ' in memory, so memory usage grows with the number of processes.'
+                ' Changes made through one process are applied to the other'
+                ' processes shortly afterwards, by re-reading the changed data from'
+                ' the database. Changes that affect many fields, such as adding'
+                ' books, cause the whole library to be re-read in every process.'))
     parser.add_option(
         '--pidfile', default=None, help=_('Write process PID to the specified file'))
     parser.add_option(
@@ -205,7 +422,13 @@ def main(args=sys.argv):
         raise SystemExit('The --log option must point to a file, not a directory')
     if opts.access_log and os.path.isdir(opts.access_log):
         raise SystemExit('The --access-log option must point to a file, not a directory')
-    server = Server(libraries, opts)
+    num_processes = getattr(opts, 'processes', 1)
+    if num_processes > 1:
+        if not int(opts.port):
+            raise SystemExit('The --port option must be specified when using more than one process')
+        server = Workers(libraries, opts, num_processes)
+    else:
+        server = Server(libraries, opts)
     if getattr(opts, 'daemonize', False):
         if not opts.log and not iswindows:
             raise SystemExit(
@@ -218,9 +441,12 @@ def main(args=sys.argv):
     signal.signal(signal.SIGTERM, lambda s, f: server.stop())
     if not getattr(opts, 'daemonize', False) and not iswindows:
         signal.signal(signal.SIGHUP, lambda s, f: server.stop())
-    # Needed for dynamic cover generation, which uses Qt for drawing
-    from calibre.gui2 import ensure_app, load_builtin_fonts
-    ensure_app(), load_builtin_fonts()
+    if num_processes < 2:
+        # Needed for dynamic cover generation, which uses Qt for drawing. The
+        # worker processes do this themselves, as Qt must not be initialized
+        # before forking.
+        from calibre.gui2 import ensure_app, load_builtin_fonts
+        ensure_app(), load_builtin_fonts()
     try:
         server.serve_forever()
     finally:
@@ -6,7 +6,7 @@ from __future__ import (unicode_literals, division, absolute_import,
 __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
-import httplib, zlib, json, base64, os
+import httplib, zlib, json, base64, os, time
 from io import BytesIO
 from functools import partial
 from urllib import urlencode, quote
@@ -193,3 +193,132 @@ class ContentTest(LibraryBaseTest):
             d((1,), username='ro', status=FORBIDDEN)
             d((1, data['book_id']))
     # }}}
+
+    def test_srv_library_reload(self):  # {{{
+        from calibre.db.cache import Cache
+        from calibre.db.legacy import create_backend
+        from calibre.srv.library_broker import LibraryBroker
+        broker = LibraryBroker([self.library_path])
+        self.assertFalse(broker.reload_library(self.library_path))
+        db = broker.get()
+        # Simulate a change made by another server process
+        other = Cache(create_backend(self.library_path))
+        other.init()
+        other.set_field('title', {1:'changed'})
+        book_id = other.create_book_entry(get_metadata(BytesIO(b'x'), stream_type='txt'))
+        other.close()
+        self.assertNotEqual(db.field_for('title', 1), 'changed')
+        self.assertTrue(broker.reload_library(self.library_path))
+        self.ae(db.field_for('title', 1), 'changed')
+        self.assertIn(book_id, db.all_book_ids())
+        # Only re-read the changed fields
+        other = Cache(create_backend(self.library_path))
+        other.init()
+        other.set_field('tags', {1:('changed',)})
+        other.set_field('title', {2:'changed'})
+        other.close()
+        self.assertTrue(broker.reload_library(self.library_path, fields={'tags'}, book_ids={1}))
+        self.ae(db.field_for('tags', 1), ('changed',))
+        self.ae(db.search('tags:"=changed"'), {1})
+        self.assertNotEqual(db.field_for('title', 2), 'changed')
+        self.assertFalse(broker.reload_library(self.mkdtemp()))
+        broker.close()
+    # }}}
+
+    def test_srv_composite_renderer(self):  # {{{
+        from calibre.db.cache import Cache
+        from calibre.db.legacy import create_backend
+        from calibre.srv.library_broker import LibraryBroker
+        db = Cache(create_backend(self.library_path))
+        db.init()
+        db.create_custom_column('comp', 'Comp', 'composite', False, display={'composite_template': '{title}'})
+        db.close()
+        broker = LibraryBroker([self.library_path])
+        renderer = broker.get().composite_renderer
+        self.assertTrue(renderer.is_alive())
+        broker.close()
+        self.assertFalse(renderer.is_alive())
+    # }}}
+
+    def test_srv_multiple_processes(self):  # {{{
+        from multiprocessing import Pipe
+        from threading import Thread
+        from calibre.srv.opts import Options
+        from calibre.srv.standalone import ChangesChannel, Workers
+        # Each server stands in for a worker process, with its own copy of the
+        # library in memory, connected to the master by a pipe
+        workers = Workers((self.library_path,), Options(), 2)
+        channels = []
+        for num in xrange(2):
+            conn, child_conn = Pipe()
+            workers.workers[num] = (num, conn, time.time())
+            channels.append(ChangesChannel(child_conn))
+
+        def relay():
+            while not workers.stopping:
+                workers.relay_changes()
+        relay_thread = Thread(target=relay, name='RelayChanges')
+        relay_thread.daemon = True
+        relay_thread.start()
+
+        def wait_for(condition):
+            end = time.time() + 10
+            while not condition() and time.time() < end:
+                time.sleep(0.01)
+            return condition()
+
+        try:
+            with self.create_server(notify_changes=channels[0].notify_changes, local_write=True) as adder, \
+                    self.create_server(notify_changes=channels[1].notify_changes, local_write=True) as other:
+                dbs = []
+                for server, channel in zip((adder, other), channels):
+                    channel.start(server)
+                    dbs.append(server.handler.ctx.library_broker.get())
+                self.assertIsNot(dbs[0], dbs[1])
+                conn = adder.connect()
+                r, data = make_request(conn, '/cdb/add-book/1/n/{}'.format(quote(b'other process.txt')),
+                                       prefix='', method='POST', data=b'content')
+                self.ae(r.status, OK)
+                book_id = data['book_id']
+                self.assertTrue(wait_for(lambda: book_id in dbs[1].all_book_ids()))
+                r, data = make_request(other.connect(), '/book/{}'.format(book_id))
+                self.ae(r.status, OK)
+                self.ae(data['title'], dbs[0].field_for('title', book_id))
+                r, data = make_request(conn, '/cdb/delete-books/{}'.format(book_id), prefix='', method='POST')
+                self.ae(r.status, OK)
+                self.assertTrue(wait_for(lambda: book_id not in dbs[1].all_book_ids()))
+        finally:
+            workers.stopping = True
+            relay_thread.join()
+            for w in workers.workers.itervalues():
+                w[1].close()
+    # }}}
+
+    def test_srv_book_json_cache(self):  # {{{
+        from calibre.srv.metadata import book_as_json
+        from calibre.utils.serialize import json_dumps
+        with self.create_server() as server:
+            db = server.handler.router.ctx.library_broker.get(None)
+            cache = db.book_json_cache
+            conn = server.connect()
+            request = partial(make_request, conn, prefix='/interface-data')
+
+            def expected(book_id):
+                return json.loads(json_dumps(book_as_json(db, book_id)))
+
+            r, data = request('/book-metadata/1')
+            self.ae(r.status, OK)
+            self.ae(data.pop('id'), 1)
+            self.ae(data, expected(1))
+            self.ae(len(cache), 1)
+            r, data = request('/get-books')
+            self.ae(r.status, OK)
+            self.ae(set(data['metadata']), set(map(str, data['search_result']['book_ids'])))
+            for book_id, mi in data['metadata'].iteritems():
+                self.ae(mi, expected(int(book_id)))
+            db.set_field('title', {1:'changed'})
+            self.assertIsNone(cache.get(1, db.field_for('last_modified', 1), frozenset(db.field_metadata.all_field_keys())))
+            self.ae(request('/book-metadata/1')[1]['title'], 'changed')
+            r, data = request('/book-metadata/1000')
+            self.ae(r.status, NOT_FOUND)
+    # }}}
@@ -127,7 +127,7 @@ class TestServer(Thread):
 
 class LibraryServer(TestServer):
 
-    def __init__(self, library_path, libraries=(), plugins=(), specialize=lambda x:None, **kwargs):
+    def __init__(self, library_path, libraries=(), plugins=(), specialize=lambda x:None, notify_changes=None, **kwargs):
         Thread.__init__(self, name='ServerMain')
         from calibre.srv.opts import Options
         from calibre.srv.loop import ServerLoop
@@ -136,9 +136,9 @@ class LibraryServer(TestServer):
         self.setup_defaults(kwargs)
         opts = Options(**kwargs)
         self.libraries = libraries or (library_path,)
-        self.handler = Handler(self.libraries, opts, testing=True)
+        self.handler = Handler(self.libraries, opts, testing=True, notify_changes=notify_changes)
         self.loop = ServerLoop(
-            create_http_handler(self.handler.dispatch),
+            create_http_handler(self.handler.dispatch, classify_request=self.handler.classify_request),
             opts=opts,
             plugins=plugins,
             log=ServerLog(level=ServerLog.WARN),
@@ -335,6 +335,59 @@ class TestHTTP(BaseTest):
             self.ae(str(len(raw)), r.getheader('Calibre-Uncompressed-Length'))
             self.ae(r.status, httplib.OK), self.ae(zlib.decompress(r.read(), 16+zlib.MAX_WBITS), raw)
 
+            # Test cached compressed responses
+            for size in (20000, 200000, 800000):
+                raw = os.urandom(size // 4).encode('hex') + b'a' * (size // 2)
+                server.change_handler(lambda conn: conn.generate_static_output('test-%d' % size, lambda : raw, content_type='text/plain'))
+                conn = server.connect()
+                conn.request('GET', '/compressed', headers={'Accept-Encoding':'gzip'})
+                r = conn.getresponse()
+                self.ae(r.status, httplib.OK), self.ae(r.getheader('Transfer-Encoding'), 'chunked')
+                etag = r.getheader('ETag')
+                self.assertTrue(etag.endswith('-gzip"'))
+                cdata = r.read()
+                self.ae(zlib.decompress(cdata, 16+zlib.MAX_WBITS), raw)
+                conn.request('GET', '/compressed', headers={'Accept-Encoding':'gzip'})
+                r = conn.getresponse()
+                self.ae(r.status, httplib.OK), self.ae(r.getheader('Content-Encoding'), 'gzip')
+                self.ae(r.getheader('ETag'), etag)
+                self.ae(int(r.getheader('Content-Length')), len(cdata))
+                self.ae(r.getheader('Calibre-Uncompressed-Length'), str(len(raw)))
+                self.ae(r.read(), cdata)
+                conn.request('GET', '/compressed', headers={'Accept-Encoding':'gzip', 'Range':'bytes=10-99', 'If-Range':etag})
+                r = conn.getresponse()
+                self.ae(r.status, httplib.PARTIAL_CONTENT)
+                self.ae(r.read(), cdata[10:100])
+                for h in ({'Accept-Encoding':'gzip'}, {}):
+                    h['If-None-Match'] = etag
+                    conn.request('GET', '/compressed', headers=h)
+                    r = conn.getresponse()
+                    self.ae(r.status, httplib.NOT_MODIFIED)
+                    r.read()
+                conn.request('GET', '/compressed')
+                r = conn.getresponse()
+                self.ae(r.status, httplib.OK), self.ae(r.read(), raw)
+            # Large bodies are written to files by the thread pool
+            cache_dir = os.path.join(server.loop.tdir, 'compressed')
+            st = monotonic()
+            while not (os.path.isdir(cache_dir) and os.listdir(cache_dir)) and monotonic() - st < 5:
+                time.sleep(0.01)
+            self.assertTrue(os.listdir(cache_dir))
+            conn.request('GET', '/compressed', headers={'Accept-Encoding':'gzip'})
+            r = conn.getresponse()
+            self.ae(r.status, httplib.OK), self.ae(r.getheader('Content-Encoding'), 'gzip')
+            self.ae(zlib.decompress(r.read(), 16+zlib.MAX_WBITS), raw)
+
+            # Responses for different URLs that share an ETag are cached separately
+            server.change_handler(lambda conn: conn.etagged_dynamic_response(
+                'shared', lambda: ('%s ' % '/'.join(conn.path)) * 1000, content_type='text/plain'))
+            conn = server.connect()
+            for path in ('/one', '/two', '/one', '/two?x=1', '/two'):
+                conn.request('GET', path, headers={'Accept-Encoding':'gzip'})
+                r = conn.getresponse()
+                self.ae(r.status, httplib.OK), self.ae(r.getheader('Content-Encoding'), 'gzip')
+                self.ae(zlib.decompress(r.read(), 16+zlib.MAX_WBITS), ('%s ' % path[1:].partition('?')[0]) * 1000)
+
             # Test dynamic etagged content
             num_calls = [0]
 
@@ -6,11 +6,12 @@ from __future__ import (unicode_literals, division, absolute_import,
 __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
-import httplib, ssl, os, socket, time
+import httplib, ssl, os, socket, time, select
 from collections import namedtuple
 from unittest import skipIf
 from glob import glob
 from threading import Event
+from functools import partial
 
 from calibre.srv.pre_activated import has_preactivated_support
 from calibre.srv.tests.base import BaseTest, TestServer
@@ -101,6 +102,129 @@ class LoopTest(BaseTest):
             server.join()
             self.ae(1, sum(int(w.is_alive()) for w in pool.workers))
 
+    def test_job_scheduling(self):
+        ' Test scheduling of jobs in priority classes '
+        from Queue import Queue
+        from calibre.srv.pool import ThreadPool, BULK, BACKGROUND
+        from calibre.srv.utils import ServerLog
+        started, block = Queue(), Event()
+
+        def job(name, wait=True):
+            started.put(name)
+            if wait:
+                block.wait()
+        pool = ThreadPool(ServerLog(level=ServerLog.WARN), lambda: None, count=3, max_count=3, reserved_count=1, max_per_key=1)
+        pool.start()
+        try:
+            pool.put_nowait(1, partial(job, 'b1'), priority=BULK, key='lib')
+            pool.put_nowait(2, partial(job, 'b2'), priority=BULK, key='lib')
+            pool.put_nowait(3, partial(job, 'b3'), priority=BACKGROUND, key='other')
+            self.ae({started.get(timeout=2), started.get(timeout=2)}, {'b1', 'b3'})
+            # Only one job per key and one thread is reserved for interactive jobs
+            time.sleep(0.05)
+            self.assertTrue(started.empty())
+            pool.put_nowait(4, partial(job, 'i1', wait=False))
+            self.ae(started.get(timeout=2), 'i1')
+            block.set()
+            self.ae(started.get(timeout=2), 'b2')
+            st = monotonic()
+            while pool.busy and monotonic() - st < 2:
+                time.sleep(0.01)
+            stats = pool.stats()
+            self.ae(stats['bulk']['jobs'], 2), self.ae(stats['background']['jobs'], 1), self.ae(stats['interactive']['jobs'], 1)
+            self.assertGreater(stats['bulk']['max_queue_time'], 0.04)
+        finally:
+            block.set()
+            pool.stop(monotonic() + 1)
+
+        # Test adding threads when jobs wait too long
+        block.clear()
+        pool = ThreadPool(ServerLog(level=ServerLog.WARN), lambda: None, count=1, max_count=3, target_queue_time=0.01, idle_timeout=0.1)
+        pool.start()
+        try:
+            for i in xrange(4):
+                pool.put_nowait(i, partial(job, i))
+            started.get(timeout=2)
+            time.sleep(0.05)
+            block.set()
+            st = monotonic()
+            while len(pool.workers) < 2 and monotonic() - st < 2:
+                time.sleep(0.01)
+            self.assertGreater(len(pool.workers), 1)
+            self.assertLessEqual(len(pool.workers), 3)
+            # The added threads exit once they are idle
+            st = monotonic()
+            while len(pool.workers) > 1 and monotonic() - st < 3:
+                time.sleep(0.01)
+            self.ae(len(pool.workers), 1)
+        finally:
+            block.set()
+            pool.stop(monotonic() + 1)
+
+        # Threads are added when jobs are queued while all threads are busy,
+        # even though no thread dequeues a job
+        block.clear()
+        pool = ThreadPool(ServerLog(level=ServerLog.WARN), lambda: None, count=1, max_count=2, target_queue_time=0.01)
+        pool.start()
+        try:
+            pool.put_nowait(1, partial(job, 'j1'))
+            self.ae(started.get(timeout=2), 'j1')
+            pool.put_nowait(2, partial(job, 'j2'))
+            time.sleep(0.05)
+            pool.put_nowait(3, partial(job, 'j3'))
+            self.ae(len(pool.workers), 2)
+            self.ae(started.get(timeout=2), 'j2')
+        finally:
+            block.set()
+            pool.stop(monotonic() + 1)
+
+    def test_event_loops(self):
+        'Test the select and epoll event loops'
+        from calibre.srv.poller import EpollPoller, SelectPoller
+        backends = ['select'] + (['epoll'] if hasattr(select, 'epoll') else [])
+        for backend in backends:
+            with TestServer(lambda data:(data.path[0] + data.read()), event_loop=backend, timeout=0.2) as server:
+                self.assertIsInstance(server.loop.poller, EpollPoller if backend == 'epoll' else SelectPoller)
+                conns = [server.connect() for i in xrange(5)]
+                for i in xrange(3):
+                    for c, conn in enumerate(conns):
+                        conn.request('GET', '/%d' % c, b'%d' % i)
+                        r = conn.getresponse()
+                        self.ae(r.status, httplib.OK)
+                        self.ae(r.read(), b'%d%d' % (c, i))
+                # Connections that are idle for too long get a timeout response
+                s = socket.create_connection(server.address, timeout=5)
+                st = monotonic()
+                self.assertIn(b'408', s.recv(4096).partition(b'\r\n')[0])
+                self.assertGreaterEqual(monotonic() - st, 0.15)
+                s.close()
+                for conn in conns:
+                    conn.close()
+                st = monotonic()
+                while server.loop.num_active_connections and monotonic() - st < 2:
+                    time.sleep(0.01)
+                self.ae(server.loop.num_active_connections, 0)
+                self.assertLessEqual(len(server.loop.timeouts), 64)
+
+    @skipIf(not hasattr(socket, 'SO_REUSEPORT'), 'SO_REUSEPORT not available')
+    def test_reuse_port(self):
+        'Test several servers listening on the same port'
+        def specialize(server):
+            server.loop.reuse_port = True
+        with TestServer(lambda data:b'1', specialize=specialize) as s1:
+            with TestServer(lambda data:b'2', specialize=specialize, port=s1.address[1]) as s2:
+                self.ae(s1.address, s2.address)
+                self.assertTrue(s2.loop.ready)
+                seen = set()
+                for i in xrange(50):
+                    conn = s1.connect()
+                    conn.request('GET', '/')
+                    seen.add(conn.getresponse().read())
+                    conn.close()
+                    if len(seen) > 1:
+                        break
+                self.ae(seen, {b'1', b'2'})
+
     def test_fallback_interface(self):
         'Test falling back to default interface'
         def specialize(server):
@@ -0,0 +1,58 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2026, agent <agent at local>
+
+'''
+Measure the connections per second and the latency of the server with the
+different event loops, while a number of idle connections are kept open. Run
+with:
+
+    calibre-debug -c "from calibre.srv.tests.loop_benchmark import main; main()"
+'''
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import httplib, select, socket, time
+from threading import Thread
+
+
+def client(address, num_requests, latencies, errors):
+    for i in xrange(num_requests):
+        st = time.time()
+        try:
+            conn = httplib.HTTPConnection(address[0], address[1], strict=True, timeout=30)
+            conn.request('GET', '/test')
+            r = conn.getresponse()
+            r.read()
+            conn.close()
+        except Exception as e:
+            errors.append(e)
+        else:
+            latencies.append(time.time() - st)
+
+
+def run(backend, idle_connections, clients, num_requests):
+    from calibre.srv.tests.base import TestServer
+    with TestServer(lambda data:b'ok', event_loop=backend, timeout=300, worker_count=4) as server:
+        idle = [socket.create_connection(server.address) for i in xrange(idle_connections)]
+        latencies, errors = [], []
+        threads = [Thread(target=client, args=(server.address, num_requests, latencies, errors)) for i in xrange(clients)]
+        st = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        total = time.time() - st
+        for s in idle:
+            s.close()
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))] if latencies else 0
+    return len(latencies) / total, p99, len(errors)
+
+
+def main(idle_connections=500, clients=8, num_requests=250):
+    backends = ['select'] + (['epoll'] if hasattr(select, 'epoll') else [])
+    print('%d clients making %d connections each, with %d idle connections open' % (clients, num_requests, idle_connections))
+    for backend in backends:
+        rate, p99, errors = run(backend, idle_connections, clients, num_requests)
+        print('%-8s: %7.1f connections/sec p99 latency: %6.2f ms errors: %d' % (backend, rate, p99 * 1000, errors))
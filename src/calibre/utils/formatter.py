@@ -36,7 +36,7 @@ class _Parser(object):
         self.locals = {'$':val}
         self.funcs = funcs
 
-    def error(self, message):
+    def error_message(self, message):
         m = 'Formatter: ' + message + _(' near ')
         if self.lex_pos > 0:
             m = '{0} {1}'.format(m, self.prog[self.lex_pos-1][1])
@@ -44,7 +44,10 @@ class _Parser(object):
             m = '{0} {1}'.format(m, self.prog[self.lex_pos+1][1])
         else:
             m = '{0} {1}'.format(m, _('end of program'))
-        raise ValueError(m)
+        return m
+
+    def error(self, message):
+        raise ValueError(self.error_message(message))
 
     def token(self):
         if self.lex_pos >= self.prog_len:
@@ -174,6 +177,176 @@ class _Parser(object):
             self.error(_('expression is not function or constant'))
 
 
+class _Context(object):
+
+    __slots__ = ('formatter', 'kwargs', 'book', 'locals', 'funcs')
+
+    def __init__(self, formatter, val):
+        self.formatter, self.kwargs, self.book = formatter, formatter.kwargs, formatter.book
+        self.locals = {'$':val}
+        self.funcs = formatter.funcs
+
+
+class _Compiler(_Parser):
+
+    '''
+    Compiles a lexed template program into a tree of closures, so that it can
+    be evaluated any number of times without being parsed again. The closures
+    behave exactly like _Parser, including the errors raised while evaluating.
+    Syntax errors are raised when compiling, such programs are run by _Parser
+    instead, so that the error is reported at the same point. Functions are
+    looked up when the program is run, so the compiled program does not depend
+    on the template functions available when it was compiled.
+    '''
+
+    def __init__(self, prog):
+        self.lex_pos = 0
+        self.prog = prog[0]
+        self.prog_len = len(self.prog)
+        if prog[1] != '':
+            self.error(_('failed to scan program. Invalid input {0}').format(prog[1]))
+
+    def program(self):
+        val = self.statement()
+        if not self.token_is_eof():
+            self.error(_('syntax error - program ends before EOF'))
+        return val
+
+    def statement(self):
+        exprs = []
+        while True:
+            exprs.append(self.expr())
+            if self.token_is_eof() or not self.token_op_is_a_semicolon():
+                break
+            self.consume()
+            if self.token_is_eof():
+                break
+        if len(exprs) == 1:
+            return exprs[0]
+        exprs = tuple(exprs)
+
+        def statement(ctx):
+            for expr in exprs:
+                val = expr(ctx)
+            return val
+        return statement
+
+    def expr(self):
+        if self.token_is_id():
+            id = self.token()
+            if not self.token_op_is_a_lparen():
+                if self.token_op_is_a_equals():
+                    self.consume()
+                    rhs = self.expr()
+
+                    def assign(ctx):
+                        cls = ctx.funcs['assign']
+                        return cls.eval_(ctx.formatter, ctx.kwargs, ctx.book, ctx.locals, id, rhs(ctx))
+                    return assign
+                unknown_identifier = self.error_message(_('Unknown identifier ') + id)
+
+                def identifier(ctx):
+                    val = ctx.locals.get(id, None)
+                    if val is None:
+                        raise ValueError(unknown_identifier)
+                    return val
+                return identifier
+            id = id.strip()
+            unknown_function = self.error_message(_('unknown function {0}').format(id))
+            self.consume()
+            args = []
+            while not self.token_op_is_a_rparen():
+                if id == 'assign' and len(args) == 0:
+                    if not self.token_is_id():
+                        self.error('assign requires the first parameter be an id')
+                    args.append(self.constant(self.token()))
+                else:
+                    args.append(self.statement())
+                if not self.token_op_is_a_comma():
+                    break
+                self.consume()
+            if self.token() != ')':
+                self.error(_('missing closing parenthesis'))
+            wrong_args = self.error_message('incorrect number of arguments for function {}'.format(id))
+            args, num_args = tuple(args), len(args)
+
+            def call(ctx):
+                cls = ctx.funcs.get(id)
+                if cls is None:
+                    raise ValueError(unknown_function)
+                vals = [arg(ctx) for arg in args]
+                if cls.arg_count != -1 and num_args != cls.arg_count:
+                    raise ValueError(wrong_args)
+                return cls.eval_(ctx.formatter, ctx.kwargs, ctx.book, ctx.locals, *vals)
+            return call
+        elif self.token_is_constant():
+            return self.constant(self.token())
+        else:
+            self.error(_('expression is not function or constant'))
+
+    def constant(self, val):
+        return lambda ctx: val
+
+
+class _FieldFinder(_Parser):
+
+    '''
+    Walks a lexed template program the way _Parser does, without running it,
+    to find the functions it calls and the fields it reads with the functions
+    in field_functions. dynamic is set if one of those is passed a field name
+    that is computed when the program is run.
+    '''
+
+    # Template functions that read the field named by their first argument
+    field_functions = frozenset(('field', 'raw_field', 'raw_list'))
+
+    def __init__(self, prog):
+        self.lex_pos = 0
+        self.prog = prog[0]
+        self.prog_len = len(self.prog)
+        if prog[1] != '':
+            self.error(_('failed to scan program. Invalid input {0}').format(prog[1]))
+        self.fields, self.functions, self.dynamic = set(), set(), False
+
+    def expr(self):
+        # Returns the value of the expression if it is a constant, otherwise
+        # None
+        if self.token_is_id():
+            id = self.token()
+            if not self.token_op_is_a_lparen():
+                if self.token_op_is_a_equals():
+                    self.consume()
+                    self.expr()
+                return None
+            id = id.strip()
+            self.functions.add(id)
+            self.consume()
+            args = []
+            while not self.token_op_is_a_rparen():
+                if id == 'assign' and len(args) == 0:
+                    if not self.token_is_id():
+                        self.error('assign requires the first parameter be an id')
+                    self.consume()
+                    args.append(None)
+                else:
+                    args.append(self.statement())
+                if not self.token_op_is_a_comma():
+                    break
+                self.consume()
+            if self.token() != ')':
+                self.error(_('missing closing parenthesis'))
+            if id in self.field_functions:
+                if args and args[0] is not None:
+                    self.fields.add(args[0])
+                else:
+                    self.dynamic = True
+            return None
+        elif self.token_is_constant():
+            return self.token()
+        else:
+            self.error(_('expression is not function or constant'))
+
+
 class TemplateFormatter(string.Formatter):
     '''
     Provides a format function that substitutes '' for any missing value
@@ -181,6 +354,15 @@ class TemplateFormatter(string.Formatter):
 
     _validation_string = 'This Is Some Text THAT SHOULD be LONG Enough.%^&*'
 
+    # When True, templates are compiled once and the compiled form is cached,
+    # instead of being parsed every time they are evaluated. The compiled
+    # templates are shared by all formatters, see _compile_program() and
+    # _compile_template()
+    compile_templates = True
+    compiled_programs = {}
+    compiled_templates = {}
+    MAX_COMPILED = 1000
+
     # Dict to do recursion detection. It is up to the individual get_value
     # method to use it. It is cleared when starting to format a template
     composite_values = {}
@@ -249,7 +431,23 @@ class TemplateFormatter(string.Formatter):
                 (r'\s',                 None)
         ], flags=re.DOTALL)
 
+    def _compile_program(self, prog):
+        ans = self.compiled_programs.get(prog)
+        if ans is None:
+            try:
+                ans = _Compiler(self.lex_scanner.scan(prog)).program()
+            except Exception:
+                ans = False  # Let _Parser report the error
+            if len(self.compiled_programs) >= self.MAX_COMPILED:
+                self.compiled_programs.clear()
+            self.compiled_programs[prog] = ans
+        return ans
+
     def _eval_program(self, val, prog, column_name):
+        if self.compile_templates:
+            compiled = self._compile_program(prog)
+            if compiled is not False:
+                return compiled(_Context(self, val))
         # keep a cache of the lex'ed program under the theory that re-lexing
         # is much more expensive than the cache lookup. This is certainly true
         # for more than a few tokens, but it isn't clear for simple programs.
@@ -263,21 +461,62 @@ class TemplateFormatter(string.Formatter):
         parser = _Parser(val, lprog, self.funcs, self)
         return parser.program()
 
+    def template_fields(self, fmt):
+        '''
+        Return (fields, functions), the names of the fields that the template
+        fmt refers to and the names of the functions it calls, found by parsing
+        the template without running it. fields is None if they cannot be
+        known, because a field name or a format spec is computed when the
+        template is run. Raises ValueError if the template has a syntax error.
+        '''
+        fields, functions = set(), set()
+        if fmt.startswith('program:'):
+            dynamic = self._program_fields(fmt[8:], fields, functions)
+        else:
+            dynamic = self._template_fields(fmt, fields, functions)
+        return (None if dynamic else fields), functions
+
+    def _program_fields(self, prog, fields, functions):
+        finder = _FieldFinder(self.lex_scanner.scan(prog))
+        finder.program()
+        fields |= finder.fields
+        functions |= finder.functions
+        return finder.dynamic
+
+    def _template_fields(self, fmt, fields, functions):
+        dynamic = False
+        for literal_text, field_name, format_spec, conversion in self.parse(fmt):
+            if field_name is None:
+                continue
+            first = field_name._formatter_field_name_split()[0]
+            if first and isinstance(first, basestring):
+                fields.add(first)
+            if '{' in format_spec or '}' in format_spec:
+                # The format spec contains nested fields
+                return True
+            program, func_name = self._parse_format_field(format_spec)[3:5]
+            if program is not None:
+                dynamic |= self._program_fields(program, fields, functions)
+            elif func_name is not None:
+                functions.add(func_name)
+        return dynamic
+
     # ################# Override parent classes methods #####################
 
     def get_value(self, key, args, kwargs):
         raise Exception('get_value must be implemented in the subclass')
 
     def format_field(self, val, fmt):
-        # ensure we are dealing with a string.
-        if isinstance(val, (int, float)):
-            if val:
-                val = unicode(val)
-            else:
-                val = ''
+        return self._apply_format_field(val, self._parse_format_field(fmt))
+
+    def _parse_format_field(self, fmt):
+        ''' Split the format spec of a field into the parts needed by
+        _apply_format_field(). The result depends only on fmt, so it is cached
+        by _compile_template(). '''
         # Handle conditional text
         fmt, prefix, suffix = self._explode_format_string(fmt)
 
+        program = func_name = func_desc = func_args = None
         # Handle functions
         # First see if we have a functional-style expression
         if fmt.startswith('\''):
@@ -287,7 +526,7 @@ class TemplateFormatter(string.Formatter):
             if p >= 0:
                 p += 1
         if p >= 0 and fmt[-1] == '\'':
-            val = self._eval_program(val, fmt[p+1:-1], None)
+            program = fmt[p+1:-1]
             colon = fmt[0:p].find(':')
             if colon < 0:
                 dispfmt = ''
@@ -305,36 +544,94 @@ class TemplateFormatter(string.Formatter):
                 else:
                     dispfmt = fmt[0:colon]
                     colon += 1
-
-                fname = fmt[colon:p].strip()
-                if fname in self.funcs:
-                    func = self.funcs[fname]
-                    if func.arg_count == 2:
-                        # only one arg expected. Don't bother to scan. Avoids need
-                        # for escaping characters
-                        args = [fmt[p+1:-1]]
-                    else:
-                        args = self.arg_parser.scan(fmt[p+1:])[0]
-                        args = [self.backslash_comma_to_comma.sub(',', a) for a in args]
-                    if (func.arg_count == 1 and (len(args) != 1 or args[0])) or \
-                            (func.arg_count > 1 and func.arg_count != len(args)+1):
-                        raise ValueError('Incorrect number of arguments for function '+ fmt[0:p])
-                    if func.arg_count == 1:
-                        val = func.eval_(self, self.kwargs, self.book, self.locals, val)
-                        if self.strip_results:
-                            val = val.strip()
-                    else:
-                        val = func.eval_(self, self.kwargs, self.book, self.locals, val, *args)
-                        if self.strip_results:
-                            val = val.strip()
+                func_name, func_desc = fmt[colon:p].strip(), fmt[0:p]
+                # Functions that expect only one arg get the text as is, this
+                # avoids the need for escaping characters
+                single_arg = [fmt[p+1:-1]]
+                args = self.arg_parser.scan(fmt[p+1:])[0]
+                args = [self.backslash_comma_to_comma.sub(',', a) for a in args]
+                func_args = single_arg, args
+        return prefix, suffix, dispfmt, program, func_name, func_desc, func_args
+
+    def _apply_format_field(self, val, parsed_fmt):
+        prefix, suffix, dispfmt, program, fname, func_desc, func_args = parsed_fmt
+        # ensure we are dealing with a string.
+        if isinstance(val, (int, float)):
+            if val:
+                val = unicode(val)
+            else:
+                val = ''
+        if program is not None:
+            val = self._eval_program(val, program, None)
+        elif fname is not None:
+            if fname in self.funcs:
+                func = self.funcs[fname]
+                args = func_args[0] if func.arg_count == 2 else func_args[1]
+                if (func.arg_count == 1 and (len(args) != 1 or args[0])) or \
+                        (func.arg_count > 1 and func.arg_count != len(args)+1):
+                    raise ValueError('Incorrect number of arguments for function '+ func_desc)
+                if func.arg_count == 1:
+                    val = func.eval_(self, self.kwargs, self.book, self.locals, val)
+                    if self.strip_results:
+                        val = val.strip()
                 else:
-                    return _('%s: unknown function')%fname
+                    val = func.eval_(self, self.kwargs, self.book, self.locals, val, *args)
+                    if self.strip_results:
+                        val = val.strip()
+            else:
+                return _('%s: unknown function')%fname
         if val:
             val = self._do_format(val, dispfmt)
         if not val:
             return ''
         return prefix + val + suffix
 
+    def _compile_template(self, fmt):
+        ''' Parse a single function mode template into a list of literal strings
+        and (field_name, lookups, conversion, format_spec, parsed_format_spec)
+        tuples,
+        see vformat(). '''
+        ans = self.compiled_templates.get(fmt)
+        if ans is None:
+            ans = []
+            try:
+                for literal_text, field_name, format_spec, conversion in self.parse(fmt):
+                    if literal_text:
+                        ans.append(literal_text)
+                    if field_name is not None:
+                        first, rest = field_name._formatter_field_name_split()
+                        pf = None
+                        if '{' not in format_spec and '}' not in format_spec:
+                            # No nested fields in the format spec
+                            pf = self._parse_format_field(format_spec)
+                        ans.append((first, tuple(rest), conversion, format_spec, pf))
+            except Exception:
+                ans = False  # Let string.Formatter report the error
+            if len(self.compiled_templates) >= self.MAX_COMPILED:
+                self.compiled_templates.clear()
+            self.compiled_templates[fmt] = ans
+        return ans
+
+    def vformat(self, fmt, args, kwargs):
+        compiled = self._compile_template(fmt) if self.compile_templates else False
+        if compiled is False:
+            return string.Formatter.vformat(self, fmt, args, kwargs)
+        result = []
+        for part in compiled:
+            if part.__class__ is not tuple:
+                result.append(part)
+                continue
+            first, rest, conversion, format_spec, parsed_format_spec = part
+            obj = self.get_value(first, args, kwargs)
+            for is_attr, i in rest:
+                obj = getattr(obj, i) if is_attr else obj[i]
+            obj = self.convert_field(obj, conversion)
+            if parsed_format_spec is None:
+                result.append(self.format_field(obj, self._vformat(format_spec, args, kwargs, set(), 1)))
+            else:
+                result.append(self._apply_format_field(obj, parsed_format_spec))
+        return ''.join(result)
+
     def evaluate(self, fmt, args, kwargs):
         if fmt.startswith('program:'):
             ans = self._eval_program(kwargs.get('$', None), fmt[8:], self.column_name)
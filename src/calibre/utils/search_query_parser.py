@@ -16,7 +16,7 @@ methods :method:`SearchQueryParser.universal_set` and
 If this module is run, it will perform a series of unit tests.
 '''
 
-import weakref, re
+import weakref, re, time
 
 from calibre.constants import preferred_encoding
 from calibre.utils.icu import sort_key
@@ -316,11 +316,16 @@ class SearchQueryParser(object):
                 failed.append(test[0])
         return failed
 
-    def __init__(self, locations, test=False, optimize=False, lookup_saved_search=None, parse_cache=None):
+    # When not None, evaluate() records a line per node of the query tree in
+    # this list, see explain()
+    explain_log = None
+
+    def __init__(self, locations, test=False, optimize=False, lookup_saved_search=None, parse_cache=None, plan_queries=False):
         self.sqp_initialize(locations, test=test, optimize=optimize)
         self.parser = Parser()
         self.lookup_saved_search = global_lookup_saved_search if lookup_saved_search is None else lookup_saved_search
         self.sqp_parse_cache = parse_cache
+        self.plan_queries = plan_queries
 
     def sqp_change_locations(self, locations):
         self.sqp_initialize(locations, optimize=self.optimize)
@@ -354,6 +359,8 @@ class SearchQueryParser(object):
                 res = self.parser.parse(query, self.locations)
             except RuntimeError:
                 raise ParseException(_('Failed to parse query, recursion limit reached: %s')%repr(query))
+            if self.plan_queries:
+                res = self.plan(res)
             if self.sqp_parse_cache is not None:
                 self.sqp_parse_cache[query] = res
         if candidates is None:
@@ -366,22 +373,132 @@ class SearchQueryParser(object):
         return getattr(self, 'evaluate_'+group_name)
 
     def evaluate(self, parse_result, candidates):
+        if self.explain_log is not None:
+            return self.explain_evaluate(parse_result, candidates)
         return self.method(parse_result[0])(parse_result[1:], candidates)
 
+    def estimate_cost(self, location, query):
+        '''
+        Return a rough, relative estimate of how expensive it is to evaluate
+        the token :param:`location`::param:`query`. Used by :meth:`plan` to
+        decide the order in which the operands of `and` and `or` are
+        evaluated. Subclasses should override this, the default treats all
+        tokens as equally expensive, which preserves the order in the query.
+        '''
+        return 1
+
+    def plan_cost(self, tree):
+        kind = tree[0]
+        if kind == 'token':
+            return self.estimate_cost(tree[1], tree[2])
+        if kind == 'not':
+            return self.plan_cost(tree[1])
+        return sum(self.plan_cost(x) for x in tree[1:])
+
+    def plan(self, tree):
+        '''
+        Rewrite the parse tree so that the cheapest operands of every chain of
+        `and` or `or` expressions are evaluated first. Since evaluate_and() and
+        evaluate_or() only pass the candidates not yet decided to the right
+        hand side, this means that expensive terms, such as regular
+        expressions or composite columns, are evaluated over as few books as
+        possible. `and` and `or` are commutative, so the result of the
+        search is unchanged.
+        '''
+        kind = tree[0]
+        if kind == 'token':
+            return tree
+        if kind == 'not':
+            return ['not', self.plan(tree[1])]
+
+        def operands(node):
+            if node[0] == kind:
+                for child in node[1:]:
+                    for x in operands(child):
+                        yield x
+            else:
+                yield self.plan(node)
+        # sorted() is stable, so terms with equal costs keep the order in
+        # which they were specified
+        ops = sorted(operands(tree), key=self.plan_cost)
+        ans = ops[-1]
+        for op in reversed(ops[:-1]):
+            ans = [kind, op, ans]
+        return ans
+
+    def explain(self, query):
+        '''
+        Run the search for :param:`query` and return its results along with a
+        list of lines describing how it was evaluated. Every node in the
+        (planned) query tree gets a line showing its estimated cost, the
+        number of candidates it was evaluated over, the number of matches and
+        the time taken. Nodes are indented below their parents, saved searches
+        are expanded.
+        '''
+        self.explain_log, self.explain_depth = [], 0
+        try:
+            ans = self.parse(query)
+            return ans, [self.format_explain_entry(*x) for x in self.explain_log]
+        finally:
+            self.explain_log = None
+
+    def explain_evaluate(self, parse_result, candidates):
+        kind = parse_result[0]
+        desc = kind.upper() if kind != 'token' else '%s:%s' % (parse_result[1], parse_result[2])
+        entry = [self.explain_depth, desc, self.plan_cost(parse_result), len(candidates), 0, 0]
+        self.explain_log.append(entry)
+        self.explain_depth += 1
+        st = time.time()
+        try:
+            ans = self.method(kind)(parse_result[1:], candidates)
+        finally:
+            self.explain_depth -= 1
+        entry[4], entry[5] = len(ans), time.time() - st
+        return ans
+
+    def format_explain_entry(self, depth, desc, cost, num_candidates, num_matches, duration):
+        return '%s%s  [cost: %s, candidates: %d, matches: %d, time: %.2f ms]' % (
+            '  ' * depth, desc, cost, num_candidates, num_matches, duration * 1000)
+
     def evaluate_and(self, argument, candidates):
         # RHS checks only those items matched by LHS
         # returns result of RHS check: RHmatches(LHmatches(c))
         #  return self.evaluate(argument[0]).intersection(self.evaluate(argument[1]))
-        l = self.evaluate(argument[0], candidates)
+        recurse_level = self.recurse_level
+        try:
+            l = self.evaluate(argument[0], candidates)
+        except ParseException as e:
+            r = self.evaluate_after_error(e, recurse_level, argument[1], candidates)
+            if r:
+                raise e
+            return r
         return l.intersection(self.evaluate(argument[1], l))
 
     def evaluate_or(self, argument, candidates):
         # RHS checks only those elements not matched by LHS
         # returns LHS union RHS: LHmatches(c) + RHmatches(c-LHmatches(c))
         #  return self.evaluate(argument[0]).union(self.evaluate(argument[1]))
-        l = self.evaluate(argument[0], candidates)
+        recurse_level = self.recurse_level
+        try:
+            l = self.evaluate(argument[0], candidates)
+        except ParseException as e:
+            r = self.evaluate_after_error(e, recurse_level, argument[1], candidates)
+            if candidates.difference(r):
+                raise e
+            return r
         return l.union(self.evaluate(argument[1], candidates.difference(l)))
 
+    def evaluate_after_error(self, err, recurse_level, other_operand, candidates):
+        # Terms that are invalid, such as a malformed date, raise an error
+        # only when there are candidates left to evaluate them over. plan()
+        # can move such a term ahead of a term that leaves no candidates for
+        # it, so in a planned query, the error is raised only if the other
+        # operand of the `and` or `or` leaves candidates for the invalid term.
+        if not self.plan_queries:
+            raise err
+        self.recurse_level = recurse_level
+        return self.evaluate(other_operand, candidates)
+
     def evaluate_not(self, argument, candidates):
         # unary op checks only candidates. Result: list of items matching
         # returns: c - matches(c)